@@ -237,6 +237,7 @@ start_wireguard() {
         --cap-add NET_ADMIN \
         --cap-add SYS_MODULE \
         -e WG_INTERFACE=wg0 \
+        -e "WG_INTERFACES=${WG_INTERFACES:-wg0}" \
         -e WG_PORT=$WG_PORT \
         -e SERVER_VPN_IP=$SERVER_VPN_IP \
         -e TZ=Asia/Shanghai \
@@ -309,6 +310,8 @@ start_web() {
         --user root \
         -e "WEB_PORT=$WEB_PORT" \
         -e "TZ=Asia/Shanghai" \
+        -e "WG_INTERFACES=${WG_INTERFACES:-wg0}" \
+        -e "WG_SHARD_POLICY=${WG_SHARD_POLICY:-first}" \
         -e "ADMIN_USERNAME=$admin_username" \
         -e 'ADMIN_PASSWORD='"$admin_password" \
         -e "SECRET_KEY=$secret_key" \
@@ -463,6 +466,8 @@ change_admin_password() {
         --user root \
         -e "WEB_PORT=$WEB_PORT" \
         -e "TZ=Asia/Shanghai" \
+        -e "WG_INTERFACES=${WG_INTERFACES:-wg0}" \
+        -e "WG_SHARD_POLICY=${WG_SHARD_POLICY:-first}" \
         -e "ADMIN_USERNAME=$admin_username" \
         -e 'ADMIN_PASSWORD='"$new_password" \
         -e "SECRET_KEY=$secret_key" \
@@ -18,16 +18,25 @@ else
     echo "Running as user $(id -u):$(id -g)"
 fi
 
-# 等待配置文件存在
-TIMEOUT=30
-COUNTER=0
+# 等待配置文件存在：用 inotifywait 监听目录，文件一出现立即继续（没有 inotify-tools 时短间隔轮询）
+TIMEOUT=${CONFIG_WAIT_TIMEOUT:-30}
+WG_CONF_DIR="$(dirname "$WG_CONF")"
+mkdir -p "$WG_CONF_DIR"
 
 echo "Checking for WireGuard configuration..."
-while [ ! -f "$WG_CONF" ] && [ $COUNTER -lt $TIMEOUT ]; do
-    echo "Waiting for $WG_CONF... ($COUNTER/$TIMEOUT)"
-    sleep 2
-    COUNTER=$((COUNTER + 2))
-done
+if [ ! -f "$WG_CONF" ]; then
+    echo "Waiting for $WG_CONF (up to ${TIMEOUT}s)..."
+    SECONDS=0
+    while [ ! -f "$WG_CONF" ] && [ $SECONDS -lt "$TIMEOUT" ]; do
+        if command -v inotifywait >/dev/null 2>&1; then
+            # 最多等 1 秒再检查一次，避免错过检查和开始监听之间创建的文件
+            inotifywait -qq -t 1 -e create -e moved_to "$WG_CONF_DIR" >/dev/null 2>&1 || true
+        else
+            sleep 0.2
+        fi
+    done
+    [ -f "$WG_CONF" ] && echo "✓ Config appeared after ${SECONDS}s"
+fi
 
 if [ ! -f "$WG_CONF" ]; then
     echo "⚠️  WireGuard config not found, creating placeholder..."
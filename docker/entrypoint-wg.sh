@@ -7,7 +7,8 @@ set -e
 WG_INTERFACE=${WG_INTERFACE:-wg0}
 WG_PORT=${WG_PORT:-51820}
 SERVER_VPN_IP=${SERVER_VPN_IP:-10.8.0.1/24}
-WG_CONF="/etc/wireguard/${WG_INTERFACE}.conf"
+# 多接口：逗号分隔，如 "wg0,wg1"。第 N 个接口使用 WG_PORT+N 端口和第三段 +N 的网段
+WG_INTERFACES=${WG_INTERFACES:-$WG_INTERFACE}
 
 echo "=========================================="
 echo "WireGuard Docker Container"
@@ -25,9 +26,19 @@ echo "Enabling IP forwarding..."
 sysctl -w net.ipv4.ip_forward=1 >/dev/null
 sysctl -w net.ipv4.conf.all.forwarding=1 >/dev/null
 
-# 检查配置文件是否存在
-if [ ! -f "$WG_CONF" ]; then
-    echo "No WireGuard configuration found. Generating initial configuration..."
+# 生成接口初始配置: generate_config <接口> <端口> <VPN地址>
+generate_config() {
+    local iface=$1
+    local port=$2
+    local address=$3
+    local conf="/etc/wireguard/${iface}.conf"
+    # 主接口沿用原有密钥文件名，其他接口加接口名前缀
+    local key_prefix=""
+    if [ "$iface" != "$WG_INTERFACE" ]; then
+        key_prefix="${iface}_"
+    fi
+
+    echo "No WireGuard configuration found for $iface. Generating initial configuration..."
 
     # 获取容器外网接口
     DEFAULT_INTERFACE=$(ip route | grep default | awk '{print $5}' | head -n1)
@@ -40,36 +51,36 @@ if [ ! -f "$WG_CONF" ]; then
     SERVER_PUBLIC_KEY=$(echo "$SERVER_PRIVATE_KEY" | wg pubkey)
 
     # 保存密钥
-    echo "$SERVER_PRIVATE_KEY" > /etc/wireguard/server_private.key
-    echo "$SERVER_PUBLIC_KEY" > /etc/wireguard/server_public.key
-    chmod 600 /etc/wireguard/server_private.key
+    echo "$SERVER_PRIVATE_KEY" > /etc/wireguard/${key_prefix}server_private.key
+    echo "$SERVER_PUBLIC_KEY" > /etc/wireguard/${key_prefix}server_public.key
+    chmod 600 /etc/wireguard/${key_prefix}server_private.key
 
     # 创建服务端配置
-    cat > "$WG_CONF" <<EOF
+    cat > "$conf" <<EOF
 [Interface]
 # 服务端私钥
 PrivateKey = $SERVER_PRIVATE_KEY
 # 服务端 VPN 内网地址
-Address = $SERVER_VPN_IP
+Address = $address
 # 监听端口
-ListenPort = $WG_PORT
+ListenPort = $port
 # 不保存运行时配置
 SaveConfig = false
 
 # 启动时执行的命令
-PostUp = iptables -A FORWARD -i $WG_INTERFACE -j ACCEPT
-PostUp = iptables -A FORWARD -o $WG_INTERFACE -j ACCEPT
+PostUp = iptables -A FORWARD -i $iface -j ACCEPT
+PostUp = iptables -A FORWARD -o $iface -j ACCEPT
 PostUp = iptables -t nat -A POSTROUTING -o $DEFAULT_INTERFACE -j MASQUERADE
-PostUp = iptables -A INPUT -p udp --dport $WG_PORT -j ACCEPT
+PostUp = iptables -A INPUT -p udp --dport $port -j ACCEPT
 
 # 关闭时执行的命令
-PostDown = iptables -D FORWARD -i $WG_INTERFACE -j ACCEPT || true
-PostDown = iptables -D FORWARD -o $WG_INTERFACE -j ACCEPT || true
+PostDown = iptables -D FORWARD -i $iface -j ACCEPT || true
+PostDown = iptables -D FORWARD -o $iface -j ACCEPT || true
 PostDown = iptables -t nat -D POSTROUTING -o $DEFAULT_INTERFACE -j MASQUERADE || true
-PostDown = iptables -D INPUT -p udp --dport $WG_PORT -j ACCEPT || true
+PostDown = iptables -D INPUT -p udp --dport $port -j ACCEPT || true
 EOF
 
-    chmod 600 "$WG_CONF"
+    chmod 600 "$conf"
 
     # 创建客户端配置目录
     mkdir -p /etc/wireguard/clients
@@ -84,50 +95,77 @@ EOF
     echo ""
     echo "Server Public Key: $SERVER_PUBLIC_KEY"
     echo ""
-fi
+}
 
-# 启动 WireGuard
-echo "Starting WireGuard interface: $WG_INTERFACE"
+# 启动接口: start_interface <接口>
+start_interface() {
+    local iface=$1
 
-# 检查接口是否已存在
-if ip link show "$WG_INTERFACE" >/dev/null 2>&1; then
-    echo "⚠️  Interface $WG_INTERFACE already exists, bringing it down first..."
-    wg-quick down "$WG_INTERFACE" 2>/dev/null || true
-    sleep 2
-fi
+    # 启动 WireGuard
+    echo "Starting WireGuard interface: $iface"
 
-# 启动接口
-if wg-quick up "$WG_INTERFACE"; then
-    echo "✓ WireGuard started successfully"
-else
-    echo "❌ Failed to start WireGuard interface"
-    exit 1
-fi
-echo ""
+    # 检查接口是否已存在
+    if ip link show "$iface" >/dev/null 2>&1; then
+        echo "⚠️  Interface $iface already exists, bringing it down first..."
+        wg-quick down "$iface" 2>/dev/null || true
+        sleep 2
+    fi
+
+    # 启动接口
+    if wg-quick up "$iface"; then
+        echo "✓ WireGuard started successfully"
+    else
+        echo "❌ Failed to start WireGuard interface"
+        exit 1
+    fi
+    echo ""
+}
+
+# 根据接口序号推导端口和网段（第三段 +N）
+IFS=',' read -r -a INTERFACE_LIST <<< "$WG_INTERFACES"
+IFS='./' read -r OCT1 OCT2 OCT3 OCT4 MASK <<< "$SERVER_VPN_IP"
+
+index=0
+for iface in "${INTERFACE_LIST[@]}"; do
+    if [ ! -f "/etc/wireguard/${iface}.conf" ]; then
+        generate_config "$iface" $((WG_PORT + index)) "${OCT1}.${OCT2}.$((OCT3 + index)).${OCT4}/${MASK}"
+    fi
+    start_interface "$iface"
+    index=$((index + 1))
+done
 
 # 显示状态
 echo "WireGuard Status:"
-wg show "$WG_INTERFACE"
-echo ""
+for iface in "${INTERFACE_LIST[@]}"; do
+    wg show "$iface"
+    echo ""
+done
 
 echo "Container is ready!"
 echo "=========================================="
 
-# 保持容器运行并监控 WireGuard 状态
-while true; do
-    if ! wg show "$WG_INTERFACE" >/dev/null 2>&1; then
-        echo "⚠️  WireGuard interface down, attempting restart..."
-
-        # 确保接口完全关闭
-        wg-quick down "$WG_INTERFACE" 2>/dev/null || true
-        sleep 2
+# 守护接口：亚秒级检测故障，按退避重建并补回缺失的 peer，提供 /livez 和 /readyz
+if [ "${WG_SUPERVISOR:-true}" != "false" ] && command -v python3 >/dev/null 2>&1; then
+    exec python3 -u /app/wgsupervisor.py
+fi
 
-        # 重新启动接口
-        if wg-quick up "$WG_INTERFACE" 2>/dev/null; then
-            echo "✓ WireGuard interface restarted successfully"
-        else
-            echo "❌ Failed to restart WireGuard interface"
+# 未启用守护进程时：保持容器运行并每 30 秒检查一次 WireGuard 状态
+while true; do
+    for iface in "${INTERFACE_LIST[@]}"; do
+        if ! wg show "$iface" >/dev/null 2>&1; then
+            echo "⚠️  WireGuard interface $iface down, attempting restart..."
+
+            # 确保接口完全关闭
+            wg-quick down "$iface" 2>/dev/null || true
+            sleep 2
+
+            # 重新启动接口
+            if wg-quick up "$iface" 2>/dev/null; then
+                echo "✓ WireGuard interface $iface restarted successfully"
+            else
+                echo "❌ Failed to restart WireGuard interface $iface"
+            fi
         fi
-    fi
+    done
     sleep 30
 done
@@ -0,0 +1,12 @@
+"""
+测试公共设置
+
+app / wgcore 在导入时按环境变量确定 WG_DIR 等路径，这里在导入前指向临时目录，
+测试不会读写 /etc/wireguard，也不执行 wg 命令。
+"""
+import os
+import sys
+import tempfile
+
+os.environ['WG_DIR'] = tempfile.mkdtemp(prefix='wgm-test-')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
@@ -0,0 +1,71 @@
+"""API 令牌：存储、校验和权限范围"""
+import json
+import os
+import stat
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = app.ApiTokenStore(str(tmp_path / 'api_tokens.json'))
+    monkeypatch.setattr(app, 'api_tokens', store)
+    return store
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_create_and_verify(store, tmp_path):
+    token, record = store.create('ci', ['read'], 'admin')
+    assert token.startswith(f"wgm_{record['id']}_")
+    assert 'hash' not in record
+
+    saved = json.loads((tmp_path / 'api_tokens.json').read_text())
+    assert token not in json.dumps(saved)
+    assert stat.S_IMODE(os.stat(tmp_path / 'api_tokens.json').st_mode) == 0o600
+
+    assert store.verify(token)['name'] == 'ci'
+    assert store.verify(token[:-1] + ('A' if token[-1] != 'A' else 'B')) is None
+    assert store.verify('wgm_unknown_secret') is None
+
+
+def test_revoke_and_expiry(store):
+    token, record = store.create('ci', ['read'], 'admin')
+    assert store.revoke(record['id'])
+    assert store.verify(token) is None
+    assert not store.revoke(record['id'])
+
+    expired, _ = store.create('old', ['read'], 'admin', expires_days=-1)
+    assert store.verify(expired) is None
+
+
+def request(client, token, method, path, **kwargs):
+    return client.open(path, method=method, headers={'Authorization': f'Bearer {token}'}, **kwargs)
+
+
+@pytest.mark.parametrize('scopes, secrets, write', [
+    (['read'], 403, 403),
+    (['secrets'], 200, 403),
+    (['write'], 200, 200),
+    (['read', 'secrets'], 200, 403),
+])
+def test_scopes(store, client, monkeypatch, scopes, secrets, write):
+    monkeypatch.setattr(app, 'get_client_config', lambda name: {'success': True, 'config': ''})
+    token, _ = store.create('ci', scopes, 'admin')
+    # write 包含 secrets，secrets 包含 read
+    assert request(client, token, 'GET', '/api/webhooks/status').status_code == 200
+    assert request(client, token, 'GET', '/api/client/alice/config').status_code == secrets
+    assert request(client, token, 'POST', '/api/quotas', json={}).status_code == write
+
+
+def test_invalid_token_and_session_only_views(store, client):
+    assert request(client, 'wgm_x_y', 'GET', '/api/webhooks/status').status_code == 401
+    token, _ = store.create('ci', ['write'], 'admin')
+    response = request(client, token, 'GET', '/api/tokens')
+    assert response.status_code == 403
+    assert '登录会话' in response.get_json()['error']
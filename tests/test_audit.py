@@ -0,0 +1,145 @@
+"""审计日志：分段、索引、查询和写入失败后的重试"""
+import json
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """record() 取 time.time() 作为 ts，每次调用前进 10 秒"""
+    now = [1_700_000_000.0]
+
+    def tick():
+        now[0] += 10
+        return now[0]
+
+    monkeypatch.setattr(app.time, 'time', tick)
+    return now
+
+
+def make_log(directory):
+    log = app.AuditLog(str(directory))
+    log._start = lambda: None   # 不启动后台写入线程，测试中显式 flush
+    return log
+
+
+def record_many(log, count):
+    for i in range(count):
+        log.record('client.add', 'wg0', [f'c{i % 3}'], [f'KEY{i % 3}'], actor='admin', n=i)
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_segments_and_index(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(app, 'AUDIT_SEGMENT_BYTES', 600)
+    monkeypatch.setattr(app, 'AUDIT_INDEX_STRIDE', 2)
+    log = make_log(tmp_path)
+    record_many(log, 20)
+    log.flush()
+
+    names = sorted(os.listdir(tmp_path))
+    segments = [name for name in names if name.endswith('.jsonl')]
+    assert len(segments) > 2
+    # 除当前写入段外都有索引
+    assert [name for name in names if name.endswith('.idx')] == [name[:-6] + '.idx' for name in segments[:-1]]
+
+    seq = 1
+    for name in segments:
+        entries = read_lines(tmp_path / name)
+        assert name == f'audit-{entries[0]["seq"]:012d}.jsonl'
+        assert [entry['seq'] for entry in entries] == list(range(seq, seq + len(entries)))
+        seq += len(entries)
+    assert seq == 21
+
+    # 保存的索引与重新扫描的结果一致，偏移指向对应的行
+    first = segments[0]
+    with open(tmp_path / (first[:-6] + '.idx')) as f:
+        index = json.load(f)
+    scanned = log._scan_segment(str(tmp_path / first), index['first_seq'])
+    assert index == {key: value for key, value in scanned.items() if key != 'path'}
+    assert [ts for ts, _ in index['sparse']] == [entry['ts'] for entry in read_lines(tmp_path / first)][::2]
+    with open(tmp_path / first, 'rb') as f:
+        for offset in index['peers']['KEY1']:
+            f.seek(offset)
+            assert json.loads(f.readline())['public_keys'] == ['KEY1']
+
+
+def test_query(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(app, 'AUDIT_SEGMENT_BYTES', 600)
+    log = make_log(tmp_path)
+    start = clock[0]
+    record_many(log, 20)
+    log.record('quota.suspend', 'wg0', ['c1'], ['KEY1'], actor='system')
+
+    entries, more = log.query(peer='c1')
+    assert not more
+    assert [entry['detail']['n'] for entry in entries if 'detail' in entry] == [1, 4, 7, 10, 13, 16, 19]
+    assert entries[-1]['op'] == 'quota.suspend'
+    assert [entry['seq'] for entry in log.query(peer='KEY1')[0]] == [entry['seq'] for entry in entries]
+
+    entries, _ = log.query(since=start + 50, until=start + 80)
+    assert [entry['seq'] for entry in entries] == [5, 6, 7, 8]
+    assert [entry['op'] for entry in log.query(op='quota.')[0]] == ['quota.suspend']
+
+    page, more = log.query(after_seq=3, limit=5)
+    assert more and [entry['seq'] for entry in page] == [4, 5, 6, 7, 8]
+
+
+def test_reload_continues_sequence(tmp_path, clock):
+    log = make_log(tmp_path)
+    record_many(log, 10)
+    log.flush()
+
+    # 当前段末尾残留写入中断的半行
+    current = sorted(name for name in os.listdir(tmp_path) if name.endswith('.jsonl'))[-1]
+    with open(tmp_path / current, 'a') as f:
+        f.write('{"seq": 11, "ts"')
+
+    reloaded = make_log(tmp_path)
+    assert reloaded.record('client.delete', 'wg0', ['c9'], actor='admin') == 11
+    reloaded.flush()
+    assert read_lines(tmp_path / current)[-1]['seq'] == 11
+    assert [entry['seq'] for entry in reloaded.query(peer='c9')[0]] == [11]
+
+
+def test_failed_write_keeps_entries(tmp_path, clock, monkeypatch):
+    log = make_log(tmp_path)
+    record_many(log, 3)
+    log.flush()
+    size = log._segments[-1]['size']
+
+    write_at = app.AuditLog._write_at
+
+    def fail(path, start, data):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(app.AuditLog, '_write_at', staticmethod(fail))
+    record_many(log, 2)
+    with pytest.raises(OSError):
+        log.flush()
+    assert [entry['seq'] for entry in log._buffer] == [4, 5]
+    assert log._segments[-1]['size'] == size
+    assert log._segments[-1]['last_seq'] == 3
+
+    monkeypatch.setattr(app.AuditLog, '_write_at', staticmethod(write_at))
+    log.record('client.delete', 'wg0', ['c0'], actor='admin')
+    log.flush()
+    assert [entry['seq'] for entry in read_lines(log._segments[-1]['path'])] == [1, 2, 3, 4, 5, 6]
+    assert log._segments[-1]['size'] == os.path.getsize(log._segments[-1]['path'])
+
+
+def test_prune_keeps_newest_segments(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(app, 'AUDIT_SEGMENT_BYTES', 300)
+    monkeypatch.setattr(app, 'AUDIT_KEEP_SEGMENTS', 2)
+    log = make_log(tmp_path)
+    record_many(log, 30)
+    log.flush()
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.jsonl')]) == 2
+    assert len(log._segments) == 2
+    assert log.query()[0][-1]['seq'] == 30
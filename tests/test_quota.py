@@ -0,0 +1,134 @@
+"""流量配额：超额暂停、失败回滚、堆压缩和周期切换"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import app
+from wgcore import ConfigIndex
+
+PUBLIC_KEY = 'ALICEPUB'
+CONFIG = f"""[Interface]
+PrivateKey = SERVERPRIV
+Address = 10.8.0.1/24
+
+# 客户端: alice
+[Peer]
+PublicKey = {PUBLIC_KEY}
+AllowedIPs = 10.8.0.2/32
+"""
+
+
+class FakeInterface:
+    name = 'wg0'
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def apply_peers(self, changes):
+        self.calls.append(changes)
+        return {'success': not self.fail, 'stderr': 'failed' if self.fail else ''}
+
+    def read_index(self):
+        return ConfigIndex(CONFIG)
+
+
+@pytest.fixture
+def iface(monkeypatch):
+    iface = FakeInterface()
+    monkeypatch.setattr(app, 'get_interface', lambda name=None: iface)
+    monkeypatch.setattr(app.audit, 'record', lambda *args, **kwargs: None)
+    monkeypatch.setattr(app.webhooks, 'publish', lambda *args, **kwargs: None)
+    return iface
+
+
+def make_enforcer(tmp_path, rule):
+    (tmp_path / 'quotas.json').write_text(json.dumps({'clients': {'alice': rule}}))
+    return app.QuotaEnforcer(str(tmp_path / 'quotas.json'), str(tmp_path / 'quota_state.json'))
+
+
+def observe(enforcer, now, total=None):
+    changed = []
+    if total is not None:
+        changed.append(SimpleNamespace(name='alice', group=None, interface='wg0', public_key=PUBLIC_KEY,
+                                       total_rx=total, total_tx=0))
+    enforcer.observe(SimpleNamespace(generated_at=now, changed=changed))
+
+
+def saved_state(tmp_path):
+    return json.loads((tmp_path / 'quota_state.json').read_text())
+
+
+def test_suspends_when_quota_exhausted(tmp_path, iface):
+    enforcer = make_enforcer(tmp_path, {'limit_bytes': 1000})
+    now = 1_700_000_000
+    observe(enforcer, now, 5000)          # 开始跟踪，基线为当前累计值
+    observe(enforcer, now + 10, 5900)
+    assert not enforcer.is_suspended('alice')
+    assert iface.calls == []
+
+    observe(enforcer, now + 20, 6000)
+    assert enforcer.is_suspended('alice')
+    assert iface.calls == [[(PUBLIC_KEY, None)]]
+    assert saved_state(tmp_path)['suspended']['alice']['used'] == 1000
+    assert enforcer.suspended_public_keys('wg0') == {PUBLIC_KEY}
+
+
+def test_failed_suspend_is_rolled_back(tmp_path, iface):
+    enforcer = make_enforcer(tmp_path, {'limit_bytes': 1000})
+    iface.fail = True
+    observe(enforcer, 1_700_000_000, 0)
+    observe(enforcer, 1_700_000_010, 2000)
+    assert not enforcer.is_suspended('alice')
+    assert saved_state(tmp_path)['suspended'] == {}
+
+
+def test_heap_is_compacted(tmp_path, iface):
+    enforcer = make_enforcer(tmp_path, {'limit_bytes': 10**12})
+    for i in range(100):
+        observe(enforcer, 1_700_000_000 + i, i * 1000)
+    assert len(enforcer._remaining) == 1
+    assert len(enforcer._heap) <= 2
+    assert enforcer._heap[0] == (10**12 - 99_000, 'alice')
+
+
+def test_monthly_rollover_restores(tmp_path, iface):
+    enforcer = make_enforcer(tmp_path, {'limit_bytes': 1000, 'period': 'monthly'})
+    now = 1_700_000_000
+    _, month_end = app._month_bounds(now)
+    observe(enforcer, now, 0)
+    observe(enforcer, now + 10, 1500)
+    assert enforcer.is_suspended('alice')
+
+    observe(enforcer, month_end - 1)
+    assert enforcer.is_suspended('alice')
+
+    observe(enforcer, month_end)
+    assert not enforcer.is_suspended('alice')
+    assert iface.calls[-1] == [(PUBLIC_KEY, '10.8.0.2/32')]
+    usage = saved_state(tmp_path)['usage']['alice']
+    assert usage['base'] == 1500
+    assert usage['period_end'] == app._month_bounds(month_end)[1]
+
+
+def test_rolling_window_drops_old_days(tmp_path, iface):
+    enforcer = make_enforcer(tmp_path, {'limit_bytes': 1000, 'period': 'rolling', 'window_days': 2})
+    day = 19_700
+    observe(enforcer, day * 86400 + 100, 0)
+    observe(enforcer, day * 86400 + 200, 600)
+    observe(enforcer, (day + 1) * 86400 + 100, 900)
+    usage = enforcer._usage['alice']
+    # 每天的起点是跨过日边界后第一次采集到的累计值，窗口内最早一天的起点是基线
+    assert usage['daily'] == {str(day): 0, str(day + 1): 900}
+    assert usage['base'] == 0
+    assert usage['period_end'] == (day + 2) * 86400
+
+    # 第三天：第一天移出窗口，基线变为第二天的起点
+    observe(enforcer, (day + 2) * 86400 + 100, 1500)
+    assert set(usage['daily']) == {str(day + 1), str(day + 2)}
+    assert usage['base'] == 900
+    assert not enforcer.is_suspended('alice')
+
+    observe(enforcer, (day + 2) * 86400 + 200, 1900)
+    assert enforcer.is_suspended('alice')
@@ -0,0 +1,73 @@
+"""用量历史：跨天起始值、计数重置和按周期汇总"""
+from datetime import datetime
+from types import SimpleNamespace
+
+import app
+
+
+def at(year, month, day, hour=12):
+    return datetime(year, month, day, hour).timestamp()
+
+
+def observe(history, now, **totals):
+    clients = [SimpleNamespace(name=name, interface='wg1' if name == 'carol' else 'wg0', total_rx=rx, total_tx=tx)
+               for name, (rx, tx) in totals.items()]
+    history.observe(SimpleNamespace(generated_at=now, clients=clients))
+
+
+def test_day_uses_previous_day_as_baseline(tmp_path):
+    history = app.UsageHistory(str(tmp_path))
+    observe(history, at(2026, 1, 30, 8), alice=(100, 10))
+    observe(history, at(2026, 1, 30, 20), alice=(300, 30))
+    observe(history, at(2026, 1, 31, 8), alice=(350, 35), bob=(1000, 0))
+    observe(history, at(2026, 1, 31, 20), alice=(500, 50), bob=(1500, 0))
+
+    rows = list(history.iter_usage('2026-01-30', '2026-01-31'))
+    assert rows == [
+        ('2026-01-30', 'alice', 'wg0', 200, 20, 220),
+        ('2026-01-31', 'alice', 'wg0', 200, 20, 220),
+        # 新客户端从当天首次采样开始计算
+        ('2026-01-31', 'bob', 'wg0', 500, 0, 500),
+    ]
+    assert history.days() == ['2026-01-30', '2026-01-31']
+
+
+def test_restart_continues_from_files(tmp_path):
+    history = app.UsageHistory(str(tmp_path))
+    observe(history, at(2026, 1, 30), alice=(100, 0))
+    observe(history, at(2026, 1, 30, 20), alice=(200, 0))
+    history.flush()
+
+    restarted = app.UsageHistory(str(tmp_path))
+    observe(restarted, at(2026, 1, 31), alice=(250, 0))
+    assert list(restarted.iter_usage('2026-01-31', '2026-01-31')) == [('2026-01-31', 'alice', 'wg0', 50, 0, 50)]
+
+
+def test_counter_reset_keeps_usage(tmp_path):
+    history = app.UsageHistory(str(tmp_path))
+    observe(history, at(2026, 2, 1, 8), alice=(1000, 0))
+    observe(history, at(2026, 2, 1, 9), alice=(1400, 0))
+    # 同名客户端重建后计数从 0 开始：起始值随之平移，当天已有的用量不变
+    observe(history, at(2026, 2, 1, 10), alice=(50, 0))
+    assert list(history.iter_usage('2026-02-01', '2026-02-01')) == [('2026-02-01', 'alice', 'wg0', 400, 0, 400)]
+    observe(history, at(2026, 2, 1, 11), alice=(80, 0))
+    assert list(history.iter_usage('2026-02-01', '2026-02-01')) == [('2026-02-01', 'alice', 'wg0', 430, 0, 430)]
+
+
+def test_month_and_total_granularity(tmp_path):
+    history = app.UsageHistory(str(tmp_path))
+    observe(history, at(2026, 1, 31, 1), alice=(0, 0), carol=(0, 0))
+    observe(history, at(2026, 1, 31, 23), alice=(100, 0), carol=(10, 0))
+    observe(history, at(2026, 2, 1, 23), alice=(300, 0), carol=(30, 0))
+    observe(history, at(2026, 2, 2, 23), alice=(600, 0), carol=(60, 0))
+
+    assert list(history.iter_usage('2026-01-01', '2026-02-28', 'month')) == [
+        ('2026-01', 'alice', 'wg0', 100, 0, 100),
+        ('2026-01', 'carol', 'wg1', 10, 0, 10),
+        ('2026-02', 'alice', 'wg0', 500, 0, 500),
+        ('2026-02', 'carol', 'wg1', 50, 0, 50),
+    ]
+    assert list(history.iter_usage('2026-02-01', '2026-02-02', 'total', names={'alice'})) == [
+        ('2026-02-01~2026-02-02', 'alice', 'wg0', 500, 0, 500),
+    ]
+    assert [row[1] for row in history.iter_usage('2026-01-01', '2026-02-28', 'total', interface='wg1')] == ['carol']
@@ -0,0 +1,168 @@
+"""wgcore 中不依赖 wg 命令的部分：配置词法分析、区间拼接和运行时 peer 对比"""
+import pytest
+
+import wgcore
+from wgcore import (DISABLED_PREFIX, BackendError, ConfigIndex, WGInterface, diff_peers,
+                    get_runtime_allowed_ips, normalize_allowed_ips, validate_peer_block)
+
+CONFIG = """[Interface]
+# 服务端私钥
+PrivateKey = SERVERPRIV
+Address = 10.8.0.1/24
+ListenPort = 51820
+
+# 启动时执行的命令
+PostUp = iptables -A FORWARD -i wg0 -j ACCEPT
+
+# 客户端: alice
+# 分组: office
+# 标签: laptop, vpn
+[Peer]
+PublicKey = AAAA
+AllowedIPs = 10.8.0.2/32, 10.9.0.0/24  # 办公网
+
+# Client: bob
+[Peer]
+PublicKey = BBBB
+AllowedIPs = 10.8.0.3/32
+
+[Peer]
+PublicKey = CCCC
+AllowedIPs = 10.8.0.4/32
+
+#~ # 客户端: dave
+#~ [Peer]
+#~ PublicKey = DDDD
+#~ AllowedIPs = 10.8.0.5/32
+"""
+
+
+def test_lexer_finds_every_peer_block():
+    index = ConfigIndex(CONFIG)
+    assert [span.public_key for span in index.peers] == ['AAAA', 'BBBB', 'CCCC', 'DDDD']
+    assert [span.name for span in index.peers] == ['alice', 'bob', None, 'dave']
+    assert index.interface_text.endswith('ACCEPT\n\n')
+    assert 'PostUp' in index.interface_text
+
+
+def test_lexer_fields():
+    alice, bob, unnamed, dave = ConfigIndex(CONFIG).peers
+    assert alice.allowed_ips == '10.8.0.2/32, 10.9.0.0/24'
+    assert alice.group == 'office'
+    assert alice.tags == ('laptop', 'vpn')
+    assert bob.group is None and bob.tags == ()
+    assert unnamed.client_name.startswith('Unknown-')
+    assert dave.disabled and not alice.disabled
+
+
+def test_spans_cover_blocks_exactly():
+    index = ConfigIndex(CONFIG)
+    assert index.block_text(index.peers[0]).startswith('# 客户端: alice\n')
+    assert index.block_text(index.peers[2]).startswith('[Peer]\n')
+    for left, right in zip(index.peers, index.peers[1:]):
+        assert left.end == right.start
+    assert index.peers[-1].end == len(CONFIG)
+
+
+def test_find():
+    index = ConfigIndex(CONFIG)
+    assert index.find('bob') == [1]
+    assert index.find(index.peers[2].client_name) == [2]
+    assert index.find('nobody') == []
+    assert index.find_public_key('DDDD') == [3]
+
+
+def test_splice_delete_shifts_later_spans():
+    index = ConfigIndex(CONFIG)
+    removed = index.splice(1)
+    assert 'BBBB' not in removed.text
+    assert '\n\n\n' not in removed.text
+    assert [span.public_key for span in removed.peers] == ['AAAA', 'CCCC', 'DDDD']
+    # 平移后的区间与重新扫描的结果一致
+    rescanned = ConfigIndex(removed.text)
+    assert [(s.start, s.end) for s in removed.peers] == [(s.start, s.end) for s in rescanned.peers]
+
+
+def test_splice_replace_and_validate():
+    index = ConfigIndex(CONFIG)
+    replaced = index.splice(2, '# 客户端: carl\n[Peer]\nPublicKey = EEEE\nAllowedIPs = 10.8.0.4/32\n\n')
+    assert replaced.peers[2].name == 'carl'
+    assert replaced.peers[2].public_key == 'EEEE'
+    assert ConfigIndex(replaced.text).peers[3].start == replaced.peers[3].start
+    with pytest.raises(ValueError):
+        index.splice(0, '[Peer]\nPublicKey = EEEE\n')
+
+
+def test_splice_many_matches_repeated_splice():
+    index = ConfigIndex(CONFIG)
+    blocks = {i: index.replace_public_key(i, f'NEW{i}') for i in (0, 2)}
+    batched = index.splice_many(blocks)
+    assert [span.public_key for span in batched.peers] == ['NEW0', 'BBBB', 'NEW2', 'DDDD']
+    assert batched.text == index.splice(0, blocks[0]).splice(2, blocks[2]).text
+
+
+def test_set_disabled_round_trip():
+    index = ConfigIndex(CONFIG)
+    disabled = index.set_disabled(1, True)
+    assert disabled.peers[1].disabled
+    assert DISABLED_PREFIX + 'PublicKey = BBBB' in disabled.text
+    assert disabled.set_disabled(1, False).text == CONFIG
+
+
+def test_set_metadata():
+    index = ConfigIndex(CONFIG).set_metadata(1, group='lab', tags=['a', 'b'])
+    assert index.peers[1].group == 'lab'
+    assert index.peers[1].tags == ('a', 'b')
+    cleared = index.set_metadata(1, group='', tags=[])
+    assert cleared.peers[1].group is None and cleared.peers[1].tags == ()
+
+
+def test_validate_peer_block():
+    assert validate_peer_block('[Peer]\nPublicKey = X\nAllowedIPs = 10.0.0.1/32\n') == []
+    assert validate_peer_block('[Peer]\nAllowedIPs = 10.0.0.1/32\n') == ['缺少PublicKey']
+    assert validate_peer_block('[Peer]\nPublicKey = X\n[Peer]\nPublicKey = Y\n')
+
+
+def test_lexer_reads_full_allowed_ips_without_comment():
+    (span,) = ConfigIndex('[Peer]\nPublicKey = K\nAllowedIPs = 10.0.0.2/32 ,fd00::2/128  # 备注\n').peers
+    assert span.allowed_ips == '10.0.0.2/32 ,fd00::2/128'
+
+
+def test_normalize_allowed_ips():
+    assert normalize_allowed_ips('10.8.0.9/24, fd00::1/64 10.8.0.2/32') == '10.8.0.0/24,10.8.0.2/32,fd00::/64'
+    assert normalize_allowed_ips('(none)') == ''
+    assert normalize_allowed_ips(None) == ''
+
+
+def test_diff_peers():
+    expected = {'A': '10.8.0.2/32', 'B': '10.8.0.3/32, 10.9.0.0/24', 'C': '10.8.0.4/32', 'D': ''}
+    running = {'A': '10.8.0.2/32', 'B': '10.8.0.3/32', 'D': '10.8.0.5/32', 'X': '10.8.0.6/32'}
+    drift, changes = diff_peers(expected, running)
+    assert {item['public_key']: item['kind'] for item in drift} == {
+        'B': 'allowed_ips', 'C': 'missing', 'D': 'allowed_ips', 'X': 'extra'}
+    assert changes == [('B', '10.8.0.3/32,10.9.0.0/24'), ('C', '10.8.0.4/32'),
+                       ('D', None), ('D', ''), ('X', None)]
+    assert diff_peers({'A': '10.8.0.2/32'}, {'A': '10.8.0.2/32'}) == ([], [])
+
+
+def test_apply_peers_builds_one_wg_set(monkeypatch):
+    commands = []
+    monkeypatch.setattr(wgcore, 'run_command', lambda cmd: commands.append(cmd) or {'success': True})
+    iface = WGInterface('wg0')
+    assert iface.apply_peers([])['success']
+    assert commands == []
+    iface.apply_peers([('A', '10.8.0.2/32, 10.9.0.0/24'), ('B', ''), ('C', None)])
+    assert commands == [['wg', 'set', 'wg0', 'peer', 'A', 'allowed-ips', '10.8.0.2/32,10.9.0.0/24',
+                         'peer', 'B', 'peer', 'C', 'remove']]
+
+
+def test_get_runtime_allowed_ips(monkeypatch):
+    output = 'A\t10.8.0.2/32 10.9.0.1/24\nB\t(none)\n'
+    monkeypatch.setattr(wgcore, 'run_command', lambda cmd, use_sudo=True: {'success': True, 'stdout': output})
+    assert get_runtime_allowed_ips('wg0') == {'A': '10.8.0.2/32,10.9.0.0/24', 'B': ''}
+    monkeypatch.setattr(wgcore, 'run_command', lambda cmd, use_sudo=True: {'success': False, 'stdout': ''})
+    assert get_runtime_allowed_ips('wg0') is None
+    monkeypatch.setattr(wgcore, 'run_command',
+                        lambda cmd, use_sudo=True: {'success': False, 'stdout': '', 'error': 'timeout'})
+    with pytest.raises(BackendError):
+        get_runtime_allowed_ips('wg0')
@@ -0,0 +1,122 @@
+"""接口守护：按配置补回缺失的 peer，跳过已禁用和因超出配额暂停的 peer"""
+import json
+
+import pytest
+
+import wgsupervisor
+from wgcore import ConfigIndex
+
+CONFIG = """[Interface]
+PrivateKey = SERVERPRIV
+Address = 10.8.0.1/24
+
+# 客户端: alice
+[Peer]
+PublicKey = AAAA
+AllowedIPs = 10.8.0.2/32
+
+# 客户端: bob
+[Peer]
+PublicKey = BBBB
+AllowedIPs = 10.8.0.3/32, 10.9.0.0/24
+
+# 客户端: carol
+[Peer]
+PublicKey = CCCC
+AllowedIPs = 10.8.0.4/32
+
+#~ # 客户端: dave
+#~ [Peer]
+#~ PublicKey = DDDD
+#~ AllowedIPs = 10.8.0.5/32
+"""
+
+
+class FakeInterface:
+    name = 'wg0'
+    conf = '/nonexistent/wg0.conf'
+
+    def invalidate(self):
+        pass
+
+    def read_index(self):
+        return ConfigIndex(CONFIG)
+
+
+@pytest.fixture
+def wg(tmp_path, monkeypatch):
+    """记录执行的命令；running 为运行时公钥，fail 为 wg set 是否失败"""
+    state = {'running': set(), 'fail': False, 'commands': []}
+
+    def run_command(cmd, use_sudo=True):
+        state['commands'].append(cmd)
+        if cmd[:2] == ['wg', 'show']:
+            return {'success': True, 'stdout': ''.join(f'{key}\t10.0.0.1/32\n' for key in state['running'])}
+        return {'success': not state['fail'], 'stderr': 'failed' if state['fail'] else ''}
+
+    monkeypatch.setattr(wgsupervisor, 'run_command', run_command)
+    monkeypatch.setattr(wgsupervisor, 'QUOTA_STATE_FILE', str(tmp_path / 'quota_state.json'))
+    return state
+
+
+def suspend(tmp_path, public_key, interface='wg0'):
+    (tmp_path / 'quota_state.json').write_text(json.dumps(
+        {'usage': {}, 'suspended': {'carol': {'interface': interface, 'public_key': public_key}}}))
+
+
+def set_commands(wg):
+    return [cmd for cmd in wg['commands'] if cmd[:2] == ['wg', 'set']]
+
+
+def test_reapplies_only_missing_enabled_peers(wg):
+    wg['running'] = {'AAAA'}
+    watch = wgsupervisor.InterfaceWatch(FakeInterface())
+    assert watch.verify()
+    assert set_commands(wg) == [['wg', 'set', 'wg0',
+                                 'peer', 'BBBB', 'allowed-ips', '10.8.0.3/32,10.9.0.0/24',
+                                 'peer', 'CCCC', 'allowed-ips', '10.8.0.4/32']]
+    assert watch.in_sync and watch.reapplied == 2
+
+
+def test_in_sync_runs_no_command(wg):
+    wg['running'] = {'AAAA', 'BBBB', 'CCCC'}
+    watch = wgsupervisor.InterfaceWatch(FakeInterface())
+    assert watch.verify()
+    assert set_commands(wg) == []
+    assert watch.in_sync
+
+
+def test_suspended_peer_is_not_reapplied(wg, tmp_path):
+    wg['running'] = {'AAAA', 'BBBB'}
+    suspend(tmp_path, 'CCCC')
+    watch = wgsupervisor.InterfaceWatch(FakeInterface())
+    assert watch.verify()
+    assert set_commands(wg) == []
+
+    # 其他接口上的暂停记录不影响本接口
+    suspend(tmp_path, 'CCCC', interface='wg1')
+    assert watch.verify()
+    assert set_commands(wg) == [['wg', 'set', 'wg0', 'peer', 'CCCC', 'allowed-ips', '10.8.0.4/32']]
+
+
+def test_restart_removes_readded_suspended_peer(wg, tmp_path):
+    wg['running'] = {'AAAA', 'BBBB', 'CCCC'}
+    suspend(tmp_path, 'CCCC')
+    watch = wgsupervisor.InterfaceWatch(FakeInterface())
+    assert watch.verify()
+    assert set_commands(wg) == []
+    assert watch.verify(restarted=True)
+    assert set_commands(wg) == [['wg', 'set', 'wg0', 'peer', 'CCCC', 'remove']]
+
+
+def test_failed_set_is_reported(wg):
+    wg['fail'] = True
+    watch = wgsupervisor.InterfaceWatch(FakeInterface())
+    assert watch.verify()
+    assert not watch.in_sync
+    assert watch.last_error.startswith('同步 peer 失败')
+
+
+def test_unreadable_runtime(wg, monkeypatch):
+    monkeypatch.setattr(wgsupervisor, 'run_command', lambda cmd, use_sudo=True: {'success': False})
+    assert not wgsupervisor.InterfaceWatch(FakeInterface()).verify()
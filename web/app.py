@@ -3,21 +3,55 @@
 WireGuard Web 管理界面 - Flask 后端
 """
 
-from flask import Flask, render_template, jsonify, request, send_file, redirect, url_for, flash, session
+from flask import (Flask, Response, render_template, jsonify, request, redirect, url_for, flash, session, g,
+                   has_request_context)
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import CSRFProtect, CSRFError
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import subprocess
+import click
 import os
 import re
+import sys
+import subprocess
+import csv
+import gzip
 import json
+import atexit
+import bisect
+import marshal
+import time
+import hmac
+import queue
+import heapq
+import itertools
+import random
+import hashlib
+import ipaddress
+import secrets
+import socket
+import threading
+import http.client
+import urllib.parse
+import urllib.request
 from datetime import datetime
 import tempfile
-import base64
-from io import BytesIO
+from io import StringIO
 import bcrypt
 from functools import wraps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from wgcore import (
+    WG_DIR, WG_INTERFACE, INTERFACES, ONLINE_THRESHOLD, BackendError, _breakers, _reload_hooks, _BLOCK_PUBLIC_KEY_RE,
+    run_command, get_interface, get_all_server_info, get_clients, serialize_clients, format_bytes,
+    load_traffic_data, generate_keypair, public_key_from_private,
+    _read_private_file, _write_private_file, generate_qrcode, read_client_config, cached_qrcode_png,
+    _qrcode_module, _qr_pool, QR_CACHE_SIZE, endpoint, format_endpoint, get_runtime_allowed_ips, diff_peers,
+    start_trace, end_trace, trace_span,
+    create_client, delete_peers, _clean_names, _group_by_interface, clients_in_group, configured_client_names,
+    _backup_config, _apply_runtime_changes, _delete_from_interface, _remove_client_files, export_targets,
+    _export_entries, _stream_zip
+)
 
 app = Flask(__name__)
 
@@ -26,10 +60,27 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24).hex())
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 会话1小时后过期
 app.config['WTF_CSRF_TIME_LIMIT'] = None  # CSRF令牌不过期（由会话控制）
 app.config['WTF_CSRF_SSL_STRICT'] = False  # 允许非HTTPS环境（生产环境应使用HTTPS）
+app.config['WTF_CSRF_CHECK_DEFAULT'] = False  # 由 authenticate_request 检查：API 令牌请求不需要 CSRF
 
 # CSRF 保护
 csrf = CSRFProtect(app)
 
+# 由 authenticate_request 读取的视图标记（视图函数对象集合）
+_csrf_exempt_views = set()   # 不做 CSRF 校验：agent、复制等使用各自令牌认证的接口
+_secret_views = set()        # 返回客户端私钥或原始配置：API 令牌需要 secrets 或 write 权限
+
+
+def csrf_exempt(view):
+    """标记视图不做 CSRF 校验（放在 @app.route 下面）"""
+    _csrf_exempt_views.add(view)
+    return view
+
+
+def returns_secrets(view):
+    """标记视图返回客户端私钥或原始配置，read 权限的 API 令牌不能访问（放在 @app.route 下面）"""
+    _secret_views.add(view)
+    return view
+
 # 会话Cookie配置
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
@@ -56,17 +107,37 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = '请先登录以访问此页面'
 
-# 配置
-WG_INTERFACE = "wg0"
-WG_DIR = "/etc/wireguard"
-WG_CONF = f"{WG_DIR}/{WG_INTERFACE}.conf"
-CLIENT_DIR = f"{WG_DIR}/clients"
-
 # 用户数据存储
 USERS_FILE = f"{WG_DIR}/users.json"
 
-# 流量数据存储
-TRAFFIC_FILE = f"{WG_DIR}/traffic.json"
+# 登录密码校验（bcrypt）在独立线程池中进行，突发登录不会占满请求线程
+AUTH_WORKERS = int(os.environ.get('AUTH_WORKERS', '2'))   # 同时校验密码的线程数
+AUTH_QUEUE = int(os.environ.get('AUTH_QUEUE', '8'))       # 排队等待校验的登录上限，超出时直接返回繁忙
+
+# API 令牌
+API_TOKENS_FILE = f"{WG_DIR}/api_tokens.json"
+
+# 运行模式：standalone（默认，完整 Web 界面）或 agent（仅提供节点 agent 接口）
+WGM_MODE = os.environ.get('WGM_MODE', 'standalone')
+
+# 节点 agent：控制器使用 AGENT_TOKEN 访问本节点的 /agent/v1/* 接口（未设置时接口禁用）
+AGENT_TOKEN = os.environ.get('AGENT_TOKEN', '')
+NODE_NAME = os.environ.get('NODE_NAME', socket.gethostname())
+
+# 多服务器控制器：FLEET_NODES="名称=http://host:port,名称2=http://host2:port"
+FLEET_NODES = os.environ.get('FLEET_NODES', '')
+FLEET_TOKEN = os.environ.get('FLEET_TOKEN', AGENT_TOKEN)
+FLEET_TIMEOUT = float(os.environ.get('FLEET_TIMEOUT', '3'))   # 单个节点请求超时（秒）
+FLEET_POOL_SIZE = int(os.environ.get('FLEET_POOL_SIZE', '4'))  # 每个节点保持的持久连接数
+
+# 配置复制：主节点把每次 peer 变更作为增量推送到备用节点
+REPLICATION_ROLE = os.environ.get('REPLICATION_ROLE', '')           # primary / standby / 空（关闭）
+REPLICATION_STANDBYS = os.environ.get('REPLICATION_STANDBYS', '')   # 主节点：逗号分隔的备用节点 URL
+REPLICATION_TOKEN = os.environ.get('REPLICATION_TOKEN', AGENT_TOKEN)
+REPLICATION_DIR = f"{WG_DIR}/replication"
+REPLICATION_INTERVAL = float(os.environ.get('REPLICATION_INTERVAL', '5'))                 # 心跳/重试间隔（秒）
+REPLICATION_SNAPSHOT_INTERVAL = float(os.environ.get('REPLICATION_SNAPSHOT_INTERVAL', '3600'))  # 全量快照间隔（秒）
+REPLICATION_JOURNAL_MAX = int(os.environ.get('REPLICATION_JOURNAL_MAX', '1000'))          # 日志保留的最大增量数
 
 # 用户模型
 class User(UserMixin):
@@ -116,15 +187,33 @@ class User(UserMixin):
 
 
 # 用户数据管理
+# 按文件 (mtime, size, inode) 缓存，会话请求加载用户时不再每次启动 cat 子进程
+_users_cache = {'key': None, 'data': {}}
+
+
+def _users_file_key():
+    try:
+        st = os.stat(USERS_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
 def load_users():
-    """加载用户数据"""
+    """加载用户数据（返回副本，可以修改后交给 save_users）"""
     try:
+        key = _users_file_key()
+        if key is not None and key == _users_cache['key']:
+            return json.loads(json.dumps(_users_cache['data']))
         if os.path.exists(USERS_FILE):
             result = run_command(['cat', USERS_FILE], use_sudo=False)
             if not result['success']:
                 result = run_command(['cat', USERS_FILE])
             if result['success']:
-                return json.loads(result['stdout'])
+                users = json.loads(result['stdout'])
+                if key is not None:
+                    _users_cache.update(key=key, data=users)
+                return json.loads(json.dumps(users))
         return {}
     except Exception as e:
         print(f"Error loading users: {e}")
@@ -142,6 +231,7 @@ def save_users(users_data):
         result = run_command(['cp', temp_file, USERS_FILE])
         run_command(['chmod', '600', USERS_FILE])
         os.unlink(temp_file)
+        _users_cache['key'] = None
 
         return result['success']
     except Exception as e:
@@ -169,14 +259,12 @@ def init_default_user():
             print("   - 至少包含一个特殊字符 (!@#$%^&* 等)")
             raise ValueError(f"密码不符合安全要求: {message}")
 
-        # 生成新的密码哈希
-        new_password_hash = User.hash_password(default_password)
-
-        # 检查是否需要更新密码
+        # 检查是否需要更新密码（bcrypt 每次加盐结果不同，只能用 checkpw 校验已保存的哈希）
         needs_update = False
         if default_username in users:
             # 用户已存在，检查密码是否需要更新
-            if users[default_username].get('password_hash') != new_password_hash:
+            stored = users[default_username]
+            if not User(default_username, stored.get('password_hash')).check_password(default_password):
                 needs_update = True
                 print(f"🔄 检测到环境变量密码变化，更新管理员密码: {default_username}")
         else:
@@ -187,7 +275,7 @@ def init_default_user():
         if needs_update:
             users[default_username] = {
                 'username': default_username,
-                'password_hash': new_password_hash
+                'password_hash': User.hash_password(default_password)
             }
 
             if save_users(users):
@@ -213,96 +301,6 @@ def init_default_user():
     return users
 
 
-# 流量数据管理
-def load_traffic_data():
-    """加载流量数据"""
-    try:
-        if os.path.exists(TRAFFIC_FILE):
-            result = run_command(['cat', TRAFFIC_FILE], use_sudo=False)
-            if not result['success']:
-                result = run_command(['cat', TRAFFIC_FILE])
-            if result['success']:
-                return json.loads(result['stdout'])
-        return {}
-    except Exception as e:
-        print(f"Error loading traffic data: {e}")
-        return {}
-
-
-def save_traffic_data(traffic_data):
-    """保存流量数据"""
-    try:
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            json.dump(traffic_data, f, indent=2)
-            temp_file = f.name
-
-        run_command(['mkdir', '-p', WG_DIR])
-        result = run_command(['cp', temp_file, TRAFFIC_FILE])
-        run_command(['chmod', '600', TRAFFIC_FILE])
-        os.unlink(temp_file)
-
-        return result['success']
-    except Exception as e:
-        print(f"Error saving traffic data: {e}")
-        return False
-
-
-def parse_transfer_size(size_str):
-    """将流量字符串转换为字节数（支持二进制和十进制单位）"""
-    if not size_str or size_str == '0 B':
-        return 0
-
-    # 二进制单位（1024为基数）
-    binary_units = {
-        'B': 1,
-        'KiB': 1024,
-        'MiB': 1024**2,
-        'GiB': 1024**3,
-        'TiB': 1024**4
-    }
-
-    # 十进制单位（1000为基数）
-    decimal_units = {
-        'B': 1,
-        'KB': 1000,
-        'MB': 1000**2,
-        'GB': 1000**3,
-        'TB': 1000**4
-    }
-
-    match = re.match(r'([\d.]+)\s*(\w+)', size_str)
-    if match:
-        value = float(match.group(1))
-        unit = match.group(2)
-        # 优先匹配二进制单位，然后匹配十进制单位
-        multiplier = binary_units.get(unit) or decimal_units.get(unit, 1)
-        return int(value * multiplier)
-    return 0
-
-
-def format_bytes(bytes_value):
-    """将字节数转换为十进制单位（MB, GB, TB）"""
-    if bytes_value == 0:
-        return '0 B'
-
-    units = ['B', 'KB', 'MB', 'GB', 'TB']
-    unit_index = 0
-    value = float(bytes_value)
-
-    # 使用1000为基数（十进制）
-    while value >= 1000 and unit_index < len(units) - 1:
-        value /= 1000
-        unit_index += 1
-
-    # 格式化输出
-    if value >= 100:
-        return f'{value:.1f} {units[unit_index]}'
-    elif value >= 10:
-        return f'{value:.2f} {units[unit_index]}'
-    else:
-        return f'{value:.2f} {units[unit_index]}'
-
-
 @login_manager.user_loader
 def load_user(username):
     """Flask-Login 用户加载回调"""
@@ -313,421 +311,1334 @@ def load_user(username):
     return None
 
 
-def run_command(cmd, use_sudo=True, shell=False):
+_auth_pool = ThreadPoolExecutor(max_workers=max(1, AUTH_WORKERS), thread_name_prefix='wg-auth')
+_auth_slots = threading.BoundedSemaphore(max(1, AUTH_WORKERS) + max(0, AUTH_QUEUE))
+
+
+def check_password_bounded(user, password):
     """
-    执行命令并返回结果
+    在 bcrypt 线程池中校验密码
 
-    Args:
-        cmd: 命令列表 (推荐) 或字符串 (仅用于需要shell的复杂命令)
-        use_sudo: 是否使用sudo
-        shell: 是否使用shell (仅在必要时使用)
+    同时最多 AUTH_WORKERS 个校验、AUTH_QUEUE 个排队，超出时不等待直接返回 None，
+    突发登录只占用有限的 CPU 和请求线程，不影响状态等其他请求。
 
     Returns:
-        dict: 包含success, stdout, stderr, returncode的字典
+        bool | None: 校验结果，繁忙时为 None
     """
+    if not _auth_slots.acquire(blocking=False):
+        return None
     try:
-        # 如果是字符串且不需要shell，转换为列表
-        if isinstance(cmd, str) and not shell:
-            cmd = cmd.split()
-
-        # 如果需要sudo且cmd是列表
-        if use_sudo and isinstance(cmd, list):
-            if cmd[0] != 'sudo':
-                cmd = ['sudo'] + cmd
-        elif use_sudo and isinstance(cmd, str):
-            if not cmd.startswith('sudo'):
-                cmd = f'sudo {cmd}'
-
-        result = subprocess.run(
-            cmd,
-            shell=shell,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        return {
-            'success': result.returncode == 0,
-            'stdout': result.stdout,
-            'stderr': result.stderr,
-            'returncode': result.returncode
-        }
-    except Exception as e:
+        with trace_span('bcrypt'):
+            return _auth_pool.submit(user.check_password, password).result()
+    finally:
+        _auth_slots.release()
+
+
+class StatusSnapshot:
+    """
+    一次完整状态采集的结果（各接口服务器信息 + 客户端记录）
+
+    后端不可用时返回上一次成功的快照，stale=True 并附带失败原因。
+    """
+    __slots__ = ('interfaces', 'clients', 'generated_at', 'stale', 'error', 'changed',
+                 '_group_index', '_tag_index', '_group_stats', '_sorted')
+
+    def __init__(self, interfaces, clients, generated_at, stale=False, error=None, changed=()):
+        self.interfaces = interfaces
+        self.clients = clients
+        self.generated_at = generated_at
+        self.stale = stale
+        self.error = error
+        self.changed = changed  # 本次采集中流量计数有变化的客户端
+        self._group_index = None
+        self._tag_index = None
+        self._group_stats = None
+        self._sorted = {}
+
+    def group_index(self):
+        """{分组: [PeerRecord]}（未分组为 None），每个快照只构建一次"""
+        if self._group_index is None:
+            index = {}
+            for client in self.clients:
+                index.setdefault(client.group, []).append(client)
+            self._group_index = index
+        return self._group_index
+
+    def tag_index(self):
+        """{标签: [PeerRecord]}，每个快照只构建一次"""
+        if self._tag_index is None:
+            index = {}
+            for client in self.clients:
+                for tag in client.tags:
+                    index.setdefault(tag, []).append(client)
+            self._tag_index = index
+        return self._tag_index
+
+    def group_stats(self):
+        """各分组的汇总（客户端数、在线数、禁用数、累计流量），每个快照只计算一次"""
+        if self._group_stats is None:
+            now = int(self.generated_at)
+            stats = {}
+            for group, clients in self.group_index().items():
+                total_rx = sum(c.total_rx for c in clients)
+                total_tx = sum(c.total_tx for c in clients)
+                stats[group] = {
+                    'group': group,
+                    'client_count': len(clients),
+                    'online_count': sum(1 for c in clients if c.is_online(now)),
+                    'disabled_count': sum(1 for c in clients if c.disabled),
+                    'total_rx_bytes': total_rx,
+                    'total_tx_bytes': total_tx,
+                    'transfer_total': format_bytes(total_rx + total_tx)
+                }
+            self._group_stats = stats
+        return self._group_stats
+
+    def sorted_clients(self, sort, descending=False):
+        """按 CLIENT_SORT_KEYS 中的列排序的客户端列表，每个快照每种排序只排一次"""
+        key = (sort, descending)
+        if key not in self._sorted:
+            sort_key = CLIENT_SORT_KEYS[sort]
+            now = int(self.generated_at)
+            self._sorted[key] = sorted(self.clients, key=lambda c: sort_key(c, now), reverse=descending)
+        return self._sorted[key]
+
+    def as_stale(self, error):
+        return StatusSnapshot(self.interfaces, self.clients, self.generated_at, stale=True, error=error)
+
+    def to_dict(self, now=None, include_clients=True):
+        """序列化为 /api/status 返回格式（include_clients=False 时不含客户端列表）"""
+        if now is None:
+            now = int(time.time())
         return {
-            'success': False,
-            'error': str(e)
+            'server': self.interfaces[0],
+            'interfaces': self.interfaces,
+            **({'clients': serialize_clients(self.clients, now)} if include_clients else {}),
+            'client_count': len(self.clients),
+            'online_count': sum(1 for c in self.clients if c.is_online(now)),
+            'generated_at': int(self.generated_at),
+            'stale': self.stale,
+            'age': max(0, int(now - self.generated_at)),
+            **({'error': self.error} if self.error else {})
         }
 
 
-def get_server_info():
-    """获取服务器信息"""
+def _ip_sort_key(ip):
+    try:
+        address = ipaddress.ip_address(ip.split('/')[0])
+        return (address.version, int(address))
+    except ValueError:
+        return (9, 0)
+
+
+# /api/clients 可用的排序列：key(客户端, 快照时间) -> 排序键
+CLIENT_SORT_KEYS = {
+    'name': lambda c, now: c.name.lower(),
+    'ip': lambda c, now: _ip_sort_key(c.ip),
+    'interface': lambda c, now: c.interface,
+    'group': lambda c, now: (c.group is None, c.group or ''),
+    'status': lambda c, now: (c.disabled, not c.is_online(now)),
+    'handshake': lambda c, now: c.handshake,
+    'transfer': lambda c, now: c.total_rx + c.total_tx
+}
+CLIENTS_PAGE_MAX = 500   # /api/clients 单页最多返回的客户端数
+
+
+# 状态快照缓存：仪表盘、agent 接口和 fleet 控制器共享同一次采集结果
+STATUS_CACHE_TTL = float(os.environ.get('STATUS_CACHE_TTL', '5'))
+_snapshot_lock = threading.Lock()
+_snapshot = None
+_last_good_snapshot = None
+
+
+def collect_status():
+    """采集一次完整状态，后端不可用时抛出 BackendError"""
+    interfaces = get_all_server_info()
+    changed = []
+    clients = get_clients(changed_clients=changed)
+    return StatusSnapshot(interfaces, clients, time.time(), changed=changed)
+
+
+def _is_fresh(snapshot, max_age):
+    return snapshot is not None and not snapshot.stale and time.time() - snapshot.generated_at < max_age
+
+
+def get_status_snapshot(max_age=None):
+    """
+    返回状态快照，超过 max_age 秒（默认 STATUS_CACHE_TTL）时重新采集
+
+    采集失败时返回上一次成功的快照（stale=True）；已有其他请求在采集时，
+    有旧快照就直接返回旧快照而不是排队等待，保证接口延迟有上限。
+    没有任何成功快照时才抛出 BackendError。
+    """
+    global _snapshot, _last_good_snapshot
+    if max_age is None:
+        max_age = STATUS_CACHE_TTL
+
+    snapshot = _snapshot
+    if _is_fresh(snapshot, max_age):
+        return snapshot
+
+    last_good = _last_good_snapshot
+    if not _snapshot_lock.acquire(blocking=last_good is None):
+        return last_good.as_stale('状态采集进行中')
+
     try:
-        # 检查配置文件是否存在
-        if not os.path.exists(WG_CONF):
-            print(f"DEBUG: Config file {WG_CONF} does not exist")
-            return {'error': 'WireGuard configuration not found'}
+        # 等待锁期间可能已由其他请求完成采集
+        snapshot = _snapshot
+        if _is_fresh(snapshot, max_age):
+            return snapshot
+        try:
+            snapshot = collect_status()
+        except Exception as e:
+            print(f"Status collection failed: {e}")
+            if _last_good_snapshot is None:
+                raise BackendError(str(e)) from e
+            _snapshot = _last_good_snapshot.as_stale(str(e))
+            return _snapshot
+        _snapshot = _last_good_snapshot = snapshot
+        _run_snapshot_hooks(snapshot)
+        return snapshot
+    finally:
+        _snapshot_lock.release()
 
-        # 检查文件权限
+
+def invalidate_status_snapshot():
+    """配置变更后丢弃缓存的快照"""
+    global _snapshot
+    _snapshot = None
+
+
+# 每次成功采集后调用的回调（在快照锁内按采集顺序调用）
+_snapshot_hooks = []
+
+
+def register_snapshot_hook(hook):
+    _snapshot_hooks.append(hook)
+    return hook
+
+
+def _run_snapshot_hooks(snapshot):
+    for hook in _snapshot_hooks:
         try:
-            stat_info = os.stat(WG_CONF)
-            print(f"DEBUG: Config file permissions: {oct(stat_info.st_mode)[-3:]}, owner: {stat_info.st_uid}:{stat_info.st_gid}")
+            hook(snapshot)
         except Exception as e:
-            print(f"DEBUG: Cannot stat config file: {e}")
+            print(f"Snapshot hook {getattr(hook, '__name__', hook)} failed: {e}")
 
-        # 获取服务器配置
-        result = run_command(['cat', WG_CONF], use_sudo=False)
-        if not result['success']:
-            print(f"DEBUG: Non-sudo read failed: {result.get('stderr', 'No error message')}")
-            # 尝试使用 sudo 读取
-            result = run_command(['cat', WG_CONF])
-            if not result['success']:
-                print(f"DEBUG: Sudo read also failed: {result.get('stderr', 'No error message')}")
-                return {'error': 'Cannot read WireGuard config'}
 
-        config = result['stdout']
+class StatusCollector(threading.Thread):
+    """后台定时采集状态，没有页面访问时也能驱动快照回调（在线状态变化等）"""
 
-        # 检查是否是占位符配置
-        if 'placeholder' in config:
-            print("DEBUG: Found placeholder configuration")
-            return {'error': 'WireGuard not fully initialized yet'}
+    def __init__(self, interval):
+        super().__init__(daemon=True, name='status-collector')
+        self.interval = interval
 
-        # 解析配置
-        server_info = {
-            'interface': WG_INTERFACE,
-            'address': re.search(r'Address\s*=\s*([^\s]+)', config).group(1) if re.search(r'Address\s*=\s*([^\s]+)', config) else 'N/A',
-            'listen_port': re.search(r'ListenPort\s*=\s*(\d+)', config).group(1) if re.search(r'ListenPort\s*=\s*(\d+)', config) else 'N/A',
-        }
+    def run(self):
+        while True:
+            try:
+                get_status_snapshot(max_age=self.interval / 2)
+            except Exception as e:
+                print(f"Status collector: {e}")
+            time.sleep(self.interval)
 
-        # 获取公网 IP (这个命令需要shell来处理管道和命令替换)
-        public_ip_cmd = run_command(
-            "ip addr show $(ip route | grep default | awk '{print $5}' | head -n1) | grep 'inet ' | awk '{print $2}' | cut -d/ -f1 | head -n1",
-            use_sudo=False,
-            shell=True
-        )
-        server_info['public_ip'] = public_ip_cmd['stdout'].strip() if public_ip_cmd['success'] else 'N/A'
 
-        # 获取服务状态
-        status_cmd = run_command(['wg', 'show', WG_INTERFACE], use_sudo=False)
-        server_info['status'] = 'active' if status_cmd['success'] else 'inactive'
+# ==================== 在线状态跟踪 ====================
 
-        print(f"DEBUG: Successfully read config, server_info: {server_info}")
-        return server_info
-    except Exception as e:
-        print(f"DEBUG: Exception in get_server_info: {e}")
-        return {'error': str(e)}
+# 后台采集间隔（秒）
+PRESENCE_INTERVAL = float(os.environ.get('PRESENCE_INTERVAL', '30'))
+# 上线/下线事件日志
+EVENTS_FILE = f"{WG_DIR}/events.jsonl"
+# 内存中保留的最近事件数量（更早的从日志文件读取）
+EVENTS_MEMORY = int(os.environ.get('EVENTS_MEMORY', '1000'))
+# 持久化的最后握手时间精度（秒），只在推进超过该值时写状态文件
+ACTIVITY_RESOLUTION = 3600
 
 
-def _parse_peer_data(peer_data, wg_output, traffic_data):
+class PresenceTracker:
     """
-    解析单个peer块的数据（包括前置注释）
+    客户端在线状态跟踪
 
-    Args:
-        peer_data: 包含注释和peer内容的完整文本块
-        wg_output: wg show命令的输出，用于获取连接状态
-        traffic_data: 流量数据字典（会被修改）
+    每次采集后按握手时间和 ONLINE_THRESHOLD 判定在线状态，只在状态变化时
+    向 events.jsonl 追加事件：上线（connect）和下线（disconnect，附会话时长和流量）。
+    未结束的会话保存在 presence.json 中，重启后继续跟踪。
 
-    Returns:
-        dict: 客户端信息字典，如果解析失败返回None
-    """
-    # 提取客户端名称（从注释中）- 只使用精确匹配
-    name_match = None
-
-    # 1. 标准中文格式：# 客户端: name 或 # 客户端： name
-    name_match = re.search(r'#\s*客户端[：:]\s*(\S+)', peer_data)
-
-    # 2. 英文格式：# Client: name
-    if not name_match:
-        name_match = re.search(r'#\s*[Cc]lient\s*[：:]\s*(\S+)', peer_data)
-
-    # 3. 简化格式：# name （但要确保不是关键词）
-    if not name_match:
-        simple_match = re.search(r'#\s*([a-zA-Z0-9_-]+)\s*$', peer_data, re.MULTILINE)
-        if simple_match:
-            candidate_name = simple_match.group(1)
-            # 排除明显的关键词，避免误匹配
-            excluded_words = ['Peer', 'peer', 'PublicKey', 'AllowedIPs', 'Endpoint', 'PersistentKeepalive']
-            if candidate_name not in excluded_words and len(candidate_name) > 1:
-                name_match = simple_match
-
-    # 提取公钥
-    pubkey_match = re.search(r'PublicKey\s*=\s*([^\s]+)', peer_data)
-    if not pubkey_match:
-        return None  # 无效的peer块
-    pubkey = pubkey_match.group(1)
-
-    # 对于真正无法识别的客户端，使用公钥后8位作为标识
-    if name_match:
-        name = name_match.group(1)
-    else:
-        # 使用URL安全的公钥后缀，去除特殊字符
-        safe_suffix = pubkey.replace('+', '').replace('=', '').replace('/', '')[-8:]
-        name = f'Unknown-{safe_suffix}'
-
-    # 提取 IP
-    ip_match = re.search(r'AllowedIPs\s*=\s*([^\s]+)', peer_data)
-    ip = ip_match.group(1).replace('/32', '') if ip_match else 'N/A'
-
-    # 从 wg show 中获取连接状态
-    peer_pattern = f'peer: {re.escape(pubkey)}(.*?)(?=peer:|$)'
-    peer_info = re.search(peer_pattern, wg_output, re.DOTALL)
-
-    status = 'offline'
-    last_handshake = 'Never'
-    transfer_rx = '0 B'
-    transfer_tx = '0 B'
-
-    if peer_info:
-        peer_data_status = peer_info.group(1)
-
-        # 检查最后握手时间
-        handshake_match = re.search(r'latest handshake:\s*(.+)', peer_data_status)
-        if handshake_match:
-            last_handshake = handshake_match.group(1).strip()
-            status = 'online' if 'second' in last_handshake or 'minute' in last_handshake else 'offline'
-
-        # 传输数据
-        rx_match = re.search(r'transfer:\s*([\d.]+\s+\w+)\s+received', peer_data_status)
-        tx_match = re.search(r'received,\s*([\d.]+\s+\w+)\s+sent', peer_data_status)
-        if rx_match:
-            transfer_rx = rx_match.group(1)
-        if tx_match:
-            transfer_tx = tx_match.group(1)
-
-    # 流量持久化和累计计算
-    # 注意：traffic_data 作为参数传入，不再在这里加载
-
-    # 解析当前流量为字节数
-    current_rx_bytes = parse_transfer_size(transfer_rx)
-    current_tx_bytes = parse_transfer_size(transfer_tx)
-
-    # 获取或初始化该客户端的流量记录
-    if name not in traffic_data:
-        traffic_data[name] = {
-            'accumulated_rx': 0,
-            'accumulated_tx': 0,
-            'last_rx': 0,
-            'last_tx': 0,
-            'last_update': datetime.now().isoformat()
-        }
+    同时记录每个 peer 的首次出现时间和最后握手时间（按小时精度持久化），
+    接口重启后运行时握手时间归零也不会丢失，供过期客户端清理使用。
+    """
 
-    client_traffic = traffic_data[name]
+    def __init__(self, events_path, state_path):
+        self.events_path = events_path
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._sessions = None   # {(接口, 公钥): 会话信息}
+        self._activity = {}     # {(接口, 公钥): [首次出现时间, 最后握手时间]}
+        self._recent = deque(maxlen=EVENTS_MEMORY)
+        self.last_seq = 0
+        self.listeners = []     # 新事件回调（参数为事件列表）
+
+    def _ensure_loaded(self):
+        if self._sessions is not None:
+            return
+        state = {}
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self._sessions = {(s['interface'], s['public_key']): s for s in state.get('sessions', [])}
+        self._activity = {(iface, public_key): [first_seen, last_handshake]
+                          for iface, public_key, first_seen, last_handshake in state.get('activity', [])}
+        self.last_seq = state.get('last_seq', 0)
+        # 日志比状态文件新（写完事件后进程退出）时以日志为准
+        for event in self._read_events(self.last_seq):
+            self.last_seq = event['seq']
+            self._recent.append(event)
+
+    def _read_events(self, since):
+        try:
+            with open(self.events_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event['seq'] > since:
+                        yield event
+        except (OSError, ValueError):
+            return
+
+    def _save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'last_seq': self.last_seq,
+                'sessions': list(self._sessions.values()),
+                'activity': [[iface, public_key, first_seen, last_handshake]
+                             for (iface, public_key), (first_seen, last_handshake) in self._activity.items()]
+            }, f)
+        os.replace(temp_path, self.state_path)
+
+    def _emit(self, events, event):
+        self.last_seq += 1
+        event['seq'] = self.last_seq
+        events.append(event)
+
+    def observe(self, snapshot):
+        """快照回调：比较本次和上次的在线状态，记录变化"""
+        now = int(snapshot.generated_at)
+        with self._lock:
+            self._ensure_loaded()
+            events = []
+            seen = set()
+            dirty = False
+            for client in snapshot.clients:
+                key = (client.interface, client.public_key)
+                seen.add(key)
+                activity = self._activity.get(key)
+                if activity is None:
+                    self._activity[key] = [now, client.handshake]
+                    dirty = True
+                elif client.handshake - activity[1] >= ACTIVITY_RESOLUTION:
+                    activity[1] = client.handshake
+                    dirty = True
+                session = self._sessions.get(key)
+                online = client.is_online(now)
+                if online and session is None:
+                    session = self._sessions[key] = {
+                        'interface': client.interface,
+                        'public_key': client.public_key,
+                        'name': client.name,
+                        'connected_at': client.handshake,
+                        'last_handshake': client.handshake,
+                        'rx_start': client.total_rx,
+                        'tx_start': client.total_tx,
+                        'rx_last': client.total_rx,
+                        'tx_last': client.total_tx
+                    }
+                    self._emit(events, {
+                        'type': 'connect', 'ts': client.handshake,
+                        'name': client.name, 'interface': client.interface, 'public_key': client.public_key
+                    })
+                elif online:
+                    session['last_handshake'] = client.handshake
+                    session['rx_last'] = client.total_rx
+                    session['tx_last'] = client.total_tx
+                elif session is not None:
+                    self._close(events, key, now, client.handshake or session['last_handshake'],
+                                client.total_rx, client.total_tx, 'timeout')
+
+            # 已从配置中删除的客户端
+            for key in [key for key in self._sessions if key not in seen]:
+                session = self._sessions[key]
+                self._close(events, key, now, session['last_handshake'],
+                            session['rx_last'], session['tx_last'], 'removed')
+            for key in [key for key in self._activity if key not in seen]:
+                del self._activity[key]
+                dirty = True
+
+            if events:
+                with open(self.events_path, 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event, ensure_ascii=False) + '\n')
+                self._recent.extend(events)
+            if events or dirty:
+                self._save_state()
+
+        for listener in self.listeners:
+            if events:
+                listener(events)
+
+    def _close(self, events, key, now, last_handshake, total_rx, total_tx, reason):
+        session = self._sessions.pop(key)
+        self._emit(events, {
+            'type': 'disconnect', 'ts': now, 'reason': reason,
+            'name': session['name'], 'interface': session['interface'], 'public_key': session['public_key'],
+            'connected_at': session['connected_at'],
+            'last_handshake': last_handshake,
+            'duration': max(0, last_handshake - session['connected_at']),
+            'rx_bytes': max(0, total_rx - session['rx_start']),
+            'tx_bytes': max(0, total_tx - session['tx_start'])
+        })
 
-    # 检测流量重置（当前流量小于上次记录的流量）
-    # 这通常发生在系统重启或 WireGuard 接口重启时
-    if current_rx_bytes < client_traffic['last_rx']:
-        # 发生重置，将上次的流量值累加到累计值中
-        client_traffic['accumulated_rx'] += client_traffic['last_rx']
+    def events_since(self, since, limit=500):
+        """返回序号大于 since 的事件（按序号升序，最多 limit 条）"""
+        with self._lock:
+            self._ensure_loaded()
+            recent = list(self._recent)
+            last_seq = self.last_seq
+        if recent and since >= recent[0]['seq'] - 1:
+            events = [e for e in recent if e['seq'] > since][:limit]
+        else:
+            # 超出内存窗口，从日志文件读取
+            events = []
+            for event in self._read_events(since):
+                events.append(event)
+                if len(events) >= limit:
+                    break
+        return {'events': events, 'last_seq': last_seq}
+
+    def online_sessions(self):
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._sessions.values())
+
+    def activity(self):
+        """返回 {(接口, 公钥): (首次出现时间, 最后握手时间)}"""
+        with self._lock:
+            self._ensure_loaded()
+            return {key: tuple(value) for key, value in self._activity.items()}
+
+
+presence = PresenceTracker(EVENTS_FILE, f"{WG_DIR}/presence.json")
+register_snapshot_hook(presence.observe)
+
+
+# ==================== Webhook 通知 ====================
+
+# 接收地址（逗号分隔），留空关闭
+WEBHOOK_URLS = [u.strip() for u in os.environ.get('WEBHOOK_URLS', '').split(',') if u.strip()]
+# 签名密钥：设置后请求带 X-WGM-Signature: sha256=<HMAC-SHA256(body)>
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_DIR = f"{WG_DIR}/webhooks"
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '200'))       # 单次投递最多事件数
+WEBHOOK_BATCH_WINDOW = float(os.environ.get('WEBHOOK_BATCH_WINDOW', '2'))   # 收到事件后等待合并的秒数
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))               # 并发投递线程数
+WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', '10'))
+WEBHOOK_RETRY_MAX = float(os.environ.get('WEBHOOK_RETRY_MAX', '300'))       # 重试间隔上限（秒）
+WEBHOOK_QUEUE_MAX = int(os.environ.get('WEBHOOK_QUEUE_MAX', '100000'))      # 队列上限，超出丢弃最旧事件
+
+
+class WebhookDispatcher:
+    """
+    Webhook 批量投递
 
-    if current_tx_bytes < client_traffic['last_tx']:
-        # 发生重置，将上次的流量值累加到累计值中
-        client_traffic['accumulated_tx'] += client_traffic['last_tx']
+    事件先追加到磁盘队列（queue.jsonl，带序号），由后台线程按接收地址分批投递，
+    请求处理线程只做一次文件追加。每个地址记录已确认的序号（state.json），
+    同一时间只有一批在途，失败按指数退避重试，重启后从确认位置继续。
+    同一批次中带相同 key 的事件（如流量超限）只保留最后一条。
+    """
 
-    # 计算总流量（累计 + 当前）
-    total_rx_bytes = client_traffic['accumulated_rx'] + current_rx_bytes
-    total_tx_bytes = client_traffic['accumulated_tx'] + current_tx_bytes
-    total_bytes = total_rx_bytes + total_tx_bytes
+    def __init__(self, urls, directory):
+        self.urls = urls
+        self.directory = directory
+        self.queue_path = os.path.join(directory, 'queue.jsonl')
+        self.state_path = os.path.join(directory, 'state.json')
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._events = []      # 尚未被所有地址确认的事件
+        self._file_lines = 0   # 队列文件行数（用于判断何时压缩）
+        self._unsynced = False
+        self.last_seq = 0
+        self._targets = {url: {'acked': 0, 'attempts': 0, 'next_try': 0.0, 'in_flight': False,
+                               'delivered': 0, 'last_error': None} for url in urls}
+        self._pool = None
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.urls)
+
+    def _load(self):
+        """
+        读取各地址的确认位置和未确认的事件
 
-    # 更新记录
-    client_traffic['last_rx'] = current_rx_bytes
-    client_traffic['last_tx'] = current_tx_bytes
-    client_traffic['last_update'] = datetime.now().isoformat()
+        state.json 里没有的地址是新配置的：从队列中最新的序号开始，只接收之后的事件，
+        并立即写入 state.json，之后重启不会再按全局序号重新推算。
+        没有 state.json（首次启动或状态丢失）时所有地址从头投递队列中的事件。
+        """
+        state = None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.last_seq = (state or {}).get('last_seq', 0)
 
-    # 更新 traffic_data（引用传递，会修改外部的字典）
-    traffic_data[name] = client_traffic
+        events = []
+        try:
+            with open(self.queue_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    self._file_lines += 1
+                    event = json.loads(line)
+                    self.last_seq = max(self.last_seq, event['seq'])
+                    events.append(event)
+        except (OSError, ValueError):
+            pass
+
+        acked = (state or {}).get('acked', {})
+        added = [url for url in self._targets if url not in acked]
+        for url, target in self._targets.items():
+            target['acked'] = acked[url] if url in acked else (self.last_seq if state is not None else 0)
+        floor = min(t['acked'] for t in self._targets.values())
+        self._events = [e for e in events if e['seq'] > floor]
+        if added:
+            self._save_state()
+
+    def _save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'last_seq': self.last_seq,
+                       'acked': {url: t['acked'] for url, t in self._targets.items()}}, f)
+        os.replace(temp_path, self.state_path)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._load()
+        self._pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='webhook')
+        self._thread = threading.Thread(target=self._run, daemon=True, name='webhook-dispatcher')
+        self._thread.start()
+        self._wake.set()
+
+    def publish(self, event_type, data, key=None):
+        self.publish_many([(event_type, data, key)])
+
+    def publish_many(self, items):
+        """
+        追加事件到队列并唤醒投递线程（未配置接收地址或未启动时忽略）
 
-    # 格式化总流量（使用十进制单位）
-    transfer_total = format_bytes(total_bytes)
+        Args:
+            items: [(事件类型, 事件数据, 合并 key 或 None)] 列表
+        """
+        if self._thread is None or not items:
+            return
+        now = int(time.time())
+        with self._lock:
+            events = []
+            for event_type, data, key in items:
+                self.last_seq += 1
+                event = {'seq': self.last_seq, 'type': event_type, 'ts': now, 'node': NODE_NAME, 'data': data}
+                if key:
+                    event['key'] = key
+                events.append(event)
+            with open(self.queue_path, 'a') as f:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self._events.extend(events)
+            self._file_lines += len(events)
+            self._unsynced = True
+
+            if len(self._events) > WEBHOOK_QUEUE_MAX:
+                dropped = len(self._events) - WEBHOOK_QUEUE_MAX
+                floor = self._events[dropped - 1]['seq']
+                print(f"Webhook queue full, dropping {dropped} oldest events")
+                for target in self._targets.values():
+                    target['acked'] = max(target['acked'], floor)
+                self._compact()
+        self._wake.set()
+
+    def _compact(self):
+        """丢弃所有地址都已确认的事件，文件中已确认的行过多时重写队列文件（需持有锁）"""
+        floor = min(t['acked'] for t in self._targets.values())
+        if self._events and self._events[0]['seq'] <= floor:
+            self._events = [e for e in self._events if e['seq'] > floor]
+        if self._file_lines > 2 * len(self._events) + 1000:
+            temp_path = self.queue_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for event in self._events:
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.queue_path)
+            self._file_lines = len(self._events)
+        self._save_state()
 
-    return {
-        'name': name,
-        'public_key': pubkey,
-        'ip': ip,
-        'status': status,
-        'last_handshake': last_handshake,
-        'transfer_rx': transfer_rx,
-        'transfer_tx': transfer_tx,
-        'transfer_total': transfer_total
-    }
+    @staticmethod
+    def _coalesce(batch):
+        """同一批次中相同 key 的事件只保留最后一条"""
+        last = {}
+        for i, event in enumerate(batch):
+            if 'key' in event:
+                last[event['key']] = i
+        return [e for i, e in enumerate(batch) if 'key' not in e or last[e['key']] == i]
+
+    def _run(self):
+        wait = None
+        while True:
+            self._wake.wait(wait)
+            self._wake.clear()
+            if WEBHOOK_BATCH_WINDOW > 0:
+                # 突发事件（如接口重启导致大量 peer 下线）合并成少数几批
+                time.sleep(WEBHOOK_BATCH_WINDOW)
+
+            with self._lock:
+                if self._unsynced:
+                    # 批量落盘后再投递
+                    with open(self.queue_path, 'a') as f:
+                        os.fsync(f.fileno())
+                    self._unsynced = False
+
+                now = time.monotonic()
+                wait = None
+                for url, target in self._targets.items():
+                    if target['in_flight']:
+                        continue
+                    if not self._events or self._events[-1]['seq'] <= target['acked']:
+                        continue
+                    if target['next_try'] > now:
+                        delay = target['next_try'] - now
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    batch = [e for e in self._events if e['seq'] > target['acked']][:WEBHOOK_BATCH_SIZE]
+                    target['in_flight'] = True
+                    self._pool.submit(self._deliver, url, batch)
+
+    def _deliver(self, url, batch):
+        payload = self._coalesce(batch)
+        body = json.dumps({'node': NODE_NAME, 'events': payload}, ensure_ascii=False).encode()
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'wireguard-manager'}
+        if WEBHOOK_SECRET:
+            signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+            headers['X-WGM-Signature'] = f'sha256={signature}'
+
+        error = None
+        try:
+            req = urllib.request.Request(url, data=body, headers=headers, method='POST')
+            with urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT) as response:
+                response.read()
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+
+        with self._lock:
+            target = self._targets[url]
+            target['in_flight'] = False
+            if error is None:
+                target['acked'] = batch[-1]['seq']
+                target['attempts'] = 0
+                target['delivered'] += len(payload)
+                target['last_error'] = None
+                self._compact()
+            else:
+                target['attempts'] += 1
+                target['last_error'] = error
+                delay = min(WEBHOOK_RETRY_MAX, 2 ** target['attempts'])
+                target['next_try'] = time.monotonic() + delay * random.uniform(0.5, 1.0)
+                print(f"Webhook delivery to {url} failed ({error}), retry #{target['attempts']}")
+        self._wake.set()
+
+    def status(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'last_seq': self.last_seq,
+                'pending': len(self._events),
+                'targets': [{
+                    'url': url,
+                    'acked_seq': t['acked'],
+                    'pending': sum(1 for e in self._events if e['seq'] > t['acked']),
+                    'delivered': t['delivered'],
+                    'attempts': t['attempts'],
+                    'last_error': t['last_error']
+                } for url, t in self._targets.items()]
+            }
 
 
-def get_clients():
-    """获取所有客户端信息"""
-    try:
-        # 检查配置文件是否存在
-        if not os.path.exists(WG_CONF):
-            return []
+webhooks = WebhookDispatcher(WEBHOOK_URLS, WEBHOOK_DIR)
 
-        # 读取配置文件
-        result = run_command(['cat', WG_CONF], use_sudo=False)
-        if not result['success']:
-            # 尝试使用 sudo 读取
-            result = run_command(['cat', WG_CONF])
-            if not result['success']:
-                return []
 
-        config = result['stdout']
+def _publish_presence_events(events):
+    webhooks.publish_many([(f"peer.{e['type']}", e, None) for e in events])
 
-        # 检查是否是占位符配置
-        if 'placeholder' in config:
-            return []
 
-        # 获取 wg show 输出（包含连接状态）
-        wg_show = run_command(['wg', 'show', WG_INTERFACE], use_sudo=False)
-        wg_output = wg_show['stdout'] if wg_show['success'] else ''
+presence.listeners.append(_publish_presence_events)
 
-        # 加载流量数据（整个函数只加载一次）
-        traffic_data = load_traffic_data()
 
-        clients = []
-
-        # 使用状态机方法解析配置，正确捕获 [Peer] 之前的注释
-        lines = config.split('\n')
-        in_interface = False
-        in_peer = False
-        peer_comment_lines = []  # 当前peer前的注释行
-        peer_content_lines = []  # 当前peer块的内容行
-
-        for line in lines:
-            stripped = line.strip()
-
-            # 检测 [Interface]
-            if stripped == '[Interface]':
-                in_interface = True
-                in_peer = False
-
-            # 检测 [Peer]
-            elif stripped == '[Peer]':
-                # 保存之前的peer（如果存在）
-                if in_peer and peer_content_lines:
-                    # 处理上一个peer
-                    peer_data = '\n'.join(peer_comment_lines + peer_content_lines)
-                    client = _parse_peer_data(peer_data, wg_output, traffic_data)
-                    if client:
-                        clients.append(client)
-                    # 重置注释列表，防止注释被关联到错误的peer
-                    peer_comment_lines = []
-
-                # 开始新的peer块
-                in_interface = False
-                in_peer = True
-                peer_content_lines = [line]
-                # peer_comment_lines 已经包含了之前收集的注释
-
-            # 在interface块中
-            elif in_interface:
-                # 检查是否是 Peer 的注释（用于识别客户端名称）
-                if stripped.startswith('#'):
-                    # 检查是否是客户端注释格式
-                    if (re.search(r'#\s*客户端[：:]', stripped) or
-                        re.search(r'#\s*[Cc]lient\s*:', stripped) or
-                        (re.search(r'^#\s*[a-zA-Z0-9_-]+\s*$', stripped) and
-                         not any(keyword in stripped for keyword in ['服务端', '监听', '启动', '关闭', 'Interface', 'Server']))):
-                        # 这是一个 Peer 的注释，结束 Interface 块
-                        in_interface = False
-                        peer_comment_lines.append(line)
-                    # 否则忽略（Interface 块内的注释）
-                else:
-                    pass  # 忽略 Interface 块的其他内容
-
-            # 在peer块中
-            elif in_peer:
-                # 检查是否是下一个 Peer 的注释
-                if stripped.startswith('#'):
-                    # 检查是否是客户端注释格式
-                    if (re.search(r'#\s*客户端[：:]', stripped) or
-                        re.search(r'#\s*[Cc]lient\s*:', stripped) or
-                        (re.search(r'^#\s*[a-zA-Z0-9_-]+\s*$', stripped) and
-                         not any(keyword in stripped for keyword in ['服务端', '监听', '启动', '关闭', 'Interface', 'Server']))):
-                        # 这是下一个 Peer 的注释，结束当前 peer
-                        if peer_content_lines:
-                            # 处理当前peer
-                            peer_data = '\n'.join(peer_comment_lines + peer_content_lines)
-                            client = _parse_peer_data(peer_data, wg_output, traffic_data)
-                            if client:
-                                clients.append(client)
-
-                        # 开始收集新的注释
-                        in_peer = False
-                        peer_comment_lines = [line]
-                        peer_content_lines = []
-                    else:
-                        # peer 内部的注释，添加到内容中
-                        peer_content_lines.append(line)
-                else:
-                    # peer 的配置行
-                    peer_content_lines.append(line)
+# ==================== 审计日志 ====================
 
-            # 不在任何section中（可能是peer的注释或空行）
-            else:
-                if stripped.startswith('#'):
-                    # 这是注释行，可能是下一个peer的注释
-                    peer_comment_lines.append(line)
-                elif not stripped:
-                    # 空行
-                    if peer_comment_lines:
-                        # 如果之前有注释，这个空行属于注释部分
-                        peer_comment_lines.append(line)
-                # 其他行忽略
-
-        # 处理最后一个peer块（如果存在）
-        if in_peer and peer_content_lines:
-            peer_data = '\n'.join(peer_comment_lines + peer_content_lines)
-            client = _parse_peer_data(peer_data, wg_output, traffic_data)
-            if client:
-                clients.append(client)
+AUDIT_DIR = f"{WG_DIR}/audit"
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', '1'))              # 缓冲写入的最长延迟（秒），每批一次 fsync
+AUDIT_SEGMENT_BYTES = int(os.environ.get('AUDIT_SEGMENT_BYTES', str(16 * 1024 * 1024)))  # 单个日志文件的大小上限
+AUDIT_KEEP_SEGMENTS = int(os.environ.get('AUDIT_KEEP_SEGMENTS', '32'))                 # 保留的日志文件数
+AUDIT_INDEX_STRIDE = 64                                                                # 时间索引每隔多少条记录一个位置
+AUDIT_BATCH = 256                                                                      # 缓冲达到该条数时立即写入
 
-        # 检测重复的公钥
-        pubkey_count = {}
-        for client in clients:
-            pubkey = client['public_key']
-            if pubkey in pubkey_count:
-                pubkey_count[pubkey] += 1
-            else:
-                pubkey_count[pubkey] = 1
-
-        # 标记重复的客户端
-        for client in clients:
-            pubkey = client['public_key']
-            if pubkey_count[pubkey] > 1:
-                client['is_duplicate'] = True
-                client['duplicate_warning'] = f'⚠️ 此公钥有{pubkey_count[pubkey]}个重复'
-            else:
-                client['is_duplicate'] = False
 
-        # 保存流量数据（整个函数只保存一次）
-        save_traffic_data(traffic_data)
+def _audit_actor():
+    """当前操作者：登录用户名、token:<令牌名>，后台任务为 system"""
+    if not has_request_context():
+        return 'system', None
+    token = g.get('api_token')
+    if token:
+        return f"token:{token['name']}", request.remote_addr
+    if current_user.is_authenticated:
+        return current_user.username, request.remote_addr
+    return 'anonymous', request.remote_addr
 
-        return clients
-    except Exception as e:
-        return []
+
+class AuditLog:
+    """
+    只追加的结构化审计日志
+
+    每条记录一行 JSON：seq、ts、actor、ip、op、interface、peers（名称）、public_keys、
+    before/after（操作前后接口配置文件的 SHA-256 前 16 位）和 detail。
+    record() 只放入内存缓冲，后台线程每 AUDIT_FLUSH_INTERVAL 秒（或满 AUDIT_BATCH 条）
+    一次写入并 fsync。日志按大小分段为 audit-<首条序号>.jsonl，写满的段旁边保存索引
+    （.idx：时间稀疏索引 + 名称/公钥到行偏移的索引），只保留最近 AUDIT_KEEP_SEGMENTS 段。
+    查询按时间跳过整段并用稀疏索引定位，按客户端查询直接读取索引中的行。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()      # 缓冲和序号
+        self._io_lock = threading.Lock()   # 文件和索引
+        self._buffer = []
+        self._segments = None              # 按序号升序的段信息，最后一段为当前写入段
+        self.last_seq = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+    # ---------- 段和索引 ----------
+
+    @staticmethod
+    def _new_segment(path, first_seq):
+        return {'path': path, 'first_seq': first_seq, 'last_seq': first_seq - 1, 'first_ts': None,
+                'last_ts': None, 'size': 0, 'count': 0, 'sparse': [], 'peers': {}}
+
+    @staticmethod
+    def _index_entry(segment, entry, offset, size):
+        if segment['count'] % AUDIT_INDEX_STRIDE == 0:
+            segment['sparse'].append([entry['ts'], offset])
+        for key in set(entry.get('peers', ())) | set(entry.get('public_keys', ())):
+            segment['peers'].setdefault(key, []).append(offset)
+        if segment['first_ts'] is None:
+            segment['first_ts'] = entry['ts']
+        segment['last_ts'] = entry['ts']
+        segment['last_seq'] = entry['seq']
+        segment['count'] += 1
+        segment['size'] = offset + size
+
+    def _scan_segment(self, path, first_seq):
+        segment = self._new_segment(path, first_seq)
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break   # 写入中断的半行，之后从这里覆盖
+                try:
+                    self._index_entry(segment, json.loads(line), offset, len(line))
+                except ValueError:
+                    pass
+                offset += len(line)
+        return segment
+
+    def _ensure_loaded(self):
+        if self._segments is not None:
+            return
+        self._segments = []
+        try:
+            names = sorted(name for name in os.listdir(self.directory)
+                           if re.fullmatch(r'audit-\d+\.jsonl', name))
+        except OSError:
+            names = []
+        for i, name in enumerate(names):
+            path = os.path.join(self.directory, name)
+            segment = None
+            if i < len(names) - 1:
+                try:
+                    with open(path[:-len('.jsonl')] + '.idx') as f:
+                        segment = dict(json.load(f), path=path)
+                except (OSError, ValueError):
+                    pass
+            if segment is None:
+                segment = self._scan_segment(path, int(name[6:-6]))
+            self._segments.append(segment)
+        if self._segments:
+            self.last_seq = self._segments[-1]['last_seq']
+
+    def _seal(self, segment):
+        """写满的段：保存索引，之后启动时不必重新扫描"""
+        index_path = segment['path'][:-len('.jsonl')] + '.idx'
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({key: value for key, value in segment.items() if key != 'path'}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def _prune(self):
+        while len(self._segments) > max(1, AUDIT_KEEP_SEGMENTS):
+            segment = self._segments.pop(0)
+            for path in (segment['path'], segment['path'][:-len('.jsonl')] + '.idx'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    # ---------- 写入 ----------
+
+    def snapshot(self, ifaces=None):
+        """操作前调用：各接口配置文件的哈希 {接口名: 哈希}，传给 record(before=...)"""
+        hashes = {}
+        for iface in ifaces if ifaces is not None else INTERFACES.values():
+            text = iface.read_config()
+            hashes[iface.name] = hashlib.sha256(text.encode()).hexdigest()[:16] if text is not None else None
+        return hashes
+
+    def record(self, op, interface=None, peers=(), public_keys=(), before=None, actor=None, **detail):
+        """
+        追加一条审计记录（只写入内存缓冲，不阻塞调用方）
+
+        Args:
+            interface: 修改的接口，配合 before 记录操作前后的配置哈希
+            before: 操作前 snapshot() 的结果
+            actor: 操作者，默认取当前请求的登录用户/API 令牌，后台任务为 system
+        """
+        who, ip = _audit_actor()
+        entry = {'ts': round(time.time(), 3), 'actor': actor or who, 'op': op}
+        if ip:
+            entry['ip'] = ip
+        if interface:
+            entry['interface'] = interface
+        if peers:
+            entry['peers'] = list(peers)
+        if public_keys:
+            entry['public_keys'] = [key for key in public_keys if key]
+        if before is not None and interface in before:
+            iface = get_interface(interface)
+            entry['before'] = before[interface]
+            entry['after'] = self.snapshot([iface])[interface] if iface else None
+        if detail:
+            entry['detail'] = detail
+
+        with self._lock:
+            self._ensure_loaded()
+            self.last_seq += 1
+            entry['seq'] = self.last_seq
+            self._buffer.append(entry)
+            full = len(self._buffer) >= AUDIT_BATCH
+        self._start()
+        if full:
+            self._wake.set()
+        return entry['seq']
+
+    def flush(self):
+        """
+        把缓冲中的记录写入当前段（一次 write + fsync），写满时切换到新段
+
+        段大小和索引只在写入成功后更新；写入失败时未写入的记录放回缓冲开头，下次重试
+        """
+        with self._io_lock:
+            with self._lock:
+                self._ensure_loaded()
+                entries, self._buffer = self._buffer, []
+            i = 0
+            try:
+                if entries:
+                    os.makedirs(self.directory, exist_ok=True)
+                while i < len(entries):
+                    segment = self._segments[-1] if self._segments else None
+                    new_segment = segment is None or segment['size'] >= AUDIT_SEGMENT_BYTES
+                    if new_segment:
+                        first_seq = entries[i]['seq']
+                        segment = self._new_segment(
+                            os.path.join(self.directory, f'audit-{first_seq:012d}.jsonl'), first_seq)
+                    pending = []
+                    start = offset = segment['size']
+                    while i + len(pending) < len(entries) and offset < AUDIT_SEGMENT_BYTES:
+                        entry = entries[i + len(pending)]
+                        line = (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode()
+                        pending.append((entry, offset, line))
+                        offset += len(line)
+                    self._write_at(segment['path'], start, b''.join(line for _, _, line in pending))
+
+                    if new_segment:
+                        if self._segments:
+                            self._seal(self._segments[-1])
+                        self._segments.append(segment)
+                        self._prune()
+                    for entry, entry_offset, line in pending:
+                        self._index_entry(segment, entry, entry_offset, len(line))
+                    i += len(pending)
+            except BaseException:
+                with self._lock:
+                    self._buffer = entries[i:] + self._buffer
+                raise
+
+    @staticmethod
+    def _write_at(path, start, data):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            # 从已确认的末尾写入，覆盖上次中断时可能残留的半行
+            os.lseek(fd, start, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.ftruncate(fd, start + len(data))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name='audit-writer')
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(AUDIT_FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Audit log: write failed: {e}")
+
+    # ---------- 查询 ----------
+
+    def query(self, peer=None, since=None, until=None, op=None, after_seq=0, limit=500):
+        """
+        按时间/客户端查询（序号升序）
+
+        Args:
+            peer: 客户端名称或公钥
+            since, until: epoch 秒（含两端）
+            op: 操作类型，以 . 结尾时按前缀匹配（如 client.）
+            after_seq: 只返回序号大于它的记录（翻页）
+
+        Returns:
+            tuple: (记录列表, 是否还有更多)
+        """
+        self.flush()
+        result = []
+        with self._io_lock:
+            segments = list(self._segments or [])
+        for segment in segments:
+            if segment['last_seq'] <= after_seq or (since is not None and (segment['last_ts'] or 0) < since):
+                continue
+            if until is not None and segment['first_ts'] is not None and segment['first_ts'] > until:
+                break
+            try:
+                f = open(segment['path'], 'rb')
+            except OSError:
+                continue
+            with f:
+                if peer is not None:
+                    lines = self._lines_at(f, segment['peers'].get(peer, ()))
+                else:
+                    start = 0
+                    if since is not None:
+                        i = bisect.bisect_left([ts for ts, _ in segment['sparse']], since) - 1
+                        start = segment['sparse'][i][1] if i >= 0 else 0
+                    f.seek(start)
+                    lines = iter(f.readline, b'')
+                for line in lines:
+                    if not line.endswith(b'\n'):
+                        break
+                    entry = json.loads(line)
+                    if entry['seq'] <= after_seq or (since is not None and entry['ts'] < since):
+                        continue
+                    if until is not None and entry['ts'] > until:
+                        break
+                    if op and not (entry['op'].startswith(op) if op.endswith('.') else entry['op'] == op):
+                        continue
+                    if len(result) >= limit:
+                        return result, True
+                    result.append(entry)
+        return result, False
+
+    @staticmethod
+    def _lines_at(f, offsets):
+        for offset in offsets:
+            f.seek(offset)
+            yield f.readline()
+
+
+audit = AuditLog(AUDIT_DIR)
 
 
-def generate_qrcode(config_text):
-    """生成二维码"""
+@app.route('/api/audit')
+@login_required
+def api_audit():
+    """审计日志：?peer=名称或公钥&since=&until=（epoch 秒）&op=client.&after=<seq>&limit=500"""
     try:
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as f:
-            f.write(config_text)
-            temp_file = f.name
+        since = float(request.args['since']) if request.args.get('since') else None
+        until = float(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since / until 必须是 epoch 秒'}), 400
+    limit = max(1, min(request.args.get('limit', default=500, type=int), 5000))
+    entries, more = audit.query(request.args.get('peer') or None, since, until, request.args.get('op') or None,
+                                request.args.get('after', default=0, type=int), limit)
+    return jsonify({'success': True, 'entries': entries, 'more': more,
+                    'next_after': entries[-1]['seq'] if more else None})
 
-        # 生成二维码到临时文件 (需要shell进行输入重定向)
-        png_file = temp_file + '.png'
-        result = run_command(f'qrencode -o {png_file} < {temp_file}', shell=True)
 
-        if result['success'] and os.path.exists(png_file):
-            with open(png_file, 'rb') as f:
-                qr_data = base64.b64encode(f.read()).decode()
+# ==================== 流量配额 ====================
 
-            # 清理临时文件
-            os.unlink(temp_file)
-            os.unlink(png_file)
+QUOTAS_FILE = f"{WG_DIR}/quotas.json"
+QUOTA_STATE_FILE = f"{WG_DIR}/quota_state.json"
 
-            return qr_data
-        else:
-            if os.path.exists(temp_file):
-                os.unlink(temp_file)
+
+def _month_bounds(now):
+    """当前自然月的起止 epoch（本地时间）"""
+    current = datetime.fromtimestamp(now)
+    start = current.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+class QuotaEnforcer:
+    """
+    客户端流量配额
+
+    quotas.json 格式：
+        {"clients": {"alice": {"limit_gb": 100, "period": "monthly"}},
+         "groups": {"staff": {"limit_gb": 50, "period": "rolling", "window_days": 7,
+                              "members": ["bob", "carol"]}}}
+    客户端规则优先，其次是所属分组（配置中的 # 分组: 注释，或规则中的 members 列表）
+    的规则，对组内每个客户端分别计算。
+
+    只处理每次采集中计数有变化的客户端：更新用量后把剩余额度压入最小堆，
+    堆顶额度耗尽即暂停（wg set peer X remove，配置文件不变）；另一个按时间排序的堆
+    记录各客户端下一次周期切换（月初 / 滚动窗口的每日边界），到期时重算基线并恢复。
+    每次采集的开销与变化的客户端数量成正比。
+    """
+
+    def __init__(self, config_path, state_path):
+        self.config_path = config_path
+        self.state_path = state_path
+        self._lock = threading.RLock()
+        self._config = None
+        self._usage = {}       # {名称: {base, last_total, period_end, daily, interface, public_key}}
+        self._suspended = {}   # {名称: {interface, public_key, allowed_ips, since, used, limit}}
+        self._remaining = {}   # {名称: 剩余字节}（与堆中有效条目一致）
+        self._heap = []        # (剩余字节, 名称)，惰性删除
+        self._resets = []      # (周期切换时间, 名称)，惰性删除
+
+    # ---------- 配置和状态 ----------
+
+    def _ensure_loaded(self):
+        if self._config is not None:
+            return
+        try:
+            with open(self.config_path) as f:
+                self._config = json.load(f)
+        except (OSError, ValueError):
+            self._config = {}
+        self._config.setdefault('clients', {})
+        self._config.setdefault('groups', {})
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self._usage = state.get('usage', {})
+        self._suspended = state.get('suspended', {})
+        self._rebuild()
+
+    def _save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'usage': self._usage, 'suspended': self._suspended}, f)
+        os.replace(temp_path, self.state_path)
+
+    def _save_config(self):
+        temp_path = self.config_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._config, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.config_path)
+
+    def rule_for(self, name, group=None):
+        """返回客户端适用的配额规则（含 limit 字节数），没有时返回 None"""
+        rule = self._config['clients'].get(name)
+        if rule is None and group:
+            rule = self._config['groups'].get(group)
+        if rule is None:
+            for group_rule in self._config['groups'].values():
+                if name in group_rule.get('members', []):
+                    rule = group_rule
+                    break
+        if not rule:
             return None
-    except Exception as e:
-        return None
+        limit = rule.get('limit_bytes')
+        if limit is None and rule.get('limit_gb') is not None:
+            limit = int(float(rule['limit_gb']) * 1000**3)
+        if not limit:
+            return None
+        return {
+            'limit': int(limit),
+            'period': rule.get('period', 'monthly'),
+            'window_days': int(rule.get('window_days', 30))
+        }
+
+    def _rebuild(self):
+        """配置变化后按已记录的用量重建两个堆"""
+        self._heap = []
+        self._resets = []
+        self._remaining = {}
+        now = int(time.time())
+        for name, usage in list(self._usage.items()):
+            rule = self.rule_for(name, usage.get('group'))
+            if rule is None:
+                del self._usage[name]
+                continue
+            self._reset_period(name, usage, rule, now, force=False)
+            self._push(name, usage, rule)
+        for name in list(self._suspended):
+            if self.rule_for(name, self._usage.get(name, {}).get('group')) is None:
+                self._restore(name)
+
+    # ---------- 用量计算 ----------
+
+    def _reset_period(self, name, usage, rule, now, force):
+        """进入新周期（或滚动窗口跨天）时更新基线，并登记下一次切换时间"""
+        if rule['period'] == 'rolling':
+            today = now // 86400
+            daily = usage.setdefault('daily', {})
+            daily.setdefault(str(today), usage['last_total'])
+            first_day = today - rule['window_days'] + 1
+            for day in [d for d in daily if int(d) < first_day]:
+                del daily[day]
+            usage['base'] = daily[min(daily, key=int)]
+            usage['period_end'] = (today + 1) * 86400
+        elif force or now >= usage.get('period_end', 0):
+            _, end = _month_bounds(now)
+            if 'period_end' in usage:
+                usage['base'] = usage['last_total']
+            usage['period_end'] = end
+        heapq.heappush(self._resets, (usage['period_end'], name))
+
+    def _push(self, name, usage, rule):
+        remaining = rule['limit'] - (usage['last_total'] - usage['base'])
+        self._remaining[name] = remaining
+        heapq.heappush(self._heap, (remaining, name))
+        # 每次采集都会为有变化的客户端压入新条目，旧条目只在额度耗尽时弹出：
+        # 失效条目过多时按 _remaining 重建，堆大小保持在客户端数的两倍以内
+        if len(self._heap) > 2 * len(self._remaining):
+            self._heap = [(value, key) for key, value in self._remaining.items()]
+            heapq.heapify(self._heap)
+
+    def _account(self, client, now):
+        rule = self.rule_for(client.name, client.group)
+        if rule is None:
+            return
+        total = client.total_rx + client.total_tx
+        usage = self._usage.get(client.name)
+        if usage is None:
+            # 从开始跟踪时计算用量
+            usage = self._usage[client.name] = {'base': total, 'last_total': total}
+            self._reset_period(client.name, usage, rule, now, force=True)
+        usage['last_total'] = total
+        usage['group'] = client.group
+        usage['interface'] = client.interface
+        usage['public_key'] = client.public_key
+        self._push(client.name, usage, rule)
+
+    # ---------- 暂停和恢复 ----------
+
+    def _suspend(self, name, now):
+        usage = self._usage[name]
+        rule = self.rule_for(name, usage.get('group'))
+        iface = get_interface(usage.get('interface'))
+        if iface is None or name in self._suspended:
+            return False
+        used = usage['last_total'] - usage['base']
+        self._suspended[name] = {
+            'interface': iface.name,
+            'public_key': usage['public_key'],
+            'since': now,
+            'used': used,
+            'limit': rule['limit'],
+            'until': usage['period_end']
+        }
+        # 先写入状态文件再从运行时移除：接口守护进程（wgsupervisor）按状态文件判断缺失的 peer
+        # 是否是被暂停的，顺序相反时它可能在这段时间里把 peer 补回去
+        self._save_state()
+        result = iface.apply_peers([(usage['public_key'], None)])
+        if not result['success']:
+            del self._suspended[name]
+            self._save_state()
+            print(f"Quota: failed to suspend {name}: {result.get('stderr') or result.get('error')}")
+            return False
+        print(f"Quota: suspended {name} ({used} / {rule['limit']} bytes)")
+        audit.record('quota.suspend', iface.name, [name], [usage['public_key']], used=used, limit=rule['limit'])
+        webhooks.publish('quota.exceeded', {'name': name, 'interface': iface.name, 'used': used,
+                                            'limit': rule['limit'], 'until': usage['period_end']},
+                         key=f'quota:{name}')
+        return True
+
+    def _restore(self, name):
+        info = self._suspended.pop(name, None)
+        if info is None:
+            return False
+        iface = get_interface(info['interface'])
+        index = iface.read_index() if iface else None
+        spans = index.find_public_key(info['public_key']) if index else []
+        if spans and index.peers[spans[0]].allowed_ips:
+            # 按配置文件中当前的 AllowedIPs 恢复（客户端已被删除时不恢复）
+            result = iface.apply_peers([(info['public_key'], index.peers[spans[0]].allowed_ips)])
+            if not result['success']:
+                self._suspended[name] = info
+                print(f"Quota: failed to restore {name}: {result.get('stderr') or result.get('error')}")
+                return False
+            print(f"Quota: restored {name}")
+            audit.record('quota.restore', iface.name, [name], [info['public_key']])
+            webhooks.publish('quota.restored', {'name': name, 'interface': iface.name}, key=f'quota:{name}')
+        return True
+
+    def is_suspended(self, name):
+        with self._lock:
+            self._ensure_loaded()
+            return name in self._suspended
+
+    def suspended_public_keys(self, interface):
+        """本接口上因超出配额从运行时移除的公钥"""
+        with self._lock:
+            self._ensure_loaded()
+            return {info['public_key'] for info in self._suspended.values() if info['interface'] == interface}
+
+    def rekey(self, public_keys):
+        """客户端密钥轮换后更新记录中的公钥（{名称: 新公钥}）"""
+        with self._lock:
+            self._ensure_loaded()
+            dirty = False
+            for name, public_key in public_keys.items():
+                for record in (self._usage.get(name), self._suspended.get(name)):
+                    if record is not None:
+                        record['public_key'] = public_key
+                        dirty = True
+            if dirty:
+                self._save_state()
+
+    def reapply(self, iface):
+        """syncconf 会重新加入配置中的全部 peer，重新移除本接口上已暂停的客户端"""
+        with self._lock:
+            if self._config is None:
+                self._ensure_loaded()
+            changes = [(info['public_key'], None) for info in self._suspended.values()
+                       if info['interface'] == iface.name]
+        if changes:
+            iface.apply_peers(changes)
+
+    # ---------- 采集回调 ----------
+
+    def observe(self, snapshot):
+        """快照回调：只处理流量有变化的客户端，以及到期的周期切换"""
+        now = int(snapshot.generated_at)
+        with self._lock:
+            self._ensure_loaded()
+            if not self._config['clients'] and not self._config['groups'] and not self._suspended:
+                return
+            dirty = False
+
+            for client in snapshot.changed:
+                if client.name not in self._usage:
+                    dirty = True
+                self._account(client, now)
+
+            # 周期切换：重算基线，额度恢复的客户端解除暂停
+            while self._resets and self._resets[0][0] <= now:
+                _, name = heapq.heappop(self._resets)
+                usage = self._usage.get(name)
+                rule = self.rule_for(name, usage.get('group') if usage else None)
+                if usage is None or rule is None or usage['period_end'] > now:
+                    continue
+                self._reset_period(name, usage, rule, now, force=True)
+                self._push(name, usage, rule)
+                if name in self._suspended and self._remaining[name] > 0:
+                    self._restore(name)
+                dirty = True
+
+            # 额度耗尽的客户端
+            while self._heap and self._heap[0][0] <= 0:
+                remaining, name = heapq.heappop(self._heap)
+                if self._remaining.get(name) != remaining or name in self._suspended:
+                    continue
+                if self._suspend(name, now):
+                    dirty = True
+
+            if dirty:
+                self._save_state()
+
+    # ---------- 管理接口 ----------
+
+    def update_config(self, changes):
+        """
+        合并配额设置，值为 None 表示删除该规则
+
+        Args:
+            changes: {"clients": {...}, "groups": {...}}
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for section in ('clients', 'groups'):
+                for name, rule in (changes.get(section) or {}).items():
+                    if rule is None:
+                        self._config[section].pop(name, None)
+                    else:
+                        self._config[section][name] = rule
+            self._save_config()
+            self._rebuild()
+            self._save_state()
+
+    def status(self, nearest=20):
+        """配额设置、已暂停的客户端和最接近限额的客户端"""
+        with self._lock:
+            self._ensure_loaded()
+            valid = [(remaining, name) for name, remaining in self._remaining.items()
+                     if name not in self._suspended]
+            closest = heapq.nsmallest(nearest, valid)
+            return {
+                'config': self._config,
+                'suspended': [dict(info, name=name) for name, info in self._suspended.items()],
+                'nearest': [{
+                    'name': name,
+                    'remaining': remaining,
+                    'used': self._usage[name]['last_total'] - self._usage[name]['base'],
+                    'period_end': self._usage[name]['period_end']
+                } for remaining, name in closest]
+            }
+
+
+quotas = QuotaEnforcer(QUOTAS_FILE, QUOTA_STATE_FILE)
+register_snapshot_hook(quotas.observe)
+_reload_hooks.append(quotas.reapply)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -756,7 +1667,11 @@ def login():
             user_data = users[username]
             user = User(user_data['username'], user_data['password_hash'])
 
-            if user.check_password(password):
+            valid = check_password_bounded(user, password)
+            if valid is None:
+                flash('登录请求过多，请稍后再试', 'error')
+                return render_template('login.html'), 429
+            if valid:
                 login_user(user, remember=True)
                 flash('登录成功！', 'success')
 
@@ -791,518 +1706,2088 @@ def index():
 @login_required
 @limiter.limit("1200 per hour")  # 状态API需要更高限额：支持30秒自动刷新
 def api_status():
-    """获取服务器状态"""
-    server_info = get_server_info()
-    clients = get_clients()
+    """获取服务器状态（?clients=0 不返回客户端列表，客户端由 /api/clients 分页获取）"""
+    include_clients = request.args.get('clients', '1').lower() not in ('0', 'false', 'no')
+    return compressed_json(get_status_snapshot().to_dict(include_clients=include_clients))
+
+
+try:
+    import brotli   # 可选：安装后客户端接受 br 时优先使用
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024   # 小于该字节数的响应不压缩
+
+# /api/v2/status 的客户端列：key(客户端, 快照时间) -> 整数或原始值，格式化由调用方完成
+STATUS_V2_COLUMNS = {
+    'name': lambda c, now: c.name,
+    'public_key': lambda c, now: c.public_key,
+    'ip': lambda c, now: c.ip,
+    'interface': lambda c, now: c.interface,
+    'status': lambda c, now: 2 if c.disabled else int(c.is_online(now)),
+    'handshake': lambda c, now: c.handshake,
+    'rx': lambda c, now: c.rx,
+    'tx': lambda c, now: c.tx,
+    'total_rx': lambda c, now: c.total_rx,
+    'total_tx': lambda c, now: c.total_tx,
+    'group': lambda c, now: c.group,
+    'tags': lambda c, now: list(c.tags),
+    'duplicates': lambda c, now: c.duplicates
+}
+STATUS_V2_CODES = ('offline', 'online', 'disabled')   # status 列的取值含义
+# 默认返回的列：公钥是随机数据，几乎无法压缩，占压缩后体积的大部分，需要时用 ?fields= 显式请求
+STATUS_V2_DEFAULT_FIELDS = tuple(field for field in STATUS_V2_COLUMNS if field != 'public_key')
+
+
+def compressed_json(data, status=200):
+    """紧凑 JSON 响应，按 Accept-Encoding 使用 br（安装了 brotli 时）或 gzip 压缩"""
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+    headers = {'Vary': 'Accept-Encoding'}
+    if len(body) >= COMPRESS_MIN_SIZE:
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            body = brotli.compress(body, quality=5)
+            headers['Content-Encoding'] = 'br'
+        elif accepted['gzip']:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+
+def status_v2(snapshot, fields, now=None):
+    """
+    v2 状态：客户端按列输出（每个字段一个数组，下标对应同一客户端）
 
-    return jsonify({
-        'server': server_info,
-        'clients': clients,
+    字节数为整数，时间为 epoch 秒（0 表示从未握手），status 为 STATUS_V2_CODES 的下标。
+    """
+    if now is None:
+        now = int(time.time())
+    clients = snapshot.clients
+    return {
+        'v': 2,
+        'generated_at': int(snapshot.generated_at),
+        'age': max(0, int(now - snapshot.generated_at)),
+        'stale': snapshot.stale,
+        **({'error': snapshot.error} if snapshot.error else {}),
+        'interfaces': snapshot.interfaces,
         'client_count': len(clients),
-        'online_count': len([c for c in clients if c['status'] == 'online'])
-    })
+        'online_count': sum(1 for c in clients if c.is_online(now)),
+        'online_threshold': ONLINE_THRESHOLD,
+        'status_codes': STATUS_V2_CODES,
+        'fields': list(fields),
+        'clients': {field: [STATUS_V2_COLUMNS[field](c, now) for c in clients] for field in fields}
+    }
 
 
-@app.route('/api/clients')
+@app.route('/api/v2/status')
 @login_required
-def api_clients():
-    """获取客户端列表"""
-    clients = get_clients()
-    return jsonify({'clients': clients})
+@limiter.limit("1200 per hour")
+def api_status_v2():
+    """紧凑状态：?fields=name,ip,status,handshake 只返回这些列（默认除公钥外全部，空字符串表示不要客户端列）"""
+    fields = STATUS_V2_DEFAULT_FIELDS
+    if 'fields' in request.args:
+        fields = tuple(field.strip() for field in request.args['fields'].split(',') if field.strip())
+        unknown = [field for field in fields if field not in STATUS_V2_COLUMNS]
+        if unknown:
+            return jsonify({'success': False, 'error': f"未知字段: {', '.join(unknown)}",
+                            'fields': list(STATUS_V2_COLUMNS)}), 400
+    return compressed_json(status_v2(get_status_snapshot(), fields))
+
+
+def _search_clients(clients, query):
+    """按名称、IP、分组、标签、公钥做不区分大小写的子串匹配"""
+    query = query.lower()
+    return [c for c in clients
+            if query in c.name.lower() or query in c.ip or query in (c.group or '').lower()
+            or query in c.public_key.lower() or any(query in tag.lower() for tag in c.tags)]
 
 
-@app.route('/api/client/add', methods=['POST'])
+@app.route('/api/clients')
 @login_required
-def api_add_client():
-    """添加新客户端"""
+@limiter.limit("6000 per hour")  # 仪表盘按滚动位置分页加载
+def api_clients():
+    """
+    获取客户端列表（可按 ?group= 或 ?tag= 过滤）
+
+    带 sort/order/q/offset/limit 任一参数时在服务端排序、搜索和分页：
+    ?sort=name|ip|interface|group|status|handshake|transfer&order=asc|desc&q=&offset=0&limit=100，
+    返回当前页和匹配总数 total。
+    """
+    snapshot = get_status_snapshot()
+    args = request.args
+    paged = any(name in args for name in ('sort', 'order', 'q', 'offset', 'limit'))
+
+    sort = args.get('sort', 'name')
+    if sort not in CLIENT_SORT_KEYS:
+        return jsonify({'success': False, 'error': f"sort 只支持 {' / '.join(CLIENT_SORT_KEYS)}"}), 400
+    clients = snapshot.sorted_clients(sort, args.get('order') == 'desc') if paged else snapshot.clients
+    if 'group' in args:
+        group = args['group'] or None
+        clients = [c for c in clients if c.group == group] if paged else snapshot.group_index().get(group, [])
+    elif 'tag' in args:
+        tag = args['tag']
+        clients = [c for c in clients if tag in c.tags] if paged else snapshot.tag_index().get(tag, [])
+    if not paged:
+        return jsonify({'clients': serialize_clients(clients)})
+
+    if args.get('q', '').strip():
+        clients = _search_clients(clients, args['q'].strip())
     try:
-        data = request.json
-        client_name = data.get('name', '').strip()
+        offset = max(0, int(args.get('offset', 0)))
+        limit = min(CLIENTS_PAGE_MAX, max(1, int(args.get('limit', 100))))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'offset/limit 必须是整数'}), 400
+    return jsonify({
+        'clients': serialize_clients(clients[offset:offset + limit]),
+        'total': len(clients),
+        'offset': offset,
+        'limit': limit,
+        'generated_at': int(snapshot.generated_at),
+        'stale': snapshot.stale
+    })
 
-        if not client_name:
-            return jsonify({'success': False, 'error': 'Client name is required'})
 
-        # 清理客户端名称
-        client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
+@app.route('/api/groups')
+@login_required
+@limiter.limit("1200 per hour")
+def api_groups():
+    """各分组的汇总统计（未分组的客户端汇总在 ungrouped 中）"""
+    snapshot = get_status_snapshot()
+    stats = snapshot.group_stats()
+    return jsonify({
+        'groups': sorted((v for k, v in stats.items() if k is not None), key=lambda g: g['group']),
+        'ungrouped': stats.get(None),
+        'tags': {tag: len(clients) for tag, clients in snapshot.tag_index().items()},
+        'generated_at': int(snapshot.generated_at),
+        'stale': snapshot.stale
+    })
 
-        # 获取服务器信息
-        server_info = get_server_info()
-        config_result = run_command(['cat', WG_CONF])
-        if not config_result['success']:
-            return jsonify({'success': False, 'error': 'Cannot read config'})
 
-        config = config_result['stdout']
+@app.route('/api/groups/<group>')
+@login_required
+def api_group_detail(group):
+    """单个分组的汇总和客户端列表"""
+    snapshot = get_status_snapshot()
+    stats = snapshot.group_stats().get(group)
+    if stats is None:
+        return jsonify({'success': False, 'error': f'分组不存在: {group}'}), 404
+    return jsonify(dict(stats, clients=serialize_clients(snapshot.group_index()[group])))
 
-        # 获取 VPN 网段
-        address_match = re.search(r'Address\s*=\s*(\d+\.\d+\.\d+)\.\d+', config)
-        if not address_match:
-            return jsonify({'success': False, 'error': 'Cannot determine VPN subnet'})
 
-        subnet = address_match.group(1)
+@app.route('/api/backend/status')
+@login_required
+def api_backend_status():
+    """后端命令的熔断器状态和自适应超时"""
+    return jsonify({'breakers': [b.to_dict() for b in list(_breakers.values())], 'startup': startup_report})
 
-        # 检查客户端名称是否已存在
-        existing_clients = get_clients()
-        for client in existing_clients:
-            if client['name'] == client_name:
-                return jsonify({
-                    'success': False,
-                    'error': f'客户端名称 "{client_name}" 已存在，请使用其他名称'
-                })
 
-        # 查找可用 IP
-        used_ips = re.findall(r'AllowedIPs\s*=\s*' + re.escape(subnet) + r'\.(\d+)/32', config)
-        used_ips = [int(ip) for ip in used_ips]
+@app.route('/api/events')
+@login_required
+@limiter.limit("1200 per hour")
+def api_events():
+    """增量读取客户端上线/下线事件：?since=<上次返回的 last_seq>"""
+    since = request.args.get('since', default=0, type=int)
+    limit = min(request.args.get('limit', default=500, type=int), 5000)
+    return jsonify(presence.events_since(since, limit))
 
-        # 提取所有已存在的公钥（用于重复检测）
-        existing_pubkeys = re.findall(r'PublicKey\s*=\s*([^\s]+)', config)
 
-        next_ip = 2
-        while next_ip in used_ips:
-            next_ip += 1
+@app.route('/api/webhooks/status')
+@login_required
+def api_webhooks_status():
+    """Webhook 队列和各接收地址的投递状态"""
+    return jsonify(webhooks.status())
 
-        client_ip = f"{subnet}.{next_ip}"
 
-        # 创建客户端目录
-        run_command(['mkdir', '-p', CLIENT_DIR])
+@app.route('/api/quotas', methods=['GET', 'POST'])
+@login_required
+def api_quotas():
+    """
+    查看或修改流量配额
 
-        # 生成密钥
-        private_key_result = run_command(['wg', 'genkey'])
-        if not private_key_result['success']:
-            return jsonify({'success': False, 'error': 'Failed to generate private key'})
+    POST 数据格式同 quotas.json，按名称合并，值为 null 表示删除该规则。
+    """
+    if request.method == 'POST':
+        data = request.json or {}
+        for section in ('clients', 'groups'):
+            rules = data.get(section) or {}
+            if not isinstance(rules, dict):
+                return jsonify({'success': False, 'error': f'{section} 格式错误'}), 400
+            for name, rule in rules.items():
+                if rule is not None and not isinstance(rule, dict):
+                    return jsonify({'success': False, 'error': f'{section}.{name} 格式错误'}), 400
+                if rule and rule.get('period', 'monthly') not in ('monthly', 'rolling'):
+                    return jsonify({'success': False, 'error': 'period 只能是 monthly 或 rolling'}), 400
+        quotas.update_config(data)
+        audit.record('quota.config', peers=list(data.get('clients') or {}),
+                     clients=data.get('clients'), groups=data.get('groups'))
+        return jsonify({'success': True, **quotas.status()})
+    return jsonify(quotas.status())
+
+
+@app.errorhandler(BackendError)
+def handle_backend_error(e):
+    """后端不可用且没有可用的旧快照"""
+    return jsonify({'success': False, 'error': f'WireGuard 后端不可用: {e}'}), 503
+
+
+def add_client(client_name, interface=None, group=None, tags=None):
+    """
+    添加新客户端（见 wgcore.create_client），并发送通知、记录复制增量
 
-        private_key = private_key_result['stdout'].strip()
+    Returns:
+        dict: 包含 success 以及 client 或 error 的结果字典
+    """
+    if replication.role == 'standby':
+        return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+
+    before = audit.snapshot()
+    result = create_client(client_name, interface, group, tags)
+    if not result['success']:
+        return result
+    invalidate_status_snapshot()
+
+    client = result['client']
+    webhooks.publish('client.add', {
+        'name': client['name'],
+        'interface': client['interface'],
+        'public_key': client['public_key'],
+        'allowed_ips': f"{client['ip']}/32"
+    })
 
-        # 生成公钥 (需要shell来处理管道)
-        public_key_result = run_command(f'echo "{private_key}" | wg pubkey', use_sudo=False, shell=True)
-        if not public_key_result['success']:
-            return jsonify({'success': False, 'error': 'Failed to generate public key'})
+    # 记录复制增量（备用节点据此同步）
+    replication.record({
+        'op': 'add',
+        'interface': client['interface'],
+        'name': client['name'],
+        'public_key': client['public_key'],
+        'allowed_ips': f"{client['ip']}/32",
+        'block': result['block'],
+        'files': result['files']
+    })
+    audit.record('client.add', client['interface'], [client['name']], [client['public_key']], before,
+                 ip=client['ip'], group=group, tags=tags)
 
-        public_key = public_key_result['stdout'].strip()
+    if 'warning' in result:
+        drift_monitor.notify(get_interface(client['interface']))
+        return {'success': True, 'client': client, 'warning': result['warning']}
+    return {'success': True, 'client': client}
 
-        # 保存密钥 - 使用Python文件操作代替echo命令
-        private_key_file = os.path.join(CLIENT_DIR, f'{client_name}_private.key')
-        public_key_file = os.path.join(CLIENT_DIR, f'{client_name}_public.key')
 
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            f.write(private_key)
-            temp_priv = f.name
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            f.write(public_key)
-            temp_pub = f.name
-
-        run_command(['cp', temp_priv, private_key_file])
-        run_command(['cp', temp_pub, public_key_file])
-        run_command(['chmod', '600', private_key_file])
-
-        os.unlink(temp_priv)
-        os.unlink(temp_pub)
-
-        # 获取服务器公钥 (需要shell来处理grep和awk管道)
-        server_private_key_result = run_command(f"grep '^PrivateKey' {WG_CONF} | awk '{{print $3}}'", shell=True)
-        if server_private_key_result['success']:
-            server_private_key = server_private_key_result['stdout'].strip()
-            # 使用shell管道生成公钥
-            server_public_key_result = run_command(f'echo "{server_private_key}" | wg pubkey', use_sudo=False, shell=True)
-            server_public_key = server_public_key_result['stdout'].strip()
-        else:
-            return jsonify({'success': False, 'error': 'Cannot get server public key'})
-
-        # 添加 Peer 到服务器配置
-        peer_config = f'''
-# 客户端: {client_name}
-[Peer]
-PublicKey = {public_key}
-AllowedIPs = {client_ip}/32
-'''
-
-        # 备份配置 (需要shell来处理date命令替换)
-        backup_name = f'{WG_CONF}.backup.{datetime.now().strftime("%Y%m%d_%H%M%S")}'
-        run_command(['cp', WG_CONF, backup_name])
-
-        # 追加配置 - 使用临时文件而不是echo，避免shell解释问题
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as peer_f:
-            peer_f.write(peer_config)
-            peer_temp = peer_f.name
-
-        # 使用shell重定向来追加内容
-        run_command(f'cat {peer_temp} >> {WG_CONF}', shell=True)
-        os.unlink(peer_temp)
-
-        # 生成客户端配置
-        client_config = f'''[Interface]
-PrivateKey = {private_key}
-Address = {client_ip}/24
-DNS = 8.8.8.8, 1.1.1.1
-
-[Peer]
-PublicKey = {server_public_key}
-Endpoint = {server_info['public_ip']}:{server_info['listen_port']}
-AllowedIPs = 0.0.0.0/0, ::/0
-PersistentKeepalive = 25
-'''
-
-        # 保存客户端配置 - 使用临时文件
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as client_f:
-            client_f.write(client_config)
-            client_temp = client_f.name
-
-        client_conf_path = os.path.join(CLIENT_DIR, f'{client_name}.conf')
-        run_command(['cp', client_temp, client_conf_path])
-        os.unlink(client_temp)
-        run_command(['chmod', '600', client_conf_path])
-
-        # 重新加载配置 - 使用两步法代替进程替换
-        strip_result = run_command(['wg-quick', 'strip', WG_INTERFACE])
-        if strip_result['success']:
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.conf') as strip_f:
-                strip_f.write(strip_result['stdout'])
-                strip_file = strip_f.name
-            run_command(['wg', 'syncconf', WG_INTERFACE, strip_file])
-            os.unlink(strip_file)
-
-        return jsonify({
-            'success': True,
-            'client': {
-                'name': client_name,
-                'ip': client_ip,
-                'public_key': public_key
-            }
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+@app.route('/api/client/add', methods=['POST'])
+@login_required
+def api_add_client():
+    """添加新客户端"""
+    data = request.json or {}
+    return jsonify(add_client(data.get('name', ''), data.get('interface'), data.get('group'), data.get('tags')))
 
 
 @app.route('/api/client/<client_name>/config')
+@returns_secrets
 @login_required
 def api_client_config(client_name):
     """获取客户端配置"""
+    return jsonify(get_client_config(client_name))
+
+
+def get_client_config(client_name):
+    """读取客户端配置并生成二维码，返回结果字典"""
     try:
         # 清理客户端名称
         client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
 
-        # 验证路径以防止路径遍历攻击
-        config_file = os.path.join(CLIENT_DIR, f"{client_name}.conf")
-        config_file = os.path.normpath(config_file)
-
-        # 确保文件在CLIENT_DIR中
-        if not config_file.startswith(os.path.normpath(CLIENT_DIR)):
-            return jsonify({'success': False, 'error': 'Invalid client name'})
-
-        result = run_command(['cat', config_file])
+        if not client_name:
+            return {'success': False, 'error': 'Invalid client name'}
 
-        if not result['success']:
-            return jsonify({'success': False, 'error': 'Config not found'})
+        config_text = read_client_config(client_name)
+        if config_text is None:
+            return {'success': False, 'error': 'Config not found'}
 
-        config_text = result['stdout']
         qr_code = generate_qrcode(config_text)
 
-        return jsonify({
+        return {
             'success': True,
             'config': config_text,
             'qrcode': qr_code
-        })
+        }
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return {'success': False, 'error': str(e)}
 
 
-@app.route('/api/client/<client_name>/delete', methods=['POST'])
-@login_required
-def api_delete_client(client_name):
-    """删除客户端"""
-    try:
-        # 清理客户端名称
-        original_client_name = client_name
-        client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
+def delete_client(client_name):
+    """
+    删除客户端（见 wgcore.delete_peers），并发送通知、记录复制增量
 
-        # 验证客户端名称不为空
-        if not client_name:
-            return jsonify({'success': False, 'error': '客户端名称无效'})
+    Returns:
+        dict: 包含 success 以及 message 或 error 的结果字典
+    """
+    if replication.role == 'standby':
+        return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+
+    before = audit.snapshot()
+
+    def on_deleted(iface, iface_deleted):
+        for name, public_key in iface_deleted:
+            webhooks.publish('client.delete', {'name': name, 'interface': iface.name, 'public_key': public_key})
+            replication.record({'op': 'delete', 'interface': iface.name, 'name': name, 'public_key': public_key})
+        audit.record('client.delete', iface.name, [name for name, _ in iface_deleted],
+                     [public_key for _, public_key in iface_deleted], before)
+
+    result = delete_peers([client_name], on_deleted)
+    if result.get('deleted'):
+        invalidate_status_snapshot()
+    if not result['success']:
+        return {'success': False, 'error': f"删除失败: {result['error']}"}
+    if not result['deleted']:
+        return {'success': False, 'error': f'未找到客户端 "{client_name}"'}
+    return {
+        'success': True,
+        'message': f'客户端 "{client_name}" 已成功删除'
+    }
 
-        # 读取配置
-        config_result = run_command(['cat', WG_CONF])
-        if not config_result['success']:
-            return jsonify({'success': False, 'error': '无法读取配置文件'})
 
-        config = config_result['stdout']
-        original_config = config
-
-        # 使用安全的逐行解析方法删除peer块
-        deletion_successful = False
-        target_safe_suffix = None if not client_name.startswith('Unknown-') else client_name.split('-')[1]
-
-        # 逐行安全解析 - 使用状态机
-        lines = config.split('\n')
-        new_lines = []
-
-        # 状态跟踪
-        in_interface = False
-        in_peer = False
-        peer_comment_lines = []  # 当前peer前的注释行
-        peer_content_lines = []  # 当前peer块的内容行
-        skip_current_peer = False
-
-        for i, line in enumerate(lines):
-            stripped = line.strip()
-
-            # 检测 [Interface]
-            if stripped == '[Interface]':
-                in_interface = True
-                in_peer = False
-                new_lines.append(line)
-
-            # 检测 [Peer]
-            elif stripped == '[Peer]':
-                # 保存之前的peer（如果不删除）
-                if in_peer and not skip_current_peer:
-                    # 保存上一个peer的注释和内容
-                    new_lines.extend(peer_comment_lines)
-                    new_lines.extend(peer_content_lines)
-                    # ✅ 关键修复：重置注释列表，防止注释被关联到错误的peer
-                    peer_comment_lines = []
-
-                # 开始新的peer块
-                in_interface = False
-                in_peer = True
-                # peer_comment_lines 保留给当前peer使用（之前收集的注释）
-                peer_content_lines = [line]  # 从[Peer]行开始
-                skip_current_peer = False
-
-            # 在interface块中
-            elif in_interface:
-                # 检查是否是 Peer 的注释（用于识别客户端名称）
-                if stripped.startswith('#'):
-                    # 检查是否是客户端注释格式
-                    if (re.search(r'#\s*客户端[：:]', stripped) or
-                        re.search(r'#\s*[Cc]lient\s*:', stripped) or
-                        (re.search(r'^#\s*[a-zA-Z0-9_-]+\s*$', stripped) and
-                         not any(keyword in stripped for keyword in ['服务端', '监听', '启动', '关闭', 'Interface', 'Server']))):
-                        # 这是一个 Peer 的注释，结束 Interface 块
-                        in_interface = False
-                        peer_comment_lines.append(line)
-                    else:
-                        # Interface 块内的注释，保留
-                        new_lines.append(line)
-                else:
-                    # Interface 块的其他内容，保留
-                    new_lines.append(line)
-
-            # 在peer块中
-            elif in_peer:
-                # 检查是否是下一个 Peer 的注释
-                if stripped.startswith('#'):
-                    # 检查是否是客户端注释格式
-                    if (re.search(r'#\s*客户端[：:]', stripped) or
-                        re.search(r'#\s*[Cc]lient\s*:', stripped) or
-                        (re.search(r'^#\s*[a-zA-Z0-9_-]+\s*$', stripped) and
-                         not any(keyword in stripped for keyword in ['服务端', '监听', '启动', '关闭', 'Interface', 'Server']))):
-                        # 这是下一个 Peer 的注释，结束当前 peer
-                        if not skip_current_peer:
-                            # 保存当前peer的注释和内容
-                            new_lines.extend(peer_comment_lines)
-                            new_lines.extend(peer_content_lines)
-
-                        # 开始收集新的注释
-                        in_peer = False
-                        peer_comment_lines = [line]
-                        peer_content_lines = []
-                        skip_current_peer = False
-                    else:
-                        # peer 内部的注释，添加到内容中
-                        peer_content_lines.append(line)
-                else:
-                    # peer 的配置行
-                    peer_content_lines.append(line)
-
-                # 检测PublicKey行
-                if 'PublicKey' in line and '=' in line and not skip_current_peer:
-                    pubkey_match = re.search(r'PublicKey\s*=\s*([^\s]+)', line)
-                    if pubkey_match:
-                        pubkey = pubkey_match.group(1)
-
-                        # 判断是否是要删除的目标
-                        is_target = False
-
-                        # 方法1：通过公钥后缀匹配（Unknown客户端）
-                        if target_safe_suffix:
-                            block_safe_suffix = pubkey.replace('+', '').replace('=', '').replace('/', '')[-8:]
-                            if block_safe_suffix == target_safe_suffix:
-                                is_target = True
-
-                        # 方法2：通过注释中的名称匹配（命名客户端）
-                        else:
-                            comment_text = '\n'.join(peer_comment_lines)
-                            if re.search(rf'#\s*客户端\s*[：:]\s*{re.escape(client_name)}\s*$', comment_text, re.MULTILINE):
-                                is_target = True
-                            elif re.search(rf'#\s*[Cc]lient\s*:\s*{re.escape(client_name)}\s*$', comment_text, re.MULTILINE):
-                                is_target = True
-                            elif re.search(rf'#\s*{re.escape(client_name)}\s*$', comment_text, re.MULTILINE):
-                                is_target = True
-
-                        if is_target:
-                            skip_current_peer = True
-                            deletion_successful = True
-                            # 清空已收集的内容和注释
-                            peer_content_lines = []
-                            peer_comment_lines = []
-
-            # 不在任何section中（可能是peer的注释或空行）
-            else:
-                if stripped.startswith('#'):
-                    # 这是注释行，可能是下一个peer的注释
-                    peer_comment_lines.append(line)
-                elif not stripped:
-                    # 空行
-                    if peer_comment_lines:
-                        # 如果之前有注释，这个空行属于注释部分
-                        peer_comment_lines.append(line)
-                    else:
-                        # 否则直接添加
-                        new_lines.append(line)
+@app.route('/api/client/<client_name>/delete', methods=['POST'])
+@login_required
+def api_delete_client(client_name):
+    """删除客户端"""
+    return jsonify(delete_client(client_name))
+
+
+def delete_clients(names):
+    """
+    批量删除客户端（每个接口一次配置写入和一条 wg set）
+
+    Returns:
+        dict: success、deleted、not_found，失败时包含 error
+    """
+    if replication.role == 'standby':
+        return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+
+    before = audit.snapshot()
+
+    def on_deleted(iface, iface_deleted):
+        audit.record('client.delete', iface.name, [name for name, _ in iface_deleted],
+                     [public_key for _, public_key in iface_deleted], before)
+        replication.record({
+            'op': 'delete_many',
+            'interface': iface.name,
+            'names': [name for name, _ in iface_deleted],
+            'public_keys': [public_key for _, public_key in iface_deleted if public_key]
+        })
+        webhooks.publish_many([('client.delete', {'name': name, 'interface': iface.name,
+                                                  'public_key': public_key}, None)
+                               for name, public_key in iface_deleted])
+
+    result = delete_peers(names, on_deleted)
+    if result.get('deleted'):
+        invalidate_status_snapshot()
+    return result
+
+
+def _apply_metadata(iface, names, group, tags):
+    """在单个接口上修改一组客户端的分组/标签（只改注释，不影响运行时）"""
+    iface.invalidate()
+    index = iface.read_index()
+    if index is None:
+        raise RuntimeError(f'无法读取 {iface.conf}')
+    original = index
+    for name in names:
+        for i in index.find(name):
+            index = index.set_metadata(i, group, tags)
+    if index is original:
+        return False
+    if not iface.write_config(index):
+        raise RuntimeError('无法写入新配置')
+    return True
+
+
+def set_clients_metadata(names, group=None, tags=None):
+    """
+    批量设置客户端分组/标签
+
+    Args:
+        group: 新分组，None 不修改，空字符串清除
+        tags: 新标签列表，None 不修改，空列表清除
+    """
+    if replication.role == 'standby':
+        return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+    names = _clean_names(names)
+    if not names:
+        return {'success': False, 'error': '客户端名称无效'}
+    if tags is not None and not isinstance(tags, list):
+        return {'success': False, 'error': 'tags 必须是列表'}
+
+    by_iface, not_found = _group_by_interface(names)
+    updated = []
+    try:
+        for iface, iface_names in by_iface.items():
+            before = audit.snapshot([iface])
+            if _apply_metadata(iface, iface_names, group, tags):
+                updated.extend(iface_names)
+                audit.record('client.metadata', iface.name, iface_names, before=before, group=group, tags=tags)
+                replication.record({'op': 'metadata', 'interface': iface.name, 'names': iface_names,
+                                    'group': group, 'tags': tags})
+    except RuntimeError as e:
+        return {'success': False, 'error': str(e), 'updated': updated}
+    finally:
+        if updated:
+            invalidate_status_snapshot()
+    return {'success': True, 'updated': updated, 'not_found': not_found}
+
+
+@app.route('/api/clients/metadata', methods=['POST'])
+@login_required
+def api_clients_metadata():
+    """批量设置分组/标签：{"names": [...], "group": "销售部", "tags": ["外包"]}"""
+    data = request.json or {}
+    return jsonify(set_clients_metadata(data.get('names'), data.get('group'), data.get('tags')))
+
+
+@app.route('/api/clients/delete', methods=['POST'])
+@login_required
+def api_delete_clients():
+    """批量删除客户端：{"names": [...]}"""
+    data = request.json or {}
+    return jsonify(delete_clients(data.get('names')))
+
+
+def _apply_disabled(iface, names, disabled, backup=True):
+    """
+    在单个接口上禁用/启用一组客户端：写一次配置，用一条 wg set 修改运行时
+
+    Returns:
+        list: 实际改变状态的客户端名称
+
+    Raises:
+        RuntimeError: 配置读写或运行时修改失败（已尽量恢复）
+    """
+    iface.invalidate()
+    index = iface.read_index()
+    if index is None:
+        raise RuntimeError(f'无法读取 {iface.conf}')
+
+    changes = []
+    changed_names = []
+    for name in names:
+        for i in index.find(name):
+            span = index.peers[i]
+            if span.disabled == disabled:
+                continue
+            index = index.set_disabled(i, disabled)
+            changed_names.append(name)
+            # 因流量配额暂停中的客户端启用后仍保持暂停
+            if span.public_key and not (not disabled and quotas.is_suspended(name)):
+                changes.append((span.public_key, None if disabled else span.allowed_ips))
+    if not changed_names:
+        return []
+
+    backup_name = _backup_config(iface) if backup else None
+    if not iface.write_config(index):
+        raise RuntimeError('无法写入新配置')
+    _apply_runtime_changes(iface, changes, backup_name)
+    return changed_names
+
+
+def set_clients_disabled(names, disabled):
+    """
+    批量禁用或启用客户端（保留密钥、配置文件和流量记录）
+
+    Returns:
+        dict: success、changed（实际改变的名称）、not_found，失败时包含 error
+    """
+    if replication.role == 'standby':
+        return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+
+    cleaned = _clean_names(names)
+    if not cleaned:
+        return {'success': False, 'error': '客户端名称无效'}
+
+    by_iface, not_found = _group_by_interface(cleaned)
+
+    op = 'disable' if disabled else 'enable'
+    changed = []
+    try:
+        for iface, iface_names in by_iface.items():
+            before = audit.snapshot([iface])
+            iface_changed = _apply_disabled(iface, iface_names, disabled)
+            if iface_changed:
+                changed.extend(iface_changed)
+                audit.record(f'client.{op}', iface.name, iface_changed, before=before)
+                replication.record({'op': op, 'interface': iface.name, 'names': iface_changed})
+                webhooks.publish_many([(f'client.{op}', {'name': name, 'interface': iface.name}, None)
+                                       for name in iface_changed])
+    except RuntimeError as e:
+        return {'success': False, 'error': str(e), 'changed': changed}
+    finally:
+        if changed:
+            invalidate_status_snapshot()
+
+    return {'success': True, 'changed': changed, 'not_found': not_found}
+
+
+@app.route('/api/clients/disable', methods=['POST'])
+@login_required
+def api_disable_clients():
+    """批量禁用客户端：{"names": [...]}"""
+    data = request.json or {}
+    return jsonify(set_clients_disabled(data.get('names'), True))
+
+
+@app.route('/api/clients/enable', methods=['POST'])
+@login_required
+def api_enable_clients():
+    """批量启用客户端：{"names": [...]}"""
+    data = request.json or {}
+    return jsonify(set_clients_disabled(data.get('names'), False))
+
+
+@app.route('/api/groups/<group>/<action>', methods=['POST'])
+@login_required
+def api_group_action(group, action):
+    """对整个分组执行批量操作：disable / enable / delete / rotate"""
+    operations = {
+        'disable': lambda names: set_clients_disabled(names, True),
+        'enable': lambda names: set_clients_disabled(names, False),
+        'delete': delete_clients,
+        'rotate': lambda names: rotations.rotate_clients(names, scope=f'group:{group}')
+    }
+    if action not in operations:
+        return jsonify({'success': False, 'error': f'未知操作: {action}'}), 404
+    names = clients_in_group(group)
+    if not names:
+        return jsonify({'success': False, 'error': f'分组不存在或没有客户端: {group}'}), 404
+    return jsonify(operations[action](names))
+
+
+# ==================== 密钥轮换 ====================
+
+ROTATION_DIR = f"{WG_DIR}/rotation"
+KEY_ROTATION_GRACE = float(os.environ.get('KEY_ROTATION_GRACE', '86400'))              # 新旧密钥并存的宽限期（秒），0 为立即切换
+KEY_ROTATION_WORKERS = int(os.environ.get('KEY_ROTATION_WORKERS', '16'))               # 并行重写客户端文件的线程数
+KEY_ROTATION_INTERVAL_DAYS = float(os.environ.get('KEY_ROTATION_INTERVAL_DAYS', '0'))  # 定期轮换全部客户端密钥（天），0 关闭
+KEY_ROTATION_HANDSHAKE_POLL = float(os.environ.get('KEY_ROTATION_HANDSHAKE_POLL', '2'))  # 宽限期内检查新公钥握手的间隔（秒），0 只在采集时检查
+
+_CONF_PRIVATE_KEY_RE = re.compile(r'^(\s*PrivateKey\s*=\s*)(\S+)', re.MULTILINE)
+
+_rotation_pool = ThreadPoolExecutor(max_workers=max(1, KEY_ROTATION_WORKERS), thread_name_prefix='wg-rotate')
+
+
+def _rewrite_client_files(iface, name, private_key, public_key):
+    """用新私钥重写单个客户端的 .conf 和密钥文件（幂等）"""
+    conf_path = os.path.join(iface.client_dir, f'{name}.conf')
+    config = _read_private_file(conf_path)
+    if config is not None:
+        new_config = _CONF_PRIVATE_KEY_RE.sub(lambda m: m.group(1) + private_key, config, count=1)
+        if new_config != config:
+            _write_private_file(conf_path, new_config)
+    _write_private_file(os.path.join(iface.client_dir, f'{name}_private.key'), private_key)
+    _write_private_file(os.path.join(iface.client_dir, f'{name}_public.key'), public_key)
+
+
+def _write_rotated_client_files(iface, clients):
+    """在线程池中并行重写一批客户端文件（{名称: {private_key, public_key}}）"""
+    futures = [_rotation_pool.submit(_rewrite_client_files, iface, name, item['private_key'], item['public_key'])
+               for name, item in clients.items() if not item.get('missing')]
+    for future in futures:
+        future.result()
+
+
+def _replace_server_key(path, old_public_key, public_key):
+    """把客户端配置 [Peer] 中的旧服务端公钥替换为新公钥（幂等）"""
+    config = _read_private_file(path)
+    if not config:
+        return
+    new_config = _BLOCK_PUBLIC_KEY_RE.sub(
+        lambda m: m.group(1) + public_key if m.group(2) == old_public_key else m.group(0), config)
+    if new_config != config:
+        _write_private_file(path, new_config)
+
+
+def _rekey_interface(iface, clients, grace, backup=True):
+    """
+    在单个接口上替换一批客户端公钥：一次写配置、一条 wg set（幂等，可重复执行）
+
+    Args:
+        clients: {名称: {old_public_key, public_key, ...}}，就地记录 allowed_ips / cutover / missing
+        grace: True 时新公钥以无 AllowedIPs 的 peer 加入，旧公钥继续生效直到切换
+
+    Raises:
+        RuntimeError: 配置读写或运行时修改失败（已尽量恢复）
+    """
+    iface.invalidate()
+    index = iface.read_index()
+    if index is None:
+        raise RuntimeError(f'无法读取 {iface.conf}')
+
+    positions = {span.public_key: i for i, span in enumerate(index.peers) if span.public_key}
+    replacements = {}
+    for item in clients.values():
+        i = positions.get(item['old_public_key'])
+        if i is not None:
+            replacements[i] = index.replace_public_key(i, item['public_key'])
+    if replacements:
+        try:
+            index = index.splice_many(replacements)
+        except ValueError as e:
+            raise RuntimeError(str(e))
+
+    spans = {span.public_key: span for span in index.peers if span.public_key}
+    changes = []
+    for name, item in clients.items():
+        span = spans.get(item['public_key'])
+        if span is None:
+            # 轮换过程中客户端已被删除
+            item['missing'] = True
+            continue
+        item['allowed_ips'] = span.allowed_ips
+        if span.disabled or quotas.is_suspended(name):
+            # 运行时中本来就没有这个 peer，不需要宽限期
+            changes.append((item['old_public_key'], None))
+            item['cutover'] = True
+        elif grace and not item.get('cutover'):
+            changes.append((item['public_key'], ''))
+        else:
+            changes += [(item['public_key'], span.allowed_ips), (item['old_public_key'], None)]
+            item['cutover'] = True
+
+    backup_name = None
+    if replacements:
+        backup_name = _backup_config(iface) if backup else None
+        if not iface.write_config(index):
+            raise RuntimeError('无法写入新配置')
+    if _apply_runtime_changes(iface, changes, backup_name):
+        # 整体同步后运行时只有配置中的新公钥，等同于立即切换
+        for item in clients.values():
+            item['cutover'] = True
+
+
+def _cutover_interface(iface, clients):
+    """宽限期结束：一条 wg set 把 AllowedIPs 转给新公钥并移除旧公钥，返回是否成功"""
+    index = iface.read_index()
+    spans = {span.public_key: span for span in index.peers if span.public_key} if index else {}
+    changes = []
+    for name, item in clients.items():
+        span = spans.get(item['public_key'])
+        if span is not None and not span.disabled and not quotas.is_suspended(name):
+            changes.append((item['public_key'], span.allowed_ips))
+        changes.append((item['old_public_key'], None))
+    result = iface.apply_peers(changes)
+    if not result['success']:
+        result = iface.reload()
+    return result['success']
+
+
+def _server_key_paths(iface):
+    """entrypoint 生成的服务端密钥文件（主接口无前缀，其他接口加接口名前缀）"""
+    prefix = '' if iface.name == WG_INTERFACE else f'{iface.name}_'
+    return f'{WG_DIR}/{prefix}server_private.key', f'{WG_DIR}/{prefix}server_public.key'
+
+
+def _rekey_server(iface, old_public_key, private_key, backup=True):
+    """
+    替换接口私钥（一次写配置 + wg set private-key），并并行更新所有客户端配置中的服务端公钥（幂等）
+
+    Returns:
+        bool: False 表示本机当前私钥既不是旧密钥也不是新密钥（如备用节点使用独立密钥），未做修改
+    """
+    public_key = public_key_from_private(private_key)
+    iface.invalidate()
+    index = iface.read_index()
+    if index is None:
+        raise RuntimeError(f'无法读取 {iface.conf}')
+    match = _CONF_PRIVATE_KEY_RE.search(index.interface_text)
+    if match is None:
+        raise RuntimeError(f'{iface.conf} 中没有 PrivateKey')
+    current_public_key = public_key_from_private(match.group(2))
+    if current_public_key not in (old_public_key, public_key):
+        return False
+
+    if current_public_key != public_key:
+        backup_name = _backup_config(iface) if backup else None
+        if not iface.write_config(index.text[:match.start(2)] + private_key + index.text[match.end(2):]):
+            raise RuntimeError('无法写入新配置')
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write(private_key)
+            key_file = f.name
+        result = run_command(['wg', 'set', iface.name, 'private-key', key_file])
+        os.unlink(key_file)
+        if not result['success']:
+            result = iface.reload()
+            if not result['success']:
+                if backup_name:
+                    run_command(['cp', backup_name, iface.conf])
+                    iface.invalidate()
+                raise RuntimeError(f'运行时更新失败: {result.get("stderr") or result.get("error", "未知错误")}')
+
+    private_path, public_path = _server_key_paths(iface)
+    for path, content in ((private_path, private_key), (public_path, public_key)):
+        if os.path.exists(path):
+            _write_private_file(path, content + '\n')
+
+    try:
+        filenames = [name for name in os.listdir(iface.client_dir)
+                     if name.endswith('.conf') and CLIENT_FILE_PATTERN.fullmatch(name)]
+    except OSError:
+        filenames = []
+    futures = [_rotation_pool.submit(_replace_server_key, os.path.join(iface.client_dir, name),
+                                     old_public_key, public_key) for name in filenames]
+    for future in futures:
+        future.result()
+    return True
+
+
+class KeyRotator:
+    """
+    客户端和服务端密钥轮换
+
+    每次轮换是一个任务，计划和进度保存在 rotation/<id>.json（权限 600，完成前包含新私钥）。
+    客户端轮换分三个阶段，每个阶段都可以重复执行，中断后按任务文件中记录的新密钥继续：
+      1. 进程内生成全部新密钥（X25519，不为每个客户端启动 wg 进程）
+      2. 每个接口一次配置写入、一条 wg set：新公钥以无 AllowedIPs 的 peer 加入，
+         旧公钥继续持有 AllowedIPs，旧客户端配置在宽限期内仍可使用
+      3. 线程池并行重写客户端 .conf 和密钥文件
+    之后采集回调发现新公钥握手（或宽限期到期）时，用一条 wg set 把 AllowedIPs
+    转给新公钥并移除旧公钥。服务端私钥只有一个，无法新旧并存，直接切换。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.state_path = os.path.join(directory, 'state.json')
+        self._lock = threading.RLock()
+        self._run_lock = threading.Lock()   # 同一时间只执行一个任务
+        self._jobs = None                   # {任务 ID: 任务}
+        self._next_scheduled = None
+        self._watcher = None                # 宽限期内的握手检查线程
+
+    # ---------- 任务持久化 ----------
+
+    def _ensure_loaded(self):
+        if self._jobs is not None:
+            return
+        self._jobs = {}
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            if not filename.endswith('.json') or filename == 'state.json':
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._jobs[job['id']] = job
+
+    def _save(self, job):
+        job['updated'] = int(time.time())
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{job['id']}.json")
+        temp_path = path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(temp_path, path)
+
+    def _advance(self, job, stage):
+        with self._lock:
+            job['stage'] = stage
+            if stage == 'applied':
+                job['grace_until'] = int(time.time() + job['grace'])
+            self._save(job)
+
+    def _finish_if_done(self, job):
+        """没有待切换的客户端时完成任务，并从任务文件中清除新私钥（已写入客户端文件）"""
+        pending = [name for name, item in job['clients'].items()
+                   if not item.get('cutover') and not item.get('missing')]
+        if pending:
+            job['status'] = 'grace'
+            self._ensure_watcher()
+            return
+        job['status'] = 'completed'
+        job.pop('private_key', None)
+        for item in job['clients'].values():
+            item.pop('private_key', None)
+
+    @staticmethod
+    def _by_interface(job, names=None):
+        """按接口分组任务中的客户端，返回 {接口名: {名称: 条目}}（条目与任务共享）"""
+        grouped = {}
+        for name, item in job['clients'].items():
+            if names is None or name in names:
+                grouped.setdefault(item['interface'], {})[name] = item
+        return grouped
+
+    # ---------- 创建和执行 ----------
+
+    def _create(self, kind, scope, grace, **fields):
+        with self._lock:
+            self._ensure_loaded()
+            job = {
+                'id': f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{os.urandom(3).hex()}",
+                'kind': kind,
+                'scope': scope,
+                'status': 'running',
+                'stage': 'planned',
+                'created': int(time.time()),
+                'grace': KEY_ROTATION_GRACE if grace is None else max(0.0, float(grace)),
+                **fields
+            }
+            self._jobs[job['id']] = job
+            self._save(job)
+        self._launch(job)
+        return job
+
+    def _launch(self, job):
+        threading.Thread(target=self._run, args=(job,), name=f"rotation-{job['id']}", daemon=True).start()
+
+    def _run(self, job):
+        with self._run_lock:
+            try:
+                if job['kind'] == 'server':
+                    self._run_server(job)
                 else:
-                    # 其他行
-                    new_lines.append(line)
-
-        # 处理最后一个peer块（如果存在且不删除）
-        if in_peer and not skip_current_peer:
-            new_lines.extend(peer_comment_lines)
-            new_lines.extend(peer_content_lines)
-
-        # 组装新配置
-        new_config = '\n'.join(new_lines)
-
-        # 清理多余的连续空行
-        new_config = re.sub(r'\n\n\n+', '\n\n', new_config)
-
-        # 如果所有模式都失败，返回错误
-        if not deletion_successful:
-            # 为调试提供更多信息
-            debug_info = []
-            peer_blocks = re.findall(r'\[Peer\](.*?)(?=\[Peer\]|$)', config, re.DOTALL)
-            for i, block in enumerate(peer_blocks):
-                pubkey_match = re.search(r'PublicKey\s*=\s*([^\s]+)', block)
-                if pubkey_match:
-                    pubkey = pubkey_match.group(1)
-                    debug_info.append(f"Peer {i+1}: 公钥后8位={pubkey[-8:]}")
-
-            error_msg = f'未找到客户端 "{original_client_name}"。'
-            if debug_info:
-                error_msg += f' 当前配置中的客户端: {", ".join(debug_info)}'
-
-            return jsonify({
-                'success': False,
-                'error': error_msg
+                    self._run_clients(job)
+            except Exception as e:
+                with self._lock:
+                    job['status'] = 'failed'
+                    job['error'] = str(e)
+                    self._save(job)
+                print(f"Key rotation {job['id']} failed: {e}")
+            finally:
+                invalidate_status_snapshot()
+
+    def _run_clients(self, job):
+        clients = job['clients']
+
+        # 1. 进程内生成新密钥
+        if job['stage'] == 'planned':
+            for item in clients.values():
+                if 'public_key' not in item:
+                    item['private_key'], item['public_key'] = generate_keypair()
+            self._advance(job, 'keys')
+
+        # 2. 每个接口一次配置写入和一条 wg set
+        if job['stage'] == 'keys':
+            for iface_name, iface_clients in self._by_interface(job).items():
+                iface = get_interface(iface_name)
+                if iface is None:
+                    for item in iface_clients.values():
+                        item['missing'] = True
+                    continue
+                before = audit.snapshot([iface])
+                _rekey_interface(iface, iface_clients, job['grace'] > 0)
+                rotated = {name: item for name, item in iface_clients.items() if not item.get('missing')}
+                audit.record('client.rekey', iface_name, list(rotated),
+                             [item['public_key'] for item in rotated.values()], before,
+                             actor=f"rotation:{job['id']}", old_public_keys=[item['old_public_key']
+                                                                            for item in rotated.values()])
+                quotas.rekey({name: item['public_key'] for name, item in rotated.items()})
+                replication.record({
+                    'op': 'rekey',
+                    'interface': iface_name,
+                    'clients': {name: {key: item[key] for key in ('old_public_key', 'public_key', 'private_key')}
+                                for name, item in rotated.items()}
+                })
+            self._advance(job, 'applied')
+
+        # 3. 并行重写客户端文件
+        if job['stage'] == 'applied':
+            for iface_name, iface_clients in self._by_interface(job).items():
+                iface = get_interface(iface_name)
+                if iface is not None:
+                    _write_rotated_client_files(iface, iface_clients)
+            webhooks.publish_many([('client.rotate', {'name': name, 'interface': item['interface'],
+                                                      'public_key': item['public_key'], 'job': job['id']}, None)
+                                   for name, item in clients.items() if not item.get('missing')])
+            with self._lock:
+                job['stage'] = 'files'
+                self._finish_if_done(job)
+                self._save(job)
+            print(f"Key rotation {job['id']}: {len(clients)} clients rotated ({job['status']})")
+
+    def _run_server(self, job):
+        if job['stage'] == 'planned':
+            if 'private_key' not in job:
+                job['private_key'], job['public_key'] = generate_keypair()
+            self._advance(job, 'keys')
+
+        if job['stage'] == 'keys':
+            iface = get_interface(job['interface'])
+            if iface is None:
+                raise RuntimeError(f"未知接口: {job['interface']}")
+            before = audit.snapshot([iface])
+            if not _rekey_server(iface, job['old_public_key'], job['private_key']):
+                raise RuntimeError('服务端密钥已被其他操作修改，任务中止')
+            audit.record('server.rekey', iface.name, before=before, actor=f"rotation:{job['id']}",
+                         old_public_key=job['old_public_key'], public_key=job['public_key'])
+            replication.record({
+                'op': 'rekey_server',
+                'interface': iface.name,
+                'old_public_key': job['old_public_key'],
+                'private_key': job['private_key']
             })
+            webhooks.publish('server.rotate', {'interface': iface.name, 'public_key': job['public_key'],
+                                               'job': job['id']})
+            with self._lock:
+                job['stage'] = 'files'
+                self._finish_if_done(job)
+                self._save(job)
+            print(f"Key rotation {job['id']}: server key of {iface.name} rotated")
+
+    def start(self):
+        """启动时继续执行被中断的任务"""
+        with self._lock:
+            self._ensure_loaded()
+            interrupted = [job for job in self._jobs.values() if job['status'] == 'running']
+        for job in sorted(interrupted, key=lambda j: j['created']):
+            print(f"Key rotation {job['id']}: resuming from stage {job['stage']}")
+            self._launch(job)
+        with self._lock:
+            if any(job['status'] == 'grace' for job in self._jobs.values()):
+                self._ensure_watcher()
+
+    # ---------- 管理接口 ----------
+
+    def rotate_clients(self, names, scope='clients', grace=None):
+        """
+        为一批客户端创建轮换任务并在后台执行
 
-        # 验证新配置的完整性
-        if '[Interface]' not in new_config:
-            return jsonify({
-                'success': False,
-                'error': '删除操作会破坏配置文件结构（缺少[Interface]），操作已取消'
-            })
+        没有客户端配置文件（私钥不由本面板管理）或公钥重复的客户端会被跳过。
+
+        Returns:
+            dict: success 以及 job（任务摘要）或 error
+        """
+        if replication.role == 'standby':
+            return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+        names = _clean_names(names)
+        if not names:
+            return {'success': False, 'error': '客户端名称无效'}
+
+        by_iface, not_found = _group_by_interface(names)
+        clients = {}
+        skipped = []
+        for iface, iface_names in by_iface.items():
+            index = iface.read_index()
+            for name in iface_names:
+                spans = [index.peers[i] for i in index.find(name)]
+                if (len(spans) != 1 or not spans[0].public_key
+                        or not os.path.exists(os.path.join(iface.client_dir, f'{name}.conf'))):
+                    skipped.append(name)
+                    continue
+                clients[name] = {'interface': iface.name, 'old_public_key': spans[0].public_key}
+        if not clients:
+            return {'success': False, 'error': '没有可轮换的客户端', 'skipped': skipped, 'not_found': not_found}
+
+        # 同一客户端上一次轮换仍在宽限期内时先完成切换
+        with self._lock:
+            self._ensure_loaded()
+            for job in [j for j in self._jobs.values() if j['status'] == 'grace']:
+                pending = [name for name in clients if name in job['clients']]
+                if pending:
+                    self._cutover(job, pending)
+
+        job = self._create('clients', scope, grace, clients=clients, skipped=skipped, not_found=not_found)
+        audit.record('keys.rotate', peers=list(clients), job=job['id'], scope=scope)
+        return {'success': True, 'job': self.summary(job)}
+
+    def rotate_server(self, interface=None):
+        """为接口创建服务端密钥轮换任务（所有客户端配置随之更新，旧密钥立即失效）"""
+        if replication.role == 'standby':
+            return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+        iface = get_interface(interface)
+        if iface is None:
+            return {'success': False, 'error': f'未知接口: {interface}'}
+        iface.invalidate()
+        index = iface.read_index()
+        match = _CONF_PRIVATE_KEY_RE.search(index.interface_text) if index else None
+        if match is None:
+            return {'success': False, 'error': f'无法读取 {iface.conf} 中的 PrivateKey'}
+        job = self._create('server', f'server:{iface.name}', 0, interface=iface.name, clients={},
+                           old_public_key=public_key_from_private(match.group(2)))
+        audit.record('keys.rotate', iface.name, job=job['id'], scope=job['scope'])
+        return {'success': True, 'job': self.summary(job)}
+
+    def resume(self, job_id):
+        """重新执行中断或失败的任务"""
+        with self._lock:
+            self._ensure_loaded()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return {'success': False, 'error': f'任务不存在: {job_id}'}
+            if job['status'] not in ('running', 'failed'):
+                return {'success': False, 'error': f"任务状态为 {job['status']}，无需恢复"}
+            job['status'] = 'running'
+            job.pop('error', None)
+            self._save(job)
+        self._launch(job)
+        return {'success': True, 'job': self.summary(job)}
 
-        # 验证配置文件基本结构
-        validation_errors = []
-
-        # 检查是否有必需的Interface配置项
-        if 'PrivateKey' not in new_config:
-            validation_errors.append('缺少PrivateKey')
-        if 'Address' not in new_config:
-            validation_errors.append('缺少Address')
-
-        # 检查剩余的peer块是否完整
-        remaining_peers = re.findall(r'\[Peer\](.*?)(?=\[Peer\]|$)', new_config, re.DOTALL)
-        for i, peer in enumerate(remaining_peers):
-            if 'PublicKey' not in peer:
-                validation_errors.append(f'Peer {i+1} 缺少PublicKey')
-            if 'AllowedIPs' not in peer:
-                validation_errors.append(f'Peer {i+1} 缺少AllowedIPs')
-
-        if validation_errors:
-            return jsonify({
-                'success': False,
-                'error': f'删除后配置验证失败: {", ".join(validation_errors)}。操作已取消，配置未修改。'
+    @staticmethod
+    def summary(job, detail=False):
+        """任务摘要（不包含私钥）"""
+        clients = job.get('clients', {})
+        data = {
+            'id': job['id'],
+            'kind': job['kind'],
+            'scope': job['scope'],
+            'status': job['status'],
+            'stage': job['stage'],
+            'created': job['created'],
+            'updated': job.get('updated'),
+            'grace_until': job.get('grace_until'),
+            'error': job.get('error'),
+            'total': len(clients),
+            'cutover': sum(1 for item in clients.values() if item.get('cutover')),
+            'missing': [name for name, item in clients.items() if item.get('missing')],
+            'skipped': job.get('skipped', []),
+            'not_found': job.get('not_found', [])
+        }
+        if job['kind'] == 'server':
+            data['interface'] = job['interface']
+            data['public_key'] = job.get('public_key')
+        if detail:
+            data['clients'] = {name: {'interface': item['interface'], 'public_key': item.get('public_key'),
+                                      'cutover': bool(item.get('cutover'))}
+                               for name, item in clients.items()}
+        return data
+
+    def get(self, job_id):
+        with self._lock:
+            self._ensure_loaded()
+            job = self._jobs.get(job_id)
+            return self.summary(job, detail=True) if job else None
+
+    def list_jobs(self, limit=50):
+        with self._lock:
+            self._ensure_loaded()
+            jobs = sorted(self._jobs.values(), key=lambda j: j['created'], reverse=True)[:limit]
+            return [self.summary(job) for job in jobs]
+
+    # ---------- 宽限期切换 ----------
+
+    def _cutover(self, job, names):
+        for iface_name, iface_clients in self._by_interface(job, set(names)).items():
+            iface = get_interface(iface_name)
+            if iface is not None and not _cutover_interface(iface, iface_clients):
+                continue  # 失败的接口下次采集时重试
+            for item in iface_clients.values():
+                item['cutover'] = True
+        self._finish_if_done(job)
+        self._save(job)
+
+    def _cutover_ready(self, handshakes, now):
+        """切换新公钥已握手（handshakes: {公钥: 最后握手时间}）或宽限期到期的客户端，需持有 _lock"""
+        for job in [job for job in self._jobs.values() if job['status'] == 'grace']:
+            expired = now >= job.get('grace_until', 0)
+            ready = [name for name, item in job['clients'].items()
+                     if not item.get('cutover') and not item.get('missing')
+                     and (expired or handshakes.get(item['public_key'], 0) >= job['created'])]
+            if ready:
+                self._cutover(job, ready)
+
+    def observe(self, snapshot):
+        """快照回调：新公钥已握手或宽限期到期的客户端切换到新密钥；到期时发起定期轮换"""
+        now = int(snapshot.generated_at)
+        with self._lock:
+            self._ensure_loaded()
+            if any(job['status'] == 'grace' for job in self._jobs.values()):
+                self._cutover_ready({client.public_key: client.handshake for client in snapshot.clients}, now)
+        self._maybe_schedule(now)
+
+    def _ensure_watcher(self):
+        if self._watcher is None and KEY_ROTATION_HANDSHAKE_POLL > 0:
+            self._watcher = threading.Thread(target=self._watch_handshakes, daemon=True, name='rotation-handshakes')
+            self._watcher.start()
+
+    def _watch_handshakes(self):
+        """
+        宽限期内每 KEY_ROTATION_HANDSHAKE_POLL 秒读取等待切换的接口的 wg show latest-handshakes
+
+        新公钥握手后立即切换，不等下一次状态采集：宽限期中的新公钥没有 AllowedIPs，
+        已换用新配置的客户端在切换前能握手但无法传输数据。没有宽限期任务时线程退出。
+        """
+        while True:
+            time.sleep(KEY_ROTATION_HANDSHAKE_POLL)
+            with self._lock:
+                interfaces = {item['interface'] for job in self._jobs.values() if job['status'] == 'grace'
+                              for item in job['clients'].values()
+                              if not item.get('cutover') and not item.get('missing')}
+                if not interfaces:
+                    self._watcher = None
+                    return
+            handshakes = {}
+            for name in interfaces:
+                result = run_command(['wg', 'show', name, 'latest-handshakes'], use_sudo=False)
+                for line in result['stdout'].splitlines() if result['success'] else ():
+                    public_key, _, timestamp = line.partition('\t')
+                    if timestamp.strip().isdigit():
+                        handshakes[public_key] = int(timestamp)
+            try:
+                with self._lock:
+                    self._cutover_ready(handshakes, int(time.time()))
+            except Exception as e:
+                print(f"Key rotation: handshake check failed: {e}")
+
+    def grace_peers(self, interface):
+        """本接口上处于宽限期的客户端 [(旧公钥, 新公钥)]：新公钥不带 AllowedIPs，旧公钥仍持有"""
+        with self._lock:
+            self._ensure_loaded()
+            return [(item['old_public_key'], item['public_key'])
+                    for job in self._jobs.values() if job['status'] in ('running', 'grace')
+                    for item in job.get('clients', {}).values()
+                    if item.get('interface') == interface and 'allowed_ips' in item
+                    and not item.get('cutover') and not item.get('missing')]
+
+    def on_reload(self, iface):
+        """syncconf 按配置同步运行时，旧公钥随之移除：本接口上等待切换的客户端视为已切换"""
+        with self._lock:
+            self._ensure_loaded()
+            for job in self._jobs.values():
+                if job['status'] not in ('running', 'grace'):
+                    continue
+                changed = False
+                for item in job['clients'].values():
+                    if item['interface'] == iface.name and 'public_key' in item and not item.get('cutover'):
+                        item['cutover'] = True
+                        changed = True
+                if changed:
+                    if job['status'] == 'grace':
+                        self._finish_if_done(job)
+                    self._save(job)
+
+    def _maybe_schedule(self, now):
+        """定期轮换：距上次定期轮换超过 KEY_ROTATION_INTERVAL_DAYS 时轮换全部客户端"""
+        if KEY_ROTATION_INTERVAL_DAYS <= 0 or replication.role == 'standby':
+            return
+        with self._lock:
+            if self._next_scheduled is None:
+                try:
+                    with open(self.state_path) as f:
+                        last = json.load(f).get('last_scheduled')
+                except (OSError, ValueError):
+                    last = None
+                if last is None:
+                    # 首次启用时从现在开始计时
+                    last = now
+                    self._save_schedule(last)
+                self._next_scheduled = last + KEY_ROTATION_INTERVAL_DAYS * 86400
+            if now < self._next_scheduled or any(job['status'] == 'running' for job in self._jobs.values()):
+                return
+            self._save_schedule(now)
+            self._next_scheduled = now + KEY_ROTATION_INTERVAL_DAYS * 86400
+        names = configured_client_names()
+        if names:
+            result = self.rotate_clients(names, scope='scheduled')
+            print(f"Key rotation: scheduled rotation started: {result.get('job', {}).get('id') or result.get('error')}")
+
+    def _save_schedule(self, last):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'last_scheduled': last}, f)
+        os.replace(temp_path, self.state_path)
+
+
+rotations = KeyRotator(ROTATION_DIR)
+register_snapshot_hook(rotations.observe)
+_reload_hooks.append(rotations.on_reload)
+
+
+@app.route('/api/keys/rotate', methods=['POST'])
+@login_required
+def api_rotate_keys():
+    """
+    密钥轮换：{"scope": "clients", "names": [...]} / {"scope": "group", "group": "销售部"} /
+    {"scope": "all", "interface": "wg0"} / {"scope": "server", "interface": "wg0"}，可选 "grace"（秒）
+    """
+    data = request.json or {}
+    scope = data.get('scope', 'clients')
+    grace = data.get('grace')
+    if grace is not None and not isinstance(grace, (int, float)):
+        return jsonify({'success': False, 'error': 'grace 必须是秒数'}), 400
+    if scope == 'server':
+        return jsonify(rotations.rotate_server(data.get('interface')))
+    if scope == 'group':
+        names = clients_in_group(data.get('group'))
+        scope = f"group:{data.get('group')}"
+    elif scope == 'all':
+        names = configured_client_names(data.get('interface'))
+    elif scope == 'clients':
+        names = data.get('names')
+    else:
+        return jsonify({'success': False, 'error': f'未知范围: {scope}'}), 400
+    return jsonify(rotations.rotate_clients(names, scope=scope, grace=grace))
+
+
+@app.route('/api/keys/rotations')
+@login_required
+def api_rotation_jobs():
+    """最近的密钥轮换任务"""
+    return jsonify({'success': True, 'jobs': rotations.list_jobs()})
+
+
+@app.route('/api/keys/rotations/<job_id>')
+@login_required
+def api_rotation_job(job_id):
+    """单个轮换任务的进度"""
+    job = rotations.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'任务不存在: {job_id}'}), 404
+    return jsonify({'success': True, 'job': job})
+
+
+@app.route('/api/keys/rotations/<job_id>/resume', methods=['POST'])
+@login_required
+def api_resume_rotation(job_id):
+    """继续执行中断或失败的轮换任务"""
+    return jsonify(rotations.resume(job_id))
+
+
+# ==================== 服务端地址变化 ====================
+
+ENDPOINT_CHECK_INTERVAL = float(os.environ.get('ENDPOINT_CHECK_INTERVAL', '300'))   # 重新探测服务端地址的间隔（秒），0 只在路由变化时探测
+ENDPOINT_ROUTE_DEBOUNCE = 2                                                         # 路由变化后等待的秒数，合并连续的通知
+
+_CONF_ENDPOINT_RE = re.compile(r'^(\s*Endpoint\s*=\s*)(\[[^\]]*\]|[^\s:]+):(\d+)', re.MULTILINE)
+
+
+def _replace_endpoint(path, host):
+    """把客户端配置的 Endpoint 改为新地址（保留端口，幂等），返回是否修改"""
+    config = _read_private_file(path)
+    if not config:
+        return False
+    new_config = _CONF_ENDPOINT_RE.sub(lambda m: m.group(1) + format_endpoint(host, m.group(3)), config, count=1)
+    if new_config == config:
+        return False
+    _write_private_file(path, new_config)
+    return True
+
+
+def rewrite_client_endpoints(host):
+    """在线程池中批量重写所有接口客户端配置的 Endpoint，返回修改的文件数"""
+    futures = []
+    for iface in INTERFACES.values():
+        try:
+            filenames = [name for name in os.listdir(iface.client_dir)
+                         if name.endswith('.conf') and CLIENT_FILE_PATTERN.fullmatch(name)]
+        except OSError:
+            continue
+        futures += [_rotation_pool.submit(_replace_endpoint, os.path.join(iface.client_dir, name), host)
+                    for name in filenames]
+    return sum(future.result() for future in futures)
+
+
+class EndpointMonitor:
+    """
+    服务端地址变化检测
+
+    每 ENDPOINT_CHECK_INTERVAL 秒以及 ip monitor route 报告路由变化时重新探测
+    （见 wgcore.EndpointDiscovery），地址变化时一次性重写全部客户端配置并发送
+    server.endpoint 通知。与 endpoint.json 中记录的地址比较，停机期间地址变化或
+    修改了 WG_ENDPOINT 在启动后的第一次检查中处理。备用节点不重写客户端配置。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+        self.last_check = None
+        self.last_change = None
+
+    def check(self, force_rewrite=False):
+        """
+        探测一次，地址变化（或 force_rewrite）时重写客户端配置
+
+        Returns:
+            dict: success、host、changed、updated（重写的文件数）
+        """
+        with self._lock:
+            old = endpoint.cached()
+            host, source = endpoint.discover()
+            self.last_check = int(time.time())
+            if host is None:
+                return {'success': False, 'error': '无法确定服务端地址', 'host': old}
+
+            changed = host != old
+            updated = 0
+            if (changed or force_rewrite) and old is not None and replication.role != 'standby':
+                updated = rewrite_client_endpoints(host)
+            if changed or source != endpoint.source:
+                endpoint.update(host, source)
+            if changed:
+                self.last_change = {'ts': self.last_check, 'old': old, 'new': host, 'updated': updated}
+                print(f"Endpoint: {old} -> {host} ({source}), {updated} client configs updated")
+                if old is not None:
+                    webhooks.publish('server.endpoint', {'old': old, 'new': host, 'updated': updated})
+                    audit.record('server.endpoint', old=old, new=host, source=source, updated=updated)
+            return {'success': True, 'host': host, 'source': source, 'changed': changed, 'updated': updated}
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._run, daemon=True, name='endpoint-monitor').start()
+        if not endpoint.override:
+            threading.Thread(target=self._watch_routes, daemon=True, name='endpoint-routes').start()
+
+    def _run(self):
+        # 固定地址时启动后补做一次重写：wgm 等其他进程可能已先记录了新的 WG_ENDPOINT
+        force_rewrite = bool(endpoint.override)
+        while True:
+            try:
+                self.check(force_rewrite)
+                force_rewrite = False
+            except Exception as e:
+                print(f"Endpoint monitor: {e}")
+            if endpoint.override:
+                return
+            self._wake.wait(ENDPOINT_CHECK_INTERVAL if ENDPOINT_CHECK_INTERVAL > 0 else None)
+            time.sleep(ENDPOINT_ROUTE_DEBOUNCE)
+            self._wake.clear()
+
+    def _watch_routes(self):
+        """ip monitor route 每输出一行（路由增删）就唤醒探测线程"""
+        while True:
+            try:
+                proc = subprocess.Popen(['ip', 'monitor', 'route'], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True)
+            except OSError as e:
+                print(f"Endpoint monitor: route notifications unavailable ({e}), polling only")
+                return
+            with proc:
+                for _ in proc.stdout:
+                    self._wake.set()
+            time.sleep(30)
+
+    def status(self):
+        return dict(endpoint.status(), last_check=self.last_check, last_change=self.last_change,
+                    check_interval=ENDPOINT_CHECK_INTERVAL)
+
+
+endpoint_monitor = EndpointMonitor()
+
+
+@app.route('/api/endpoint')
+@login_required
+def api_endpoint():
+    """当前服务端地址、来源和最近一次变化"""
+    return jsonify({'success': True, **endpoint_monitor.status()})
+
+
+@app.route('/api/endpoint/refresh', methods=['POST'])
+@login_required
+def api_endpoint_refresh():
+    """立即重新探测，地址变化时批量更新客户端配置"""
+    return jsonify(endpoint_monitor.check())
+
+
+# ==================== 配置漂移 ====================
+
+DRIFT_CHECK_INTERVAL = float(os.environ.get('DRIFT_CHECK_INTERVAL', '60'))                 # 定期对比配置和运行时的间隔（秒），0 只在配置文件变化时对比
+DRIFT_SETTLE = float(os.environ.get('DRIFT_SETTLE', '2'))                                 # 配置文件变化后等待的秒数，合并连续写入
+DRIFT_AUTO_RECONCILE = os.environ.get('DRIFT_AUTO_RECONCILE', 'false').lower() in ('1', 'true', 'yes')  # 发现漂移时自动修正
+DRIFT_POLL_INTERVAL = 2                                                                    # 没有 inotifywait 时比较配置文件 mtime 的间隔（秒）
+
+
+def expected_runtime_peers(iface, index):
+    """
+    按配置推算运行时应有的 peer
+
+    已禁用和超出配额暂停的客户端不在运行时中；密钥轮换宽限期内新公钥不带 AllowedIPs，
+    旧公钥继续持有配置中的 AllowedIPs。
+
+    Returns:
+        dict: {公钥: AllowedIPs}
+    """
+    suspended = quotas.suspended_public_keys(iface.name)
+    expected = {span.public_key: span.allowed_ips or '' for span in index.peers
+                if span.public_key and not span.disabled and span.public_key not in suspended}
+    for old_public_key, public_key in rotations.grace_peers(iface.name):
+        if public_key in expected:
+            expected[old_public_key] = expected[public_key]
+            expected[public_key] = ''
+    return expected
+
+
+class DriftMonitor:
+    """
+    配置文件和内核 peer 的漂移检测
+
+    inotifywait 监听 WG_DIR（没有 inotify-tools 时每 DRIFT_POLL_INTERVAL 秒比较 mtime），
+    接口配置文件被其他进程或手工修改时立即清除该接口的配置缓存和状态快照，
+    DRIFT_SETTLE 秒后对比；另外每 DRIFT_CHECK_INTERVAL 秒对比全部接口，
+    发现 wg set、失败的 syncconf 等只改变了内核的情况。
+
+    对比按公钥和 AllowedIPs 进行（见 wgcore.diff_peers）。修正时每个接口一条 wg set，
+    只改动有差异的 peer，不整体同步，其他客户端的会话不受影响。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._due = {}        # {接口名: 应当对比的 monotonic 时间}
+        self._reports = {}    # {接口名: 最近一次对比结果}
+        self._started = False
+        self.watch_mode = None
+        self.last_reconcile = None
+
+    def notify(self, iface):
+        """配置文件变化，或运行时可能与配置不一致：清除缓存，稍后对比"""
+        if iface is None:
+            return
+        if iface.invalidate_if_changed():
+            invalidate_status_snapshot()
+        with self._lock:
+            self._due.setdefault(iface.name, time.monotonic() + DRIFT_SETTLE)
+        self._wake.set()
+
+    def _compare(self, iface):
+        """
+        对比一个接口
+
+        Returns:
+            tuple: (结果字典, apply_peers 修改列表)
+        """
+        report = {'interface': iface.name, 'checked': int(time.time()), 'in_sync': None, 'drift': []}
+        index = iface.read_index()
+        if index is None:
+            report['error'] = f'无法读取 {iface.conf}'
+            return report, []
+        if 'placeholder' in index.text:
+            report['error'] = '配置尚未初始化'
+            return report, []
+        try:
+            running = get_runtime_allowed_ips(iface.name)
+        except BackendError as e:
+            report['error'] = f'WireGuard 后端不可用: {e}'
+            return report, []
+        if running is None:
+            report['error'] = '接口未启动'
+            return report, []
+
+        drift, changes = diff_peers(expected_runtime_peers(iface, index), running)
+        names = {span.public_key: span.client_name for span in index.peers if span.public_key}
+        for old_public_key, public_key in rotations.grace_peers(iface.name):
+            names.setdefault(old_public_key, names.get(public_key))
+        for item in drift:
+            item['name'] = names.get(item['public_key'])
+        report['in_sync'] = not drift
+        report['drift'] = drift
+        return report, changes
+
+    def check(self, iface, auto=False):
+        """对比一个接口并记录结果；auto 时按 DRIFT_AUTO_RECONCILE 自动修正"""
+        report, _ = self._compare(iface)
+        with self._lock:
+            previous = self._reports.get(iface.name)
+            self._reports[iface.name] = report
+        if report['drift'] and (previous is None or previous['drift'] != report['drift']):
+            kinds = {}
+            for item in report['drift']:
+                kinds[item['kind']] = kinds.get(item['kind'], 0) + 1
+            print(f"Drift: {iface.name} differs from {iface.conf}: {kinds}")
+            if auto and DRIFT_AUTO_RECONCILE:
+                return self.reconcile(iface.name, actor='system')['interfaces'][0]
+        return report
+
+    def check_all(self, interface=None):
+        return [self.check(iface) for iface in INTERFACES.values() if not interface or iface.name == interface]
+
+    def reconcile(self, interface=None, actor=None):
+        """
+        修正漂移：每个接口重新对比后用一条 wg set 应用最小修改
+
+        Returns:
+            dict: success 以及各接口的 applied（修改的 peer 数）或 error
+        """
+        results = []
+        for iface in INTERFACES.values():
+            if interface and iface.name != interface:
+                continue
+            before = audit.snapshot([iface])
+            report, changes = self._compare(iface)
+            if report.get('error'):
+                results.append(report)
+                continue
+            if changes:
+                result = iface.apply_peers(changes)
+                if not result['success']:
+                    report['error'] = f"运行时更新失败: {(result.get('stderr') or result.get('error') or '').strip()}"
+                    results.append(report)
+                    continue
+                invalidate_status_snapshot()
+                drift = report['drift']
+                audit.record('drift.reconcile', iface.name, sorted({item['name'] for item in drift if item['name']}),
+                             [item['public_key'] for item in drift], before, actor=actor,
+                             drift=[{'public_key': item['public_key'], 'kind': item['kind']} for item in drift])
+                print(f"Drift: reconciled {len(drift)} peers on {iface.name}")
+                report, _ = self._compare(iface)
+                report['applied'] = len(drift)
+            else:
+                report['applied'] = 0
+            with self._lock:
+                self._reports[iface.name] = report
+            results.append(report)
+        if interface and not results:
+            return {'success': False, 'error': f'未知接口: {interface}'}
+        self.last_reconcile = int(time.time())
+        return {'success': all(not report.get('error') for report in results), 'interfaces': results}
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._run, daemon=True, name='drift-monitor').start()
+        threading.Thread(target=self._watch_files, daemon=True, name='drift-watch').start()
+
+    def _run(self):
+        next_full = time.monotonic() + DRIFT_SETTLE
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                due = [name for name, at in self._due.items() if at <= now]
+                for name in due:
+                    del self._due[name]
+                deadlines = list(self._due.values())
+            if DRIFT_CHECK_INTERVAL > 0:
+                if now >= next_full:
+                    due = list(INTERFACES)
+                    next_full = now + DRIFT_CHECK_INTERVAL
+                deadlines.append(next_full)
+            for name in due:
+                try:
+                    self.check(INTERFACES[name], auto=True)
+                except Exception as e:
+                    print(f"Drift monitor: {name}: {e}")
+            self._wake.wait(max(0, min(deadlines) - time.monotonic()) if deadlines else None)
+
+    def _watch_files(self):
+        """inotifywait 每报告一次接口配置文件的写入、替换或删除就通知一次，不可用时轮询 mtime"""
+        watched = {os.path.basename(iface.conf): iface for iface in INTERFACES.values()}
+        try:
+            proc = subprocess.Popen(['inotifywait', '-m', '-q', '-e', 'close_write', '-e', 'moved_to',
+                                     '-e', 'delete', '-e', 'attrib', '--format', '%f', WG_DIR],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        except OSError:
+            proc = None
+        if proc is not None:
+            self.watch_mode = 'inotify'
+            with proc:
+                for line in proc.stdout:
+                    self.notify(watched.get(line.strip()))
+            print("Drift monitor: inotifywait exited, polling config files")
+
+        self.watch_mode = 'poll'
+        mtimes = {}
+        while True:
+            for filename, iface in watched.items():
+                try:
+                    mtime = os.stat(iface.conf).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if filename in mtimes and mtimes[filename] != mtime:
+                    self.notify(iface)
+                mtimes[filename] = mtime
+            time.sleep(DRIFT_POLL_INTERVAL)
+
+    def status(self):
+        with self._lock:
+            reports = [self._reports[name] for name in INTERFACES if name in self._reports]
+        return {'watch': self.watch_mode, 'check_interval': DRIFT_CHECK_INTERVAL,
+                'auto_reconcile': DRIFT_AUTO_RECONCILE, 'last_reconcile': self.last_reconcile,
+                'interfaces': reports}
+
+
+drift_monitor = DriftMonitor()
+
+
+@app.route('/api/drift')
+@login_required
+def api_drift():
+    """配置与运行时的差异：?interface=；cached=1 时返回后台最近一次对比结果，不重新对比"""
+    interface = request.args.get('interface') or None
+    if interface and get_interface(interface) is None:
+        return jsonify({'success': False, 'error': f'未知接口: {interface}'}), 404
+    if request.args.get('cached', '').lower() not in ('1', 'true', 'yes'):
+        drift_monitor.check_all(interface)
+    status = drift_monitor.status()
+    if interface:
+        status['interfaces'] = [report for report in status['interfaces'] if report['interface'] == interface]
+    return jsonify({'success': True, **status})
+
+
+@app.route('/api/drift/reconcile', methods=['POST'])
+@login_required
+def api_drift_reconcile():
+    """按配置修正运行时差异：{"interface": "wg0"}（可选，默认全部接口）"""
+    data = request.json or {}
+    return jsonify(drift_monitor.reconcile(data.get('interface') or None))
+
+
+# ==================== 过期客户端清理 ====================
+
+REAPER_IDLE_DAYS = float(os.environ.get('REAPER_IDLE_DAYS', '0'))                        # 超过 N 天没有握手视为过期，0 关闭
+REAPER_NEVER_CONNECTED_DAYS = float(os.environ.get('REAPER_NEVER_CONNECTED_DAYS', '0'))  # 出现 M 天后仍从未连接视为过期，0 关闭
+REAPER_AUTO = os.environ.get('REAPER_AUTO', 'false').lower() in ('1', 'true', 'yes')      # 采集时自动清理，否则只列出候选
+REAPER_EXEMPT_TAG = os.environ.get('REAPER_EXEMPT_TAG', 'keep')                          # 带此标签的客户端不清理
+REAPER_CHECK_INTERVAL = float(os.environ.get('REAPER_CHECK_INTERVAL', '3600'))           # 自动清理的检查间隔（秒）
+REAPER_ARCHIVE_DIR = f"{WG_DIR}/archive"
+
+
+class StalePeerReaper:
+    """
+    过期客户端清理
+
+    按在线状态跟踪记录的最后握手时间判断：超过 idle_days 天没有握手，或首次出现
+    never_connected_days 天后仍从未握手。已禁用和带 REAPER_EXEMPT_TAG 标签的客户端不清理。
+    清理前把 peer 块、客户端文件和流量记录归档到 archive/reaped-<时间>.jsonl，
+    然后每个接口一次配置写入、一条 wg set 批量删除。
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self._lock = threading.Lock()
+        self._next_check = 0
+        self.last_run = None
+
+    @staticmethod
+    def policy(idle_days=None, never_connected_days=None):
+        return {
+            'idle_days': REAPER_IDLE_DAYS if idle_days is None else float(idle_days),
+            'never_connected_days': (REAPER_NEVER_CONNECTED_DAYS if never_connected_days is None
+                                     else float(never_connected_days))
+        }
+
+    def candidates(self, snapshot, policy):
+        """按策略列出过期客户端（不做任何修改）"""
+        now = int(snapshot.generated_at)
+        idle_seconds = policy['idle_days'] * 86400
+        never_seconds = policy['never_connected_days'] * 86400
+        if idle_seconds <= 0 and never_seconds <= 0:
+            return []
+
+        activity = presence.activity()
+        result = []
+        for client in snapshot.clients:
+            if client.disabled or REAPER_EXEMPT_TAG in client.tags:
+                continue
+            first_seen, last_seen = activity.get((client.interface, client.public_key), (now, 0))
+            last_handshake = max(client.handshake, last_seen)
+            if last_handshake:
+                if idle_seconds <= 0 or now - last_handshake < idle_seconds:
+                    continue
+                reason = 'idle'
+            else:
+                if never_seconds <= 0 or now - first_seen < never_seconds:
+                    continue
+                reason = 'never_connected'
+            result.append({
+                'name': client.name,
+                'interface': client.interface,
+                'public_key': client.public_key,
+                'ip': client.ip,
+                'group': client.group,
+                'reason': reason,
+                'last_handshake': last_handshake,
+                'first_seen': first_seen,
+                'idle_days': round((now - (last_handshake or first_seen)) / 86400, 1)
             })
+        return result
 
-        # 备份配置
-        backup_name = f'{WG_CONF}.backup.{datetime.now().strftime("%Y%m%d_%H%M%S")}'
-        backup_result = run_command(['cp', WG_CONF, backup_name])
-        if not backup_result['success']:
-            return jsonify({'success': False, 'error': '无法创建配置备份'})
+    def _archive(self, candidates, now):
+        """把即将删除的客户端写入归档（权限 600，包含私钥），返回归档路径"""
+        traffic_data = load_traffic_data()
+        by_name = {item['name']: item for item in candidates}
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"reaped-{datetime.fromtimestamp(now).strftime('%Y%m%d_%H%M%S')}.jsonl")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, 'a') as f:
+            for iface in INTERFACES.values():
+                index = iface.read_index()
+                if index is None:
+                    continue
+                for span in index.peers:
+                    item = by_name.get(span.client_name)
+                    if item is None or item['interface'] != iface.name:
+                        continue
+                    files = {}
+                    for suffix in ('.conf', '_private.key', '_public.key'):
+                        content = _read_private_file(os.path.join(iface.client_dir, f"{item['name']}{suffix}"))
+                        if content is not None:
+                            files[f"{item['name']}{suffix}"] = content
+                    traffic = traffic_data.get(item['name'])
+                    f.write(json.dumps(dict(item, archived_at=now, block=index.block_text(span), files=files,
+                                            traffic=traffic.to_dict() if traffic else None),
+                                       ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return path
+
+    def reap(self, names=None, policy=None, snapshot=None):
+        """
+        归档并批量删除过期客户端
 
-        # 写入新配置
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            f.write(new_config)
-            temp_file = f.name
+        Args:
+            names: 只清理其中的客户端（仍需满足策略），None 表示全部候选
+            snapshot: 用于判断的快照，默认重新采集；快照已过期（stale）时不清理
 
-        copy_result = run_command(['cp', temp_file, WG_CONF])
-        os.unlink(temp_file)
+        Returns:
+            dict: success、reaped、archive，失败时包含 error
+        """
+        if replication.role == 'standby':
+            return {'success': False, 'error': '当前节点为备用节点，请在主节点上操作'}
+        with self._lock:
+            if snapshot is None:
+                try:
+                    snapshot = get_status_snapshot(max_age=0)
+                except BackendError as e:
+                    return {'success': False, 'error': f'WireGuard 后端不可用: {e}'}
+            if snapshot.stale:
+                # 过期快照中的握手时间不可靠，不能据此永久删除客户端
+                return {'success': False, 'error': f'状态快照已过期（{snapshot.error}），未清理任何客户端'}
+            candidates = self.candidates(snapshot, policy or self.policy())
+            if names is not None:
+                wanted = set(_clean_names(names))
+                candidates = [item for item in candidates if item['name'] in wanted]
+            if not candidates:
+                return {'success': True, 'reaped': [], 'archive': None}
+
+            now = int(time.time())
+            archive_path = self._archive(candidates, now)
+            result = delete_clients([item['name'] for item in candidates])
+            reaped = result.pop('deleted', [])
+            result.update(reaped=reaped, archive=archive_path)
+            self.last_run = {'ts': now, 'reaped': len(reaped), 'archive': archive_path}
+            print(f"Reaper: removed {len(reaped)} stale clients, archived to {archive_path}")
+            return result
+
+    def observe(self, snapshot):
+        """快照回调：开启 REAPER_AUTO 时按检查间隔自动清理"""
+        if not REAPER_AUTO or snapshot.stale or snapshot.generated_at < self._next_check:
+            return
+        self._next_check = snapshot.generated_at + REAPER_CHECK_INTERVAL
+        if replication.role == 'standby':
+            return
+        self.reap(snapshot=snapshot)
+
+
+reaper = StalePeerReaper(REAPER_ARCHIVE_DIR)
+register_snapshot_hook(reaper.observe)
+
+
+def _reaper_policy_args(source):
+    return StalePeerReaper.policy(source.get('idle_days'), source.get('never_connected_days'))
+
+
+@app.route('/api/reaper/candidates')
+@login_required
+def api_reaper_candidates():
+    """预览（dry-run）：?idle_days=&never_connected_days= 覆盖默认策略"""
+    try:
+        policy = _reaper_policy_args(request.args)
+    except ValueError:
+        return jsonify({'success': False, 'error': '天数必须是数字'}), 400
+    candidates = reaper.candidates(get_status_snapshot(), policy)
+    return jsonify({'success': True, 'policy': policy, 'auto': REAPER_AUTO,
+                    'candidates': candidates, 'last_run': reaper.last_run})
+
+
+@app.route('/api/reaper/run', methods=['POST'])
+@login_required
+def api_reaper_run():
+    """归档并删除过期客户端：{"names": [...] 可选, "idle_days": 90, "never_connected_days": 30}"""
+    data = request.json or {}
+    try:
+        policy = _reaper_policy_args(data)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '天数必须是数字'}), 400
+    return jsonify(reaper.reap(data.get('names'), policy))
+
+
+# ==================== 批量导出 ====================
+
+@app.route('/api/clients/export')
+@returns_secrets
+@login_required
+def api_export_clients():
+    """流式导出客户端配置和二维码：?format=zip&group=&tag=&interface=&qr=0"""
+    if request.args.get('format', 'zip') != 'zip':
+        return jsonify({'success': False, 'error': '只支持 format=zip'}), 400
+    group = request.args.get('group') or None
+    targets = export_targets(group, request.args.get('tag') or None, request.args.get('interface') or None)
+    if not targets:
+        return jsonify({'success': False, 'error': '没有可导出的客户端'}), 404
+
+    with_qr = request.args.get('qr', '1').lower() not in ('0', 'false', 'no')
+    filename = f"wireguard-{group or 'clients'}-{datetime.now().strftime('%Y%m%d')}.zip"
+    return Response(
+        _stream_zip(_export_entries(targets, with_qr)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f"attachment; filename=\"wireguard-clients.zip\"; "
+                                   f"filename*=UTF-8''{urllib.parse.quote(filename)}",
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+# ==================== 用量历史和报表 ====================
+
+USAGE_DIR = f"{WG_DIR}/usage"
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '300'))   # 当天用量文件的写入间隔（秒）
+USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', '400'))     # 用量历史保留天数
+
+USAGE_COLUMNS = ('period', 'name', 'interface', 'rx_bytes', 'tx_bytes', 'total_bytes')
+
+
+class UsageHistory:
+    """
+    按天记录的客户端用量历史
+
+    每天一个 usage/YYYY-MM-DD.jsonl，每行 [名称, 接口, 起始 rx, 起始 tx, 最新 rx, 最新 tx]
+    （累计字节计数），按名称排序。当天用量 = 最新 − 起始，起始值取前一天的最新值
+    （新客户端取当天首次采样）。当天的文件每 USAGE_FLUSH_INTERVAL 秒及跨天时整体重写。
+
+    报表按名称有序合并同一周期内各天的文件，只保存当前客户端的累加值，
+    内存占用与客户端数量和时间范围无关。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._day = None
+        self._rows = None    # 当天 {名称: [接口, 起始 rx, 起始 tx, 最新 rx, 最新 tx]}
+        self._carry = {}     # 前一天 {名称: (最新 rx, 最新 tx)}，作为当天的起始值
+        self._dirty = False
+        self._next_flush = 0
+
+    def _path(self, day):
+        return os.path.join(self.directory, f'{day}.jsonl')
+
+    def _read_day(self, day):
+        try:
+            f = open(self._path(day))
+        except OSError:
+            return
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def days(self, start=None, end=None):
+        """已有记录的日期（YYYY-MM-DD，升序），可限定范围（含两端）"""
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return []
+        days = sorted(name[:-6] for name in filenames if re.fullmatch(r'\d{4}-\d{2}-\d{2}\.jsonl', name))
+        return [day for day in days if (start is None or day >= start) and (end is None or day <= end)]
+
+    def _start_day(self, day):
+        """切换到新的一天：已有当天文件时接着记录，起始值取之前最近一天的最新值"""
+        self._day = day
+        self._rows = {row[0]: row[1:] for row in self._read_day(day)}
+        if not self._carry:
+            previous = self.days(end=day)
+            previous = [d for d in previous if d < day]
+            if previous:
+                self._carry = {row[0]: (row[4], row[5]) for row in self._read_day(previous[-1])}
+
+    def _flush(self):
+        if not self._dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(self._day)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for name in sorted(self._rows):
+                f.write(json.dumps([name] + self._rows[name], ensure_ascii=False) + '\n')
+        os.replace(temp_path, path)
+        self._dirty = False
+
+    def _prune(self, today):
+        cutoff = datetime.fromtimestamp(time.time() - USAGE_RETENTION_DAYS * 86400).strftime('%Y-%m-%d')
+        for day in self.days(end=cutoff):
+            if day < cutoff and day != today:
+                try:
+                    os.unlink(self._path(day))
+                except OSError:
+                    pass
+
+    def flush(self):
+        with self._lock:
+            if self._rows is not None:
+                self._flush()
+
+    def observe(self, snapshot):
+        """快照回调：更新当天各客户端的最新累计计数"""
+        now = snapshot.generated_at
+        day = datetime.fromtimestamp(now).strftime('%Y-%m-%d')
+        with self._lock:
+            if self._rows is None:
+                self._start_day(day)
+            elif day != self._day:
+                self._flush()
+                self._carry = {name: (row[3], row[4]) for name, row in self._rows.items()}
+                self._start_day(day)
+                self._prune(day)
+
+            for client in snapshot.clients:
+                total_rx, total_tx = client.total_rx, client.total_tx
+                row = self._rows.get(client.name)
+                if row is None:
+                    base = self._carry.get(client.name)
+                    if base is None or base[0] > total_rx or base[1] > total_tx:
+                        base = (total_rx, total_tx)
+                    self._rows[client.name] = [client.interface, base[0], base[1], total_rx, total_tx]
+                    self._dirty = True
+                elif row[3] != total_rx or row[4] != total_tx:
+                    # 计数变小（客户端被删除后同名重建）时平移起始值，保留当天已有用量
+                    if total_rx < row[3]:
+                        row[1] = total_rx - (row[3] - row[1])
+                    if total_tx < row[4]:
+                        row[2] = total_tx - (row[4] - row[2])
+                    row[3], row[4] = total_rx, total_tx
+                    self._dirty = True
+
+            if self._dirty and now >= self._next_flush:
+                self._flush()
+                self._next_flush = now + USAGE_FLUSH_INTERVAL
+
+    def iter_usage(self, start, end, granularity='day', names=None, interface=None):
+        """
+        逐行产出用量（整数字节）
+
+        Args:
+            start, end: YYYY-MM-DD（含两端）
+            granularity: day / month / total
+            names: 只包含这些客户端（集合），None 表示全部
+            interface: 只包含该接口
 
-        if not copy_result['success']:
-            return jsonify({'success': False, 'error': '无法写入新配置'})
-
-        # 删除客户端文件（仅在客户端名称有效时）
-        if len(client_name) > 0:
-            # 使用shell通配符来删除相关文件
-            client_pattern = os.path.join(CLIENT_DIR, f'{client_name}*')
-            run_command(f'rm -f {client_pattern}', shell=True)
-            # 对于Unknown-XXXXX格式，也删除可能的原始文件
-            if client_name.startswith('Unknown-'):
-                suffix_pattern = os.path.join(CLIENT_DIR, f'*{client_name.split("-")[1]}*')
-                run_command(f'rm -f {suffix_pattern}', shell=True)
-
-        # 重新加载配置并检查结果
-        # 使用两步法代替进程替换，更兼容
-        strip_result = run_command(['wg-quick', 'strip', WG_INTERFACE])
-        if strip_result['success']:
-            # 将strip结果写入临时文件
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.conf') as strip_f:
-                strip_f.write(strip_result['stdout'])
-                strip_file = strip_f.name
-
-            # 使用临时文件进行syncconf
-            reload_result = run_command(['wg', 'syncconf', WG_INTERFACE, strip_file])
-            os.unlink(strip_file)
-
-            if not reload_result['success']:
-                # 如果重新加载失败，尝试恢复最新备份 (需要shell来处理管道)
-                run_command(f'ls -t {WG_CONF}.backup.* | head -1 | xargs -I {{}} cp {{}} {WG_CONF}', shell=True)
-                return jsonify({'success': False, 'error': f'WireGuard配置重新加载失败: {reload_result.get("stderr", "未知错误")}，已恢复备份'})
+        Yields:
+            tuple: 与 USAGE_COLUMNS 对应的一行
+        """
+        self.flush()
+        period_of = {
+            'day': lambda day: day,
+            'month': lambda day: day[:7],
+            'total': lambda day: f'{start}~{end}'
+        }[granularity]
+        for period, period_days in itertools.groupby(self.days(start, end), key=period_of):
+            merged = heapq.merge(*(self._read_day(day) for day in period_days), key=lambda row: row[0])
+            for name, rows in itertools.groupby(merged, key=lambda row: row[0]):
+                if names is not None and name not in names:
+                    continue
+                rx = tx = 0
+                iface_name = None
+                for row in rows:
+                    iface_name = row[1]
+                    rx += row[4] - row[2]
+                    tx += row[5] - row[3]
+                if interface and iface_name != interface:
+                    continue
+                yield period, name, iface_name, rx, tx, rx + tx
+
+
+usage_history = UsageHistory(USAGE_DIR)
+register_snapshot_hook(usage_history.observe)
+
+
+def format_usage_rows(rows, fmt, batch=500):
+    """把用量行编码为 CSV 或 JSON Lines 文本块（每 batch 行一块）"""
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n') if fmt == 'csv' else None
+    if writer:
+        writer.writerow(USAGE_COLUMNS)
+    count = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
         else:
-            # strip失败，恢复备份 (需要shell来处理管道)
-            run_command(f'ls -t {WG_CONF}.backup.* | head -1 | xargs -I {{}} cp {{}} {WG_CONF}', shell=True)
-            return jsonify({'success': False, 'error': f'配置验证失败: {strip_result.get("stderr", "未知错误")}，已恢复备份'})
+            buffer.write(json.dumps(dict(zip(USAGE_COLUMNS, row)), ensure_ascii=False) + '\n')
+        count += 1
+        if count % batch == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
-        # 删除流量记录
-        traffic_data = load_traffic_data()
-        if client_name in traffic_data:
-            del traffic_data[client_name]
-            save_traffic_data(traffic_data)
 
-        return jsonify({
-            'success': True,
-            'message': f'客户端 "{original_client_name}" 已成功删除'
-        })
+def usage_report(start=None, end=None, granularity='day', fmt='csv', group=None, interface=None):
+    """
+    校验参数并返回用量报表的文本块生成器
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': f'删除过程中发生错误: {str(e)}'})
+    Returns:
+        tuple: (生成器, None) 或 (None, 错误信息)
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    try:
+        # 统一为补零的格式，文件名按字符串比较
+        start = datetime.strptime(start, '%Y-%m-%d').strftime('%Y-%m-%d') if start else today[:8] + '01'
+        end = datetime.strptime(end, '%Y-%m-%d').strftime('%Y-%m-%d') if end else today
+    except ValueError:
+        return None, '日期格式应为 YYYY-MM-DD'
+    if granularity not in ('day', 'month', 'total'):
+        return None, 'granularity 只支持 day / month / total'
+    if fmt not in ('csv', 'jsonl'):
+        return None, 'format 只支持 csv / jsonl'
+    names = set(clients_in_group(group)) if group else None
+    return format_usage_rows(usage_history.iter_usage(start, end, granularity, names, interface), fmt), None
+
+
+@app.route('/api/reports/usage')
+@login_required
+def api_usage_report():
+    """流式用量报表：?from=YYYY-MM-DD&to=YYYY-MM-DD&granularity=day|month|total&format=csv|jsonl&group=&interface="""
+    fmt = request.args.get('format', 'csv')
+    chunks, error = usage_report(request.args.get('from'), request.args.get('to'),
+                                 request.args.get('granularity', 'day'), fmt,
+                                 request.args.get('group') or None, request.args.get('interface') or None)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    return Response(chunks, mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="usage.{fmt}"',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.cli.command('usage-report')
+@click.option('--from', 'start', help='起始日期 YYYY-MM-DD（默认本月 1 日）')
+@click.option('--to', 'end', help='结束日期 YYYY-MM-DD（默认今天）')
+@click.option('--granularity', default='day', type=click.Choice(['day', 'month', 'total']))
+@click.option('--format', 'fmt', default='csv', type=click.Choice(['csv', 'jsonl']))
+@click.option('--group', default=None, help='只包含该分组')
+@click.option('--interface', default=None, help='只包含该接口')
+def cli_usage_report(start, end, granularity, fmt, group, interface):
+    """输出用量报表到标准输出（供 cron 使用）"""
+    chunks, error = usage_report(start, end, granularity, fmt, group, interface)
+    if error:
+        raise click.UsageError(error)
+    for chunk in chunks:
+        sys.stdout.write(chunk)
 
 
 @app.route('/api/debug/config', methods=['GET'])
+@returns_secrets
 @login_required
 def api_debug_config():
     """调试接口：查看配置文件结构"""
     try:
+        iface = get_interface(request.args.get('interface'))
+        if iface is None:
+            return jsonify({'success': False, 'error': '未知接口'})
+
         # 读取配置文件
-        config_result = run_command(['cat', WG_CONF])
-        if not config_result['success']:
+        config = iface.read_config()
+        if config is None:
             return jsonify({'success': False, 'error': '无法读取配置文件'})
 
-        config = config_result['stdout']
-
         # 解析peer块
         peer_blocks = re.findall(r'\[Peer\](.*?)(?=\[Peer\]|$)', config, re.DOTALL)
 
         debug_info = {
+            'interface': iface.name,
             'total_peers': len(peer_blocks),
             'peers': []
         }
@@ -1350,22 +3835,1294 @@ def api_debug_config():
         return jsonify({'success': False, 'error': f'调试过程中发生错误: {str(e)}'})
 
 
+# ==================== API 令牌 ====================
+
+API_TOKEN_PREFIX = 'wgm_'
+API_TOKEN_SCOPES = ('read', 'write', 'secrets')   # read：GET 请求；secrets：另可读取客户端配置和私钥；write：所有请求
+API_TOKEN_TOUCH_INTERVAL = 300           # last_used 写回文件的最小间隔（秒）
+
+
+class ApiTokenStore:
+    """
+    自动化脚本使用的 API 令牌
+
+    令牌格式为 wgm_<id>_<secret>，只返回一次，文件中只保存 SHA-256 摘要。
+    内存中按 id 索引，校验时取出记录后用 hmac.compare_digest 常量时间比较摘要，
+    不需要 bcrypt、子进程或读文件。吊销即删除记录，立即生效。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens = None   # {id: 记录}
+
+    def _load(self):
+        if self._tokens is None:
+            text = _read_private_file(self.path)
+            try:
+                self._tokens = json.loads(text) if text else {}
+            except ValueError as e:
+                print(f"Error loading API tokens: {e}")
+                self._tokens = {}
+        return self._tokens
+
+    def _save(self):
+        _write_private_file(self.path, json.dumps(self._tokens, ensure_ascii=False, indent=2))
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def _public(record):
+        return {key: value for key, value in record.items() if key != 'hash'}
+
+    def create(self, name, scopes, created_by, expires_days=None):
+        """
+        创建令牌
+
+        Returns:
+            tuple: (令牌明文, 记录)
+        """
+        now = int(time.time())
+        with self._lock:
+            tokens = self._load()
+            token_id = secrets.token_hex(4)
+            while token_id in tokens:
+                token_id = secrets.token_hex(4)
+            token = f'{API_TOKEN_PREFIX}{token_id}_{secrets.token_urlsafe(32)}'
+            record = {
+                'id': token_id,
+                'name': name,
+                'scopes': sorted(set(scopes)),
+                'hash': self._digest(token),
+                'created_at': now,
+                'created_by': created_by,
+                'expires_at': now + int(expires_days * 86400) if expires_days else None,
+                'last_used': None
+            }
+            tokens[token_id] = record
+            self._save()
+        return token, self._public(record)
+
+    def revoke(self, token_id):
+        with self._lock:
+            if self._load().pop(token_id, None) is None:
+                return False
+            self._save()
+        return True
+
+    def list_tokens(self):
+        with self._lock:
+            return sorted((self._public(r) for r in self._load().values()), key=lambda r: r['created_at'])
+
+    def verify(self, token):
+        """校验令牌，有效时返回记录，否则返回 None"""
+        token_id, _, _ = token[len(API_TOKEN_PREFIX):].partition('_')
+        record = self._load().get(token_id)
+        if record is None or not hmac.compare_digest(self._digest(token), record['hash']):
+            return None
+        now = int(time.time())
+        if record['expires_at'] and now >= record['expires_at']:
+            return None
+        if now - (record['last_used'] or 0) >= API_TOKEN_TOUCH_INTERVAL:
+            with self._lock:
+                record['last_used'] = now
+                self._save()
+        return record
+
+
+api_tokens = ApiTokenStore(API_TOKENS_FILE)
+
+
+class ApiTokenUser(UserMixin):
+    """通过 API 令牌认证的请求的当前用户"""
+
+    def __init__(self, record):
+        self.id = f"token:{record['id']}"
+        self.username = f"token:{record['name']}"
+        self.token = record
+
+
+@app.before_request
+def authenticate_request():
+    """
+    Authorization: Bearer wgm_... 的请求按 API 令牌认证并检查权限范围，不检查 CSRF；
+    其余请求照常做 CSRF 校验（@csrf_exempt 的接口除外）
+    """
+    view = app.view_functions.get(request.endpoint) if request.endpoint else None
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith(f'Bearer {API_TOKEN_PREFIX}'):
+        record = api_tokens.verify(auth[7:])
+        if record is None:
+            return jsonify({'success': False, 'error': 'API 令牌无效、已过期或已吊销'}), 401
+        if view in _secret_views:
+            required = 'secrets'
+        else:
+            required = 'read' if request.method in ('GET', 'HEAD', 'OPTIONS') else 'write'
+        # write 包含 secrets，secrets 包含 read
+        granted = set(record['scopes'])
+        if 'write' in granted:
+            granted.add('secrets')
+        if 'secrets' in granted:
+            granted.add('read')
+        if required not in granted:
+            return jsonify({'success': False, 'error': f'API 令牌没有 {required} 权限'}), 403
+        g.api_token = record
+        return None
+
+    if (app.config['WTF_CSRF_ENABLED'] and request.method in app.config['WTF_CSRF_METHODS']
+            and view is not None and view not in _csrf_exempt_views):
+        csrf.protect()
+    return None
+
+
+@login_manager.request_loader
+def load_user_from_token(req):
+    """Flask-Login 请求加载回调：已通过 authenticate_request 校验的 API 令牌"""
+    record = g.get('api_token')
+    return ApiTokenUser(record) if record else None
+
+
+def session_required(f):
+    """只允许登录会话访问（令牌管理等接口不接受 API 令牌）"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if g.get('api_token'):
+            return jsonify({'success': False, 'error': '该接口需要登录会话，不接受 API 令牌'}), 403
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.route('/api/tokens', methods=['GET', 'POST'])
+@login_required
+@session_required
+def api_tokens_manage():
+    """GET 列出令牌；POST 创建令牌：{"name": "ci", "scopes": ["read"], "expires_days": 90}"""
+    if request.method == 'GET':
+        return jsonify({'success': True, 'tokens': api_tokens.list_tokens()})
+
+    data = request.json or {}
+    name = str(data.get('name', '')).strip()
+    if not name or len(name) > 64:
+        return jsonify({'success': False, 'error': '令牌名称不能为空且不超过 64 个字符'}), 400
+    scopes = data.get('scopes') or ['read']
+    if not isinstance(scopes, list) or not scopes or any(scope not in API_TOKEN_SCOPES for scope in scopes):
+        return jsonify({'success': False, 'error': f"scopes 只支持 {' / '.join(API_TOKEN_SCOPES)}"}), 400
+    try:
+        expires_days = float(data['expires_days']) if data.get('expires_days') else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'expires_days 必须是数字'}), 400
+
+    token, record = api_tokens.create(name, scopes, current_user.username, expires_days)
+    audit.record('token.create', token_id=record['id'], name=name, scopes=scopes, expires_days=expires_days)
+    return jsonify({'success': True, 'token': token, 'record': record})
+
+
+@app.route('/api/tokens/<token_id>/revoke', methods=['POST'])
+@login_required
+@session_required
+def api_tokens_revoke(token_id):
+    """吊销令牌（立即生效）"""
+    if not api_tokens.revoke(token_id):
+        return jsonify({'success': False, 'error': '令牌不存在'}), 404
+    audit.record('token.revoke', token_id=token_id)
+    return jsonify({'success': True})
+
+
+# ==================== 性能分析 ====================
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '1000'))          # 超过该耗时（毫秒）的请求打印片段明细，0 关闭
+SLOW_REQUESTS_MEMORY = 100                                                 # 内存中保留的最近慢请求数
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '300'))  # 采样分析的最长时间（秒）
+
+slow_requests = deque(maxlen=SLOW_REQUESTS_MEMORY)
+
+
+def _summarize_spans(spans):
+    """按名称合并片段，返回 [(名称, 总秒数, 次数)]（按首次出现顺序）"""
+    summary = {}
+    for name, seconds in spans:
+        item = summary.get(name)
+        if item is None:
+            summary[name] = [seconds, 1]
+        else:
+            item[0] += seconds
+            item[1] += 1
+    return [(name, seconds, count) for name, (seconds, count) in summary.items()]
+
+
+@app.before_request
+def start_request_trace():
+    """每个请求记录子进程、配置解析、流量文件读写和 bcrypt 的耗时片段（见 wgcore.trace_span）"""
+    g.trace_started = time.perf_counter()
+    start_trace()
+
+
+@app.after_request
+def finish_request_trace(response):
+    """
+    登录用户的响应附带 Server-Timing 头（浏览器开发者工具的 Timing 面板可直接查看）；
+    超过 SLOW_REQUEST_MS 的请求打印并保留片段明细
+    """
+    spans = end_trace()
+    started = g.pop('trace_started', None)
+    if spans is None or started is None:
+        return response
+    total = time.perf_counter() - started
+    summary = _summarize_spans(spans)
+
+    if current_user.is_authenticated:
+        metrics = [f'{name};dur={seconds * 1000:.2f}' + (f';desc="{count}x"' if count > 1 else '')
+                   for name, seconds, count in summary]
+        response.headers['Server-Timing'] = ', '.join(metrics + [f'total;dur={total * 1000:.2f}'])
+
+    if SLOW_REQUEST_MS > 0 and total * 1000 >= SLOW_REQUEST_MS:
+        entry = {
+            'ts': int(time.time()),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(total * 1000, 1),
+            'spans': [{'name': name, 'ms': round(seconds * 1000, 1), 'count': count}
+                      for name, seconds, count in summary]
+        }
+        slow_requests.append(entry)
+        breakdown = ', '.join(f"{item['name']} {item['ms']}ms" + (f" x{item['count']}" if item['count'] > 1 else '')
+                              for item in entry['spans'])
+        print(f"Slow request: {request.method} {request.path} {entry['ms']}ms ({breakdown or 'no spans'})")
+    return response
+
+
+class SamplingProfiler:
+    """
+    按需开启的采样分析器
+
+    后台线程每隔 interval 秒读取所有其他线程的调用栈（sys._current_frames），按栈计数，
+    不需要重启进程，对被分析的请求没有插桩开销。这是墙钟采样：等待锁、I/O 和子进程的
+    线程同样会被采到。结果可导出为 collapsed stacks（flamegraph.pl、speedscope 可直接打开），
+    或按采样估算自身/累计时间的 pstats 文件（python -m pstats、snakeviz）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = None   # 正在进行的采样 {started, until, interval}
+        self.result = None     # 最近一次完成的采样
+
+    def start(self, seconds, interval):
+        with self._lock:
+            if self._running:
+                return {'success': False, 'error': '已有采样正在进行', **self._running}
+            now = time.time()
+            self._running = {'started': int(now), 'until': int(now + seconds), 'interval': interval}
+            running = dict(self._running)
+        threading.Thread(target=self._run, args=(seconds, interval), daemon=True, name='profiler').start()
+        return {'success': True, **running}
+
+    def _run(self, seconds, interval):
+        own = threading.get_ident()
+        stacks = {}
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+        finally:
+            with self._lock:
+                self.result = dict(self._running, samples=samples, stacks=stacks)
+                self._running = None
+            print(f"Profiler: {samples} samples, {len(stacks)} distinct stacks")
+
+    def status(self):
+        with self._lock:
+            result = self.result
+            return {
+                'running': dict(self._running) if self._running else None,
+                'last': {key: result[key] for key in ('started', 'until', 'interval', 'samples')} if result else None
+            }
+
+    def collapsed(self):
+        """flamegraph.pl / speedscope 的 collapsed stacks 文本：线程;函数;...;函数 次数"""
+        lines = []
+        for (thread_name, stack), count in sorted(self.result['stacks'].items(), key=lambda item: -item[1]):
+            frames = [f'{name} ({os.path.basename(filename)}:{line})' for filename, line, name in stack]
+            lines.append(';'.join([thread_name] + frames) + f' {count}')
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self):
+        """marshal 格式的 pstats 数据：调用次数为采样次数，时间为采样次数 × 间隔"""
+        interval = self.result['interval']
+        stats = {}
+        for (_, stack), count in self.result['stacks'].items():
+            seconds = count * interval
+            seen = set()
+            for i, func in enumerate(stack):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = i == len(stack) - 1
+                if leaf:
+                    entry[2] += seconds
+                if func not in seen:
+                    # 递归时累计时间只计一次
+                    seen.add(func)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if i:
+                    caller = entry[4].setdefault(stack[i - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[2] += seconds if leaf else 0.0
+                    caller[3] += seconds
+        return marshal.dumps({func: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                              for func, (cc, nc, tt, ct, callers) in stats.items()})
+
+
+profiler = SamplingProfiler()
+
+
+@app.route('/api/profile', methods=['GET'])
+@login_required
+@session_required
+def api_profile_status():
+    """采样分析状态和最近的慢请求"""
+    return jsonify({'success': True, **profiler.status(), 'slow_request_ms': SLOW_REQUEST_MS,
+                    'slow_requests': list(slow_requests)})
+
+
+@app.route('/api/profile/start', methods=['POST'])
+@login_required
+@session_required
+def api_profile_start():
+    """开始采样：{"seconds": 30, "interval_ms": 5}"""
+    data = request.json or {}
+    try:
+        seconds = float(data.get('seconds', 30))
+        interval = float(data.get('interval_ms', 5)) / 1000
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'seconds / interval_ms 必须是数字'}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({'success': False, 'error': f'seconds 必须在 0～{PROFILE_MAX_SECONDS:g} 之间'}), 400
+    if not 0.001 <= interval <= 1:
+        return jsonify({'success': False, 'error': 'interval_ms 必须在 1～1000 之间'}), 400
+    result = profiler.start(seconds, interval)
+    return jsonify(result), (200 if result['success'] else 409)
+
+
+@app.route('/api/profile/result')
+@login_required
+@session_required
+def api_profile_result():
+    """下载最近一次采样：?format=collapsed（火焰图）或 pstats"""
+    if profiler.result is None:
+        return jsonify({'success': False, 'error': '还没有完成的采样'}), 404
+    fmt = request.args.get('format', 'collapsed')
+    stamp = datetime.fromtimestamp(profiler.result['started']).strftime('%Y%m%d_%H%M%S')
+    if fmt == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain',
+                        headers={'Content-Disposition': f'attachment; filename="profile-{stamp}.folded"'})
+    if fmt == 'pstats':
+        return Response(profiler.pstats(), mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename="profile-{stamp}.pstats"'})
+    return jsonify({'success': False, 'error': 'format 只支持 collapsed / pstats'}), 400
+
+
+# ==================== 节点 agent ====================
+
+def _bearer_token_valid(expected):
+    """检查请求的 Bearer 令牌（常量时间比较），expected 为空时一律拒绝"""
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else ''
+    return bool(expected) and hmac.compare_digest(token, expected)
+
+
+def agent_auth_required(f):
+    """校验 agent 接口的 Bearer 令牌"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not _bearer_token_valid(AGENT_TOKEN):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.route('/agent/v1/status')
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_status():
+    """节点缓存的运行时状态"""
+    data = get_status_snapshot().to_dict()
+    data['node'] = NODE_NAME
+    return jsonify(data)
+
+
+@app.route('/agent/v1/events')
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_events():
+    """节点的客户端上线/下线事件"""
+    since = request.args.get('since', default=0, type=int)
+    limit = min(request.args.get('limit', default=500, type=int), 5000)
+    data = presence.events_since(since, limit)
+    data['node'] = NODE_NAME
+    return jsonify(data)
+
+
+@app.route('/agent/v1/clients', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_add_client():
+    """添加客户端"""
+    data = request.json or {}
+    return jsonify(add_client(data.get('name', ''), data.get('interface'), data.get('group'), data.get('tags')))
+
+
+@app.route('/agent/v1/clients/<client_name>/delete', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_delete_client(client_name):
+    """删除客户端"""
+    return jsonify(delete_client(client_name))
+
+
+@app.route('/agent/v1/clients/disable', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_disable_clients():
+    """批量禁用客户端"""
+    return jsonify(set_clients_disabled((request.json or {}).get('names'), True))
+
+
+@app.route('/agent/v1/clients/enable', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_enable_clients():
+    """批量启用客户端"""
+    return jsonify(set_clients_disabled((request.json or {}).get('names'), False))
+
+
+@app.route('/agent/v1/clients/<client_name>/config')
+@csrf_exempt
+@limiter.exempt
+@agent_auth_required
+def agent_client_config(client_name):
+    """获取客户端配置"""
+    return jsonify(get_client_config(client_name))
+
+
+@app.before_request
+def restrict_agent_mode():
+    """agent 模式下只开放 /agent/ 和 /replication/ 接口"""
+    if WGM_MODE == 'agent' and not request.path.startswith(('/agent/', '/replication/')):
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+
+
+# ==================== 多服务器控制器 ====================
+
+class NodeClient:
+    """
+    单个节点 agent 的 HTTP 客户端
+
+    维护一个持久连接池（HTTP/1.1 keep-alive），多次请求复用 TCP 连接；
+    每次请求使用独立的超时时间。
+    """
+
+    def __init__(self, name, url, token, timeout=FLEET_TIMEOUT, pool_size=FLEET_POOL_SIZE):
+        parsed = urllib.parse.urlsplit(url)
+        self.name = name
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self._https = parsed.scheme == 'https'
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._base_path = parsed.path.rstrip('/')
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self, timeout):
+        conn_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        return conn_class(self._host, self._port, timeout=timeout)
+
+    def request(self, method, path, payload=None, timeout=None):
+        """
+        发送请求
+
+        Returns:
+            tuple: (HTTP 状态码, 解析后的 JSON)
+
+        Raises:
+            OSError / http.client.HTTPException: 连接失败或超时
+        """
+        timeout = timeout or self.timeout
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Authorization': f'Bearer {self.token}', 'Accept': 'application/json'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(2):
+            try:
+                conn = self._pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self._new_connection(timeout)
+                reused = False
+
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+            try:
+                conn.request(method, self._base_path + path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                # 复用的连接可能已被对端关闭，换新连接重试一次（超时不重试）
+                if reused and attempt == 0 and not isinstance(e, TimeoutError):
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return response.status, json.loads(data) if data else {}
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _parse_fleet_nodes(spec):
+    """解析 FLEET_NODES 为 {名称: NodeClient}"""
+    nodes = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            name, url = item.split('=', 1)
+        else:
+            name, url = urllib.parse.urlsplit(item).netloc, item
+        nodes[name.strip()] = NodeClient(name.strip(), url.strip(), FLEET_TOKEN)
+    return nodes
+
+
+FLEET = _parse_fleet_nodes(FLEET_NODES)
+_fleet_pool = ThreadPoolExecutor(max_workers=max(2, min(32, len(FLEET))), thread_name_prefix='fleet')
+
+
+def _fetch_node_status(node):
+    """获取单个节点状态，失败时返回错误信息而不是抛出异常"""
+    started = time.monotonic()
+    try:
+        status, data = node.request('GET', '/agent/v1/status')
+        if status != 200:
+            raise RuntimeError(data.get('error') or f'HTTP {status}')
+        return {'name': node.name, 'ok': True, 'data': data,
+                'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+    except Exception as e:
+        return {'name': node.name, 'ok': False, 'error': str(e) or e.__class__.__name__,
+                'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+
+
+def get_fleet_status():
+    """并行获取所有节点状态并合并客户端列表"""
+    results = list(_fleet_pool.map(_fetch_node_status, FLEET.values()))
+
+    nodes = []
+    clients = []
+    online_count = 0
+    for result in results:
+        node_info = {
+            'name': result['name'],
+            'url': FLEET[result['name']].url,
+            'ok': result['ok'],
+            'latency_ms': result['latency_ms']
+        }
+        if result['ok']:
+            data = result['data']
+            node_info.update({
+                'server': data.get('server'),
+                'interfaces': data.get('interfaces', []),
+                'client_count': data.get('client_count', 0),
+                'online_count': data.get('online_count', 0),
+                'generated_at': data.get('generated_at'),
+                'stale': data.get('stale', False)
+            })
+            online_count += data.get('online_count', 0)
+            for client in data.get('clients', []):
+                client['node'] = result['name']
+                clients.append(client)
+        else:
+            node_info['error'] = result['error']
+        nodes.append(node_info)
+
+    return {
+        'nodes': nodes,
+        'clients': clients,
+        'client_count': len(clients),
+        'online_count': online_count,
+        'node_count': len(nodes),
+        'healthy_nodes': sum(1 for n in nodes if n['ok'])
+    }
+
+
+def _proxy_to_node(node_name, method, path, payload=None):
+    """将变更请求转发到指定节点"""
+    node = FLEET.get(node_name)
+    if node is None:
+        return jsonify({'success': False, 'error': f'未知节点: {node_name}'}), 404
+    try:
+        status, data = node.request(method, path, payload)
+        return jsonify(data), status
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'节点 {node_name} 请求失败: {e}'}), 502
+
+
+@app.route('/api/fleet/status')
+@login_required
+@limiter.limit("1200 per hour")
+def api_fleet_status():
+    """所有节点的合并状态"""
+    return jsonify(get_fleet_status())
+
+
+@app.route('/api/fleet/<node_name>/client/add', methods=['POST'])
+@login_required
+def api_fleet_add_client(node_name):
+    """在指定节点上添加客户端"""
+    data = request.json or {}
+    return _proxy_to_node(node_name, 'POST', '/agent/v1/clients',
+                          {'name': data.get('name', ''), 'interface': data.get('interface'),
+                           'group': data.get('group'), 'tags': data.get('tags')})
+
+
+@app.route('/api/fleet/<node_name>/client/<client_name>/delete', methods=['POST'])
+@login_required
+def api_fleet_delete_client(node_name, client_name):
+    """删除指定节点上的客户端"""
+    client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
+    return _proxy_to_node(node_name, 'POST', f'/agent/v1/clients/{client_name}/delete')
+
+
+@app.route('/api/fleet/<node_name>/clients/<action>', methods=['POST'])
+@login_required
+def api_fleet_set_disabled(node_name, action):
+    """批量禁用/启用指定节点上的客户端"""
+    if action not in ('disable', 'enable'):
+        return jsonify({'success': False, 'error': '未知操作'}), 404
+    data = request.json or {}
+    return _proxy_to_node(node_name, 'POST', f'/agent/v1/clients/{action}', {'names': data.get('names')})
+
+
+@app.route('/api/fleet/<node_name>/client/<client_name>/config')
+@returns_secrets
+@login_required
+def api_fleet_client_config(node_name, client_name):
+    """获取指定节点上的客户端配置"""
+    client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
+    return _proxy_to_node(node_name, 'GET', f'/agent/v1/clients/{client_name}/config')
+
+
+# ==================== 配置复制 ====================
+
+# 复制的客户端文件名（只允许这些形式，防止路径遍历）
+CLIENT_FILE_PATTERN = re.compile(r'[a-zA-Z0-9_-]+(\.conf|_private\.key|_public\.key)')
+
+
+def _read_client_files(iface):
+    """读取接口客户端目录中的配置和密钥文件，返回 {文件名: 内容}"""
+    files = {}
+    try:
+        names = os.listdir(iface.client_dir)
+    except OSError:
+        return files
+    for name in names:
+        if not CLIENT_FILE_PATTERN.fullmatch(name):
+            continue
+        try:
+            with open(os.path.join(iface.client_dir, name)) as f:
+                files[name] = f.read()
+        except OSError:
+            continue
+    return files
+
+
+def _write_client_files(iface, files):
+    """写入复制过来的客户端文件（权限 600）"""
+    if not files:
+        return
+    run_command(['mkdir', '-p', iface.client_dir])
+    for name, content in files.items():
+        if not CLIENT_FILE_PATTERN.fullmatch(name):
+            continue
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write(content)
+            temp_file = f.name
+        target = os.path.join(iface.client_dir, name)
+        run_command(['cp', temp_file, target])
+        run_command(['chmod', '600', target])
+        os.unlink(temp_file)
+
+
+class ReplicationManager:
+    """
+    配置复制
+
+    主节点：每次 peer 变更追加一条带序号的增量到本地日志（journal.jsonl），
+    后台线程把增量推送给各备用节点；备用节点落后于日志保留范围，
+    或到了定期对账时间时，推送一次全量快照。
+
+    备用节点：按序号依次应用增量（写配置 + 定向 wg set），序号不连续时返回 409，
+    主节点据此从备用节点实际的位置重发。提升为主节点后即可接管。
+    """
+
+    def __init__(self, initial_role, directory):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.state_path = os.path.join(directory, 'state.json')
+        self._initial_role = initial_role
+        self._role = None
+        self._lock = threading.Lock()
+        self._entries = []   # 日志中保留的增量（内存副本）
+        self.base_seq = 0    # _entries 第一条之前的序号
+        self.last_seq = 0
+        self.shippers = []
+
+    # ---------- 状态持久化 ----------
+
+    def _ensure_loaded(self):
+        if self._role is not None:
+            return
+        with self._lock:
+            if self._role is not None:
+                return
+            state = {}
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                pass
+            # 提升/降级后的角色持久化在 state.json 中，优先于环境变量
+            self.base_seq = state.get('base_seq', 0)
+            self.last_seq = state.get('last_seq', 0)
+            try:
+                with open(self.journal_path) as f:
+                    self._entries = [json.loads(line) for line in f if line.strip()]
+                # 增量中包含客户端私钥，旧版本按 umask 创建的日志收紧权限
+                os.chmod(self.journal_path, 0o600)
+            except (OSError, ValueError):
+                self._entries = []
+            if self._entries:
+                self.base_seq = self._entries[0]['seq'] - 1
+                self.last_seq = max(self.last_seq, self._entries[-1]['seq'])
+            self._role = state.get('role') or self._initial_role
+
+    def _save_state(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'role': self._role, 'last_seq': self.last_seq, 'base_seq': self.base_seq}, f)
+        os.replace(temp_path, self.state_path)
+
+    @property
+    def role(self):
+        self._ensure_loaded()
+        return self._role
+
+    # ---------- 主节点 ----------
+
+    def record(self, delta):
+        """主节点：追加一条增量并唤醒推送线程；其他角色忽略"""
+        if self.role != 'primary':
+            return None
+
+        with self._lock:
+            entry = dict(delta, seq=self.last_seq + 1, ts=int(time.time()))
+            os.makedirs(self.directory, exist_ok=True)
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, 'a') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._entries.append(entry)
+            self.last_seq = entry['seq']
+
+            # 超出保留数量时截断日志，落后太多的备用节点改用快照同步
+            if len(self._entries) > REPLICATION_JOURNAL_MAX:
+                self._entries = self._entries[-(REPLICATION_JOURNAL_MAX // 2):]
+                self.base_seq = self._entries[0]['seq'] - 1
+                temp_path = self.journal_path + '.tmp'
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    for item in self._entries:
+                        f.write(json.dumps(item, ensure_ascii=False) + '\n')
+                os.replace(temp_path, self.journal_path)
+            self._save_state()
+
+        for shipper in self.shippers:
+            shipper.wake.set()
+        return entry['seq']
+
+    def since(self, seq, limit=200):
+        """
+        返回序号大于 seq 的增量
+
+        Returns:
+            list: 增量列表；seq 早于日志保留范围时返回 None（需要快照）
+        """
+        with self._lock:
+            if seq < self.base_seq:
+                return None
+            start = seq - self.base_seq
+            return self._entries[start:start + limit]
+
+    def build_snapshot(self):
+        """构建全量快照：各接口的 peer 部分和客户端文件"""
+        with self._lock:
+            seq = self.last_seq
+
+        interfaces = {}
+        for iface in INTERFACES.values():
+            iface.invalidate()
+            index = iface.read_index()
+            if index is None or 'placeholder' in index.text:
+                continue
+            interfaces[iface.name] = {'peers': index.peers_text, 'files': _read_client_files(iface)}
+        return {'seq': seq, 'interfaces': interfaces}
+
+    def start(self):
+        """主节点：为每个备用节点启动推送线程"""
+        if self.role != 'primary' or self.shippers:
+            return
+        for url in REPLICATION_STANDBYS.split(','):
+            url = url.strip()
+            if url:
+                shipper = StandbyShipper(self, url)
+                self.shippers.append(shipper)
+                shipper.start()
+
+    # ---------- 备用节点 ----------
+
+    def apply_entries(self, entries):
+        """
+        备用节点：按序号应用增量
+
+        Returns:
+            bool: False 表示序号不连续（需要主节点从 last_seq 重发）
+        """
+        self._ensure_loaded()
+        with self._lock:
+            for entry in entries:
+                if entry['seq'] <= self.last_seq:
+                    continue  # 重复推送，已应用
+                if entry['seq'] != self.last_seq + 1:
+                    return False
+                iface = get_interface(entry.get('interface'))
+                before = audit.snapshot([iface]) if iface else None
+                self._apply_delta(entry)
+                names = entry.get('names') or ([entry['name']] if entry.get('name') else list(entry.get('clients', {})))
+                audit.record(f"replica.{entry['op']}", entry.get('interface'), names,
+                             entry.get('public_keys') or [entry.get('public_key')], before,
+                             actor='replication', seq=entry['seq'])
+                self.last_seq = entry['seq']
+                self._save_state()
+        return True
+
+    def _apply_delta(self, entry):
+        iface = get_interface(entry['interface'])
+        if iface is None:
+            raise ValueError(f"未知接口: {entry['interface']}")
+
+        iface.invalidate()
+        index = iface.read_index()
+        if index is None:
+            raise RuntimeError(f'无法读取 {iface.conf}')
+
+        if entry['op'] == 'add':
+            # 幂等：公钥已存在时不重复追加
+            if not index.find_public_key(entry['public_key']):
+                if not iface.write_config(index.text + entry['block']):
+                    raise RuntimeError(f'无法写入 {iface.conf}')
+            _write_client_files(iface, entry.get('files'))
+            iface.apply_peers([(entry['public_key'], entry['allowed_ips'])])
+
+        elif entry['op'] == 'delete':
+            if not _delete_from_interface(iface, [entry['name']], backup=False):
+                # 幂等：配置中已没有该客户端时仍清理残留的文件和运行时 peer
+                _remove_client_files(iface, [entry['name']])
+                if entry.get('public_key'):
+                    iface.apply_peers([(entry['public_key'], None)])
+
+        elif entry['op'] in ('disable', 'enable'):
+            _apply_disabled(iface, entry['names'], entry['op'] == 'disable', backup=False)
+
+        elif entry['op'] == 'delete_many':
+            _delete_from_interface(iface, entry['names'], backup=False)
+
+        elif entry['op'] == 'metadata':
+            _apply_metadata(iface, entry['names'], entry.get('group'), entry.get('tags'))
+
+        elif entry['op'] == 'rekey':
+            # 备用节点不保留宽限期，直接切换到新密钥
+            _rekey_interface(iface, entry['clients'], grace=False, backup=False)
+            _write_rotated_client_files(iface, entry['clients'])
+
+        elif entry['op'] == 'rekey_server':
+            _rekey_server(iface, entry['old_public_key'], entry['private_key'], backup=False)
+
+        invalidate_status_snapshot()
+
+    def apply_snapshot(self, snapshot):
+        """备用节点：用全量快照替换各接口的 peer 部分（保留本机 [Interface] 部分）"""
+        self._ensure_loaded()
+        with self._lock:
+            for name, data in snapshot['interfaces'].items():
+                iface = get_interface(name)
+                if iface is None:
+                    continue
+                iface.invalidate()
+                index = iface.read_index()
+                if index is None:
+                    raise RuntimeError(f'无法读取 {iface.conf}')
+                new_config = index.interface_text.rstrip('\n') + '\n\n' + data['peers']
+                if new_config != index.text:
+                    before = audit.snapshot([iface])
+                    if not iface.write_config(new_config):
+                        raise RuntimeError(f'无法写入 {iface.conf}')
+                    iface.reload()
+                    audit.record('replica.snapshot', iface.name, before=before, actor='replication',
+                                 seq=snapshot['seq'])
+                _write_client_files(iface, data.get('files'))
+
+            self.last_seq = snapshot['seq']
+            self.base_seq = snapshot['seq']
+            self._entries = []
+            self._save_state()
+        invalidate_status_snapshot()
+
+    def promote(self):
+        """备用节点提升为主节点（接管）"""
+        self._ensure_loaded()
+        with self._lock:
+            self._role = 'primary'
+            # 之后的增量从当前序号继续编号
+            self.base_seq = self.last_seq
+            self._entries = []
+            self._save_state()
+        self.start()
+
+    def status(self):
+        self._ensure_loaded()
+        return {
+            'role': self._role or 'disabled',
+            'last_seq': self.last_seq,
+            'base_seq': self.base_seq,
+            'standbys': [shipper.status() for shipper in self.shippers]
+        }
+
+
+class StandbyShipper(threading.Thread):
+    """主节点到单个备用节点的增量推送线程"""
+
+    def __init__(self, manager, url):
+        super().__init__(name=f'replication-{url}', daemon=True)
+        self.manager = manager
+        self.node = NodeClient(url, url, REPLICATION_TOKEN)
+        self.wake = threading.Event()
+        self.acked_seq = None
+        self.last_sync = None
+        self.last_snapshot = time.time()
+        self.last_error = None
+
+    def run(self):
+        self.wake.set()
+        while True:
+            self.wake.wait(REPLICATION_INTERVAL)
+            self.wake.clear()
+            if self.manager.role != 'primary':
+                continue
+            try:
+                self.sync()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e) or e.__class__.__name__
+
+    def push_snapshot(self):
+        snapshot = self.manager.build_snapshot()
+        status, data = self.node.request('POST', '/replication/v1/snapshot', snapshot, timeout=60)
+        if status != 200:
+            raise RuntimeError(data.get('error') or f'快照推送失败: HTTP {status}')
+        self.acked_seq = data['last_seq']
+        self.last_snapshot = time.time()
+
+    def sync(self):
+        if self.acked_seq is None:
+            status, data = self.node.request('GET', '/replication/v1/status')
+            if status != 200:
+                raise RuntimeError(data.get('error') or f'HTTP {status}')
+            self.acked_seq = data['last_seq']
+
+        # 备用节点序号超前（例如曾被提升过）或到了定期对账时间：推送全量快照
+        if self.acked_seq > self.manager.last_seq or \
+                time.time() - self.last_snapshot >= REPLICATION_SNAPSHOT_INTERVAL:
+            self.push_snapshot()
+
+        while True:
+            entries = self.manager.since(self.acked_seq)
+            if entries is None:
+                self.push_snapshot()
+                continue
+
+            # 没有新增量时也发送一次空批次作为心跳，获取备用节点当前序号
+            status, data = self.node.request('POST', '/replication/v1/deltas', {'entries': entries})
+            if status not in (200, 409):
+                raise RuntimeError(data.get('error') or f'HTTP {status}')
+            previous = self.acked_seq
+            self.acked_seq = data['last_seq']
+            self.last_sync = time.time()
+            if status == 200 and (not entries or self.acked_seq == previous):
+                break
+
+    def status(self):
+        lag = None if self.acked_seq is None else max(0, self.manager.last_seq - self.acked_seq)
+        return {
+            'url': self.node.url,
+            'acked_seq': self.acked_seq,
+            'lag': lag,
+            'last_sync': int(self.last_sync) if self.last_sync else None,
+            'last_error': self.last_error
+        }
+
+
+replication = ReplicationManager(REPLICATION_ROLE, REPLICATION_DIR)
+
+
+def replication_auth_required(f):
+    """校验复制接口的 Bearer 令牌"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not _bearer_token_valid(REPLICATION_TOKEN):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.route('/replication/v1/status')
+@csrf_exempt
+@limiter.exempt
+@replication_auth_required
+def replication_status():
+    """复制状态（角色和序号）"""
+    return jsonify(replication.status())
+
+
+@app.route('/replication/v1/deltas', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@replication_auth_required
+def replication_deltas():
+    """备用节点：接收并应用增量"""
+    if replication.role != 'standby':
+        return jsonify({'success': False, 'error': '当前节点不是备用节点', 'last_seq': replication.last_seq}), 403
+    try:
+        in_order = replication.apply_entries((request.json or {}).get('entries', []))
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'应用增量失败: {e}', 'last_seq': replication.last_seq}), 500
+    status_code = 200 if in_order else 409
+    return jsonify({'success': in_order, 'last_seq': replication.last_seq}), status_code
+
+
+@app.route('/replication/v1/snapshot', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@replication_auth_required
+def replication_snapshot():
+    """备用节点：接收并应用全量快照"""
+    if replication.role != 'standby':
+        return jsonify({'success': False, 'error': '当前节点不是备用节点', 'last_seq': replication.last_seq}), 403
+    try:
+        replication.apply_snapshot(request.json)
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'应用快照失败: {e}', 'last_seq': replication.last_seq}), 500
+    return jsonify({'success': True, 'last_seq': replication.last_seq})
+
+
+@app.route('/replication/v1/promote', methods=['POST'])
+@csrf_exempt
+@limiter.exempt
+@replication_auth_required
+def replication_promote():
+    """备用节点提升为主节点"""
+    replication.promote()
+    return jsonify({'success': True, **replication.status()})
+
+
+@app.route('/api/replication/status')
+@login_required
+def api_replication_status():
+    """复制状态（管理界面）"""
+    return jsonify(replication.status())
+
+
+@app.route('/api/replication/promote', methods=['POST'])
+@login_required
+def api_replication_promote():
+    """将本节点提升为主节点（管理界面）"""
+    if replication.role == 'primary':
+        return jsonify({'success': False, 'error': '当前节点已经是主节点'})
+    replication.promote()
+    return jsonify({'success': True, **replication.status()})
+
+
+# ==================== 启动预热 ====================
+
+# 最近一次启动各阶段耗时（秒），/api/backend/status 中返回
+startup_report = {}
+
+
+def _process_uptime():
+    """本进程已运行的秒数（读取 /proc，包括导入模块的时间），无法读取时返回 None"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _warm_qrcode(iface, name):
+    config_text = _read_private_file(os.path.join(iface.client_dir, f'{name}.conf'))
+    if config_text:
+        cached_qrcode_png(config_text)
+
+
+def warm_up():
+    """
+    开始接受请求前预热：解析各接口配置、采集一次运行时快照、导入二维码库
+
+    客户端二维码在 _qr_pool 中后台渲染（最多 QR_CACHE_SIZE 个），不推迟就绪时间。
+    """
+    started = time.monotonic()
+    for iface in INTERFACES.values():
+        iface.read_index()
+    startup_report['config'] = round(time.monotonic() - started, 3)
+
+    started = time.monotonic()
+    try:
+        get_status_snapshot(max_age=0)
+    except BackendError as e:
+        print(f"⚠️  启动时无法采集运行时状态: {e}")
+    startup_report['snapshot'] = round(time.monotonic() - started, 3)
+
+    started = time.monotonic()
+    _qrcode_module()
+    startup_report['qrcode'] = round(time.monotonic() - started, 3)
+
+    if QR_CACHE_SIZE > 0:
+        for iface, name in export_targets()[:QR_CACHE_SIZE]:
+            _qr_pool.submit(_warm_qrcode, iface, name)
+
+
+def report_ready():
+    """记录并打印从进程启动到就绪的时间"""
+    ready = _process_uptime()
+    startup_report['ready'] = round(ready, 3) if ready is not None else None
+    startup_report['ready_at'] = int(time.time())
+    steps = ', '.join(f'{key} {value:.2f}s' for key, value in startup_report.items()
+                      if key not in ('ready', 'ready_at'))
+    print(f"🚀 启动完成，用时 {ready:.2f}s（{steps}）" if ready is not None else f"🚀 启动完成（{steps}）")
+
+
 if __name__ == '__main__':
+    web_port = int(os.environ.get('WEB_PORT', '8080'))
+    imports = _process_uptime()
+    if imports is not None:
+        startup_report['imports'] = round(imports, 3)
+
     # 确保必要目录存在
-    os.makedirs(CLIENT_DIR, exist_ok=True)
+    for iface in INTERFACES.values():
+        os.makedirs(iface.client_dir, exist_ok=True)
+
+    # 启动配置复制（主节点推送线程）
+    replication.start()
+
+    # Webhook 投递线程
+    webhooks.start()
+
+    # 恢复中断的密钥轮换任务
+    rotations.start()
+
+    # 服务端地址变化检测（定时 + 路由变化）
+    endpoint_monitor.start()
+
+    # 配置文件监听和漂移检测
+    drift_monitor.start()
+
+    # 后台状态采集（驱动在线状态跟踪）
+    if PRESENCE_INTERVAL > 0:
+        StatusCollector(PRESENCE_INTERVAL).start()
+
+    if WGM_MODE == 'agent':
+        # agent 模式：无 Web 登录，只提供令牌认证的 /agent/v1/* 接口
+        if not AGENT_TOKEN:
+            raise ValueError("agent 模式必须设置 AGENT_TOKEN 环境变量")
+        print(f"🛰️  WireGuard 节点 agent: {NODE_NAME}，监听端口 {web_port}")
+        warm_up()
+        report_ready()
+        try:
+            # waitress 支持 HTTP/1.1 keep-alive，控制器可以复用连接
+            from waitress import serve
+            serve(app, host='0.0.0.0', port=web_port, threads=8)
+        except ImportError:
+            app.run(host='0.0.0.0', port=web_port, debug=False, threaded=True)
+        raise SystemExit(0)
 
     # 初始化默认用户
+    started = time.monotonic()
     init_default_user()
+    startup_report['users'] = round(time.monotonic() - started, 3)
+
+    warm_up()
 
     # 启动 Flask 应用
     print("\n" + "="*50)
     print("🔒 WireGuard Web 管理面板")
     print("="*50)
-    print(f"访问地址: http://0.0.0.0:8080")
+    print(f"访问地址: http://0.0.0.0:{web_port}")
     print(f"默认用户名: {os.environ.get('ADMIN_USERNAME', 'admin')}")
     if not os.environ.get('ADMIN_PASSWORD'):
         print(f"默认密码: admin123")
         print("⚠️  请在生产环境中修改默认密码！")
+    if FLEET:
+        print(f"多服务器控制器: {len(FLEET)} 个节点")
     print("="*50 + "\n")
+    report_ready()
 
-    app.run(host='0.0.0.0', port=8080, debug=False)
+    app.run(host='0.0.0.0', port=web_port, debug=False, threaded=True)
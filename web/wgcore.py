@@ -0,0 +1,2135 @@
+"""
+WireGuard 管理核心库 - 配置模型、后端命令、IP 分配、流量统计、服务端地址、密钥、客户端增删和导出
+
+不依赖 Flask，由 Web 后端（app.py）和命令行工具（wgm.py）共用。qrcode/PIL、cryptography
+等导入较慢的库在第一次用到时才导入，命令行每次调用的启动开销很小。
+"""
+
+import subprocess
+import os
+import re
+import json
+import hashlib
+import time
+import threading
+import tempfile
+import base64
+import ipaddress
+from io import BytesIO
+from datetime import datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# 配置
+WG_INTERFACE = os.environ.get('WG_INTERFACE', 'wg0')
+WG_DIR = os.environ.get('WG_DIR', '/etc/wireguard')
+WG_CONF = f"{WG_DIR}/{WG_INTERFACE}.conf"
+CLIENT_DIR = f"{WG_DIR}/clients"
+
+# 多接口：逗号分隔的接口列表，如 "wg0,wg1,wg2"（默认只管理 WG_INTERFACE）
+WG_INTERFACES = [name.strip() for name in os.environ.get('WG_INTERFACES', WG_INTERFACE).split(',') if name.strip()]
+if WG_INTERFACE not in WG_INTERFACES:
+    WG_INTERFACES.insert(0, WG_INTERFACE)
+
+# 新客户端的接口分配策略：first（始终使用主接口）或 least_loaded（选择 peer 最少的接口）
+WG_SHARD_POLICY = os.environ.get('WG_SHARD_POLICY', 'first')
+
+# 流量数据存储
+TRAFFIC_FILE = f"{WG_DIR}/traffic.json"
+
+# 每个接口保留的配置备份（*.conf.backup.*）份数，0 表示不清理
+CONFIG_BACKUP_KEEP = int(os.environ.get('CONFIG_BACKUP_KEEP', '50'))
+
+# 后端命令自适应超时和熔断
+COMMAND_TIMEOUT_MIN = float(os.environ.get('COMMAND_TIMEOUT_MIN', '2'))    # 自适应超时下限（秒）
+COMMAND_TIMEOUT_MAX = float(os.environ.get('COMMAND_TIMEOUT_MAX', '10'))   # 自适应超时上限（秒）
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', '3'))          # 连续失败多少次后熔断
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', '15'))         # 熔断持续时间（秒）
+
+
+# 在线判定阈值（秒）：最后握手在此时间内视为在线
+ONLINE_THRESHOLD = int(os.environ.get('ONLINE_THRESHOLD', '3600'))
+
+
+class TrafficRecord:
+    """单个客户端的流量累计记录（整数字节计数 + epoch 时间戳）"""
+    __slots__ = ('accumulated_rx', 'accumulated_tx', 'last_rx', 'last_tx', 'last_update')
+
+    def __init__(self, accumulated_rx=0, accumulated_tx=0, last_rx=0, last_tx=0, last_update=0):
+        self.accumulated_rx = accumulated_rx
+        self.accumulated_tx = accumulated_tx
+        self.last_rx = last_rx
+        self.last_tx = last_tx
+        self.last_update = last_update
+
+    @classmethod
+    def from_dict(cls, data):
+        """从 traffic.json 条目构造，兼容旧版 ISO 格式的 last_update"""
+        last_update = data.get('last_update', 0)
+        if isinstance(last_update, str):
+            try:
+                last_update = int(datetime.fromisoformat(last_update).timestamp())
+            except ValueError:
+                last_update = 0
+        return cls(
+            int(data.get('accumulated_rx', 0)),
+            int(data.get('accumulated_tx', 0)),
+            int(data.get('last_rx', 0)),
+            int(data.get('last_tx', 0)),
+            int(last_update)
+        )
+
+    def to_dict(self):
+        return {
+            'accumulated_rx': self.accumulated_rx,
+            'accumulated_tx': self.accumulated_tx,
+            'last_rx': self.last_rx,
+            'last_tx': self.last_tx,
+            'last_update': self.last_update
+        }
+
+    def update(self, current_rx, current_tx, now):
+        """
+        记录一次新的计数器采样
+
+        当前计数小于上次记录时说明接口/系统重启导致计数器归零，
+        此时将上次的值累加到累计值中。
+
+        Returns:
+            bool: 计数是否发生变化
+        """
+        if current_rx == self.last_rx and current_tx == self.last_tx:
+            return False
+        if current_rx < self.last_rx:
+            self.accumulated_rx += self.last_rx
+        if current_tx < self.last_tx:
+            self.accumulated_tx += self.last_tx
+        self.last_rx = current_rx
+        self.last_tx = current_tx
+        self.last_update = now
+        return True
+
+    @property
+    def total_rx(self):
+        return self.accumulated_rx + self.last_rx
+
+    @property
+    def total_tx(self):
+        return self.accumulated_tx + self.last_tx
+
+
+class PeerRecord:
+    """
+    单个 peer 的紧凑内存表示
+
+    只保存整数计数器和 epoch 时间戳，人类可读的格式化字符串
+    仅在 to_dict() 序列化时生成。
+    """
+    __slots__ = ('name', 'public_key', 'ip', 'interface', 'rx', 'tx', 'total_rx', 'total_tx',
+                 'handshake', 'duplicates', 'disabled', 'group', 'tags')
+
+    def __init__(self, name, public_key, ip, interface=WG_INTERFACE, rx=0, tx=0, total_rx=0, total_tx=0,
+                 handshake=0, disabled=False, group=None, tags=()):
+        self.name = name
+        self.public_key = public_key
+        self.ip = ip
+        self.interface = interface
+        self.rx = rx                  # 当前接口计数（字节）
+        self.tx = tx
+        self.total_rx = total_rx      # 累计 + 当前（字节）
+        self.total_tx = total_tx
+        self.handshake = handshake    # 最后握手 epoch 秒，0 表示从未握手
+        self.duplicates = 1           # 配置中相同公钥出现的次数
+        self.disabled = disabled      # 已禁用（配置中保留，不在运行时 peer 中）
+        self.group = group            # 分组（# 分组: 注释），未分组为 None
+        self.tags = tags              # 标签元组（# 标签: 注释）
+
+    def is_online(self, now):
+        return self.handshake > 0 and now - self.handshake < ONLINE_THRESHOLD
+
+    def to_dict(self, now=None):
+        """序列化为 API 返回格式"""
+        if now is None:
+            now = int(time.time())
+        data = {
+            'name': self.name,
+            'public_key': self.public_key,
+            'ip': self.ip,
+            'interface': self.interface,
+            'status': 'disabled' if self.disabled else ('online' if self.is_online(now) else 'offline'),
+            'last_handshake': format_handshake(self.handshake, now),
+            'transfer_rx': format_wg_bytes(self.rx),
+            'transfer_tx': format_wg_bytes(self.tx),
+            'transfer_total': format_bytes(self.total_rx + self.total_tx),
+            'is_duplicate': self.duplicates > 1,
+            'disabled': self.disabled,
+            'group': self.group,
+            'tags': list(self.tags)
+        }
+        if self.duplicates > 1:
+            data['duplicate_warning'] = f'⚠️ 此公钥有{self.duplicates}个重复'
+        return data
+
+
+def serialize_clients(clients, now=None):
+    """将 PeerRecord 列表序列化为 API 返回的字典列表"""
+    if now is None:
+        now = int(time.time())
+    return [client.to_dict(now) for client in clients]
+
+
+# 流量数据管理
+# 内存缓存：(文件mtime, {name: TrafficRecord})，文件未变化时直接复用
+_traffic_cache = {'mtime': None, 'data': None}
+
+
+def _traffic_file_mtime():
+    try:
+        return os.stat(TRAFFIC_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_traffic_data():
+    """加载流量数据，返回 {客户端名称: TrafficRecord}"""
+    try:
+        mtime = _traffic_file_mtime()
+        if mtime is not None and mtime == _traffic_cache['mtime'] and _traffic_cache['data'] is not None:
+            return _traffic_cache['data']
+
+        data = {}
+        if os.path.exists(TRAFFIC_FILE):
+            result = run_command(['cat', TRAFFIC_FILE], use_sudo=False)
+            if not result['success']:
+                result = run_command(['cat', TRAFFIC_FILE])
+            if result['success']:
+                with trace_span('traffic-load'):
+                    raw = json.loads(result['stdout'])
+                    data = {name: TrafficRecord.from_dict(entry) for name, entry in raw.items()}
+
+        _traffic_cache['mtime'] = mtime
+        _traffic_cache['data'] = data
+        return data
+    except Exception as e:
+        print(f"Error loading traffic data: {e}")
+        return {}
+
+
+def save_traffic_data(traffic_data):
+    """保存流量数据"""
+    try:
+        with trace_span('traffic-save'), tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            json.dump({name: record.to_dict() for name, record in traffic_data.items()}, f, indent=2)
+            temp_file = f.name
+
+        run_command(['mkdir', '-p', WG_DIR])
+        result = run_command(['cp', temp_file, TRAFFIC_FILE])
+        run_command(['chmod', '600', TRAFFIC_FILE])
+        os.unlink(temp_file)
+
+        if result['success']:
+            _traffic_cache['mtime'] = _traffic_file_mtime()
+            _traffic_cache['data'] = traffic_data
+
+        return result['success']
+    except Exception as e:
+        print(f"Error saving traffic data: {e}")
+        return False
+
+
+def parse_transfer_size(size_str):
+    """将流量字符串转换为字节数（支持二进制和十进制单位）"""
+    if not size_str or size_str == '0 B':
+        return 0
+
+    # 二进制单位（1024为基数）
+    binary_units = {
+        'B': 1,
+        'KiB': 1024,
+        'MiB': 1024**2,
+        'GiB': 1024**3,
+        'TiB': 1024**4
+    }
+
+    # 十进制单位（1000为基数）
+    decimal_units = {
+        'B': 1,
+        'KB': 1000,
+        'MB': 1000**2,
+        'GB': 1000**3,
+        'TB': 1000**4
+    }
+
+    match = re.match(r'([\d.]+)\s*(\w+)', size_str)
+    if match:
+        value = float(match.group(1))
+        unit = match.group(2)
+        # 优先匹配二进制单位，然后匹配十进制单位
+        multiplier = binary_units.get(unit) or decimal_units.get(unit, 1)
+        return int(value * multiplier)
+    return 0
+
+
+def format_bytes(bytes_value):
+    """将字节数转换为十进制单位（MB, GB, TB）"""
+    if bytes_value == 0:
+        return '0 B'
+
+    units = ['B', 'KB', 'MB', 'GB', 'TB']
+    unit_index = 0
+    value = float(bytes_value)
+
+    # 使用1000为基数（十进制）
+    while value >= 1000 and unit_index < len(units) - 1:
+        value /= 1000
+        unit_index += 1
+
+    # 格式化输出
+    if value >= 100:
+        return f'{value:.1f} {units[unit_index]}'
+    elif value >= 10:
+        return f'{value:.2f} {units[unit_index]}'
+    else:
+        return f'{value:.2f} {units[unit_index]}'
+
+
+def format_wg_bytes(bytes_value):
+    """按 wg show 的格式输出字节数（二进制单位，如 1.23 GiB）"""
+    if bytes_value < 1024:
+        return f'{bytes_value} B'
+    for unit, size in (('TiB', 1024**4), ('GiB', 1024**3), ('MiB', 1024**2)):
+        if bytes_value >= size:
+            return f'{bytes_value / size:.2f} {unit}'
+    return f'{bytes_value / 1024:.2f} KiB'
+
+
+def format_handshake(handshake, now):
+    """将握手 epoch 时间戳格式化为 wg show 风格的相对时间"""
+    if not handshake:
+        return 'Never'
+    seconds = max(0, now - handshake)
+    if seconds == 0:
+        return 'Now'
+
+    parts = []
+    for unit, size in (('year', 365 * 86400), ('day', 86400), ('hour', 3600), ('minute', 60), ('second', 1)):
+        count, seconds = divmod(seconds, size)
+        if count:
+            parts.append(f"{count} {unit}{'s' if count > 1 else ''}")
+    return ', '.join(parts) + ' ago'
+
+
+# ==================== 耗时跟踪 ====================
+
+_trace_local = threading.local()
+
+
+def start_trace():
+    """在当前线程开始记录耗时片段，返回片段列表 [(名称, 秒)]"""
+    spans = _trace_local.spans = []
+    return spans
+
+
+def end_trace():
+    """结束当前线程的记录，返回片段列表（没有开始记录时为 None）"""
+    spans = getattr(_trace_local, 'spans', None)
+    _trace_local.spans = None
+    return spans
+
+
+@contextmanager
+def trace_span(name):
+    """记录一段代码的耗时（当前线程没有开始记录时只多一次属性读取）"""
+    spans = getattr(_trace_local, 'spans', None)
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, time.perf_counter() - started))
+
+
+def traced(fn):
+    """让线程池中执行的 fn 记录到提交线程的片段列表"""
+    spans = getattr(_trace_local, 'spans', None)
+    if spans is None:
+        return fn
+
+    def run(*args, **kwargs):
+        _trace_local.spans = spans
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _trace_local.spans = None
+    return run
+
+
+class BackendError(Exception):
+    """后端命令（wg / sudo 等）超时、熔断或无法执行"""
+
+
+class CircuitBreaker:
+    """
+    单类后端命令的熔断器和自适应超时
+
+    超时时间按 TCP RTO 的方式根据历史耗时估算（平滑均值 + 4 倍平均偏差），
+    限制在 [COMMAND_TIMEOUT_MIN, COMMAND_TIMEOUT_MAX] 之间。
+    连续 BREAKER_THRESHOLD 次超时/执行失败后熔断 BREAKER_COOLDOWN 秒，
+    期间直接失败；冷却结束后放行一次试探调用（半开），成功即恢复。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.srtt = None        # 平滑耗时（秒）
+        self.rttvar = 0.0       # 耗时平均偏差
+        self.failures = 0       # 连续失败次数
+        self.opened_at = None   # 熔断开始时间
+        self._probing = False   # 半开状态下是否已有试探调用
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return 'open'
+        return 'half_open'
+
+    def timeout(self):
+        if self.srtt is None:
+            return COMMAND_TIMEOUT_MAX
+        return min(COMMAND_TIMEOUT_MAX, max(COMMAND_TIMEOUT_MIN, self.srtt + 4 * self.rttvar))
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self, elapsed):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = elapsed
+                self.rttvar = elapsed / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - elapsed)
+                self.srtt = 0.875 * self.srtt + 0.125 * elapsed
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= BREAKER_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'timeout': round(self.timeout(), 3),
+            'avg_latency_ms': round(self.srtt * 1000, 1) if self.srtt is not None else None
+        }
+
+
+# 按命令名区分的熔断器（sudo 之后的实际命令，如 wg / wg-quick / cat）
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _get_breaker(cmd):
+    if isinstance(cmd, str):
+        parts = cmd.split()
+    else:
+        parts = list(cmd)
+    if parts and parts[0] == 'sudo':
+        parts = parts[1:]
+    name = os.path.basename(parts[0]) if parts else 'unknown'
+
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def run_command(cmd, use_sudo=True, shell=False, timeout=None):
+    """
+    执行命令并返回结果
+
+    Args:
+        cmd: 命令列表 (推荐) 或字符串 (仅用于需要shell的复杂命令)
+        use_sudo: 是否使用sudo
+        shell: 是否使用shell (仅在必要时使用)
+        timeout: 超时秒数，默认使用该命令熔断器的自适应超时
+
+    Returns:
+        dict: 包含success, stdout, stderr, returncode的字典；
+              超时、熔断或无法执行时包含 error（熔断时还有 circuit_open=True）
+    """
+    breaker = _get_breaker(cmd)
+    if not breaker.allow():
+        return {
+            'success': False,
+            'error': f'{breaker.name}: circuit open',
+            'circuit_open': True
+        }
+
+    started = time.monotonic()
+    try:
+        # 如果是字符串且不需要shell，转换为列表
+        if isinstance(cmd, str) and not shell:
+            cmd = cmd.split()
+
+        # 如果需要sudo且cmd是列表
+        if use_sudo and isinstance(cmd, list):
+            if cmd[0] != 'sudo':
+                cmd = ['sudo'] + cmd
+        elif use_sudo and isinstance(cmd, str):
+            if not cmd.startswith('sudo'):
+                cmd = f'sudo {cmd}'
+
+        with trace_span(f'cmd-{breaker.name}'):
+            result = subprocess.run(
+                cmd,
+                shell=shell,
+                capture_output=True,
+                text=True,
+                timeout=timeout or breaker.timeout()
+            )
+        breaker.record_success(time.monotonic() - started)
+        return {
+            'success': result.returncode == 0,
+            'stdout': result.stdout,
+            'stderr': result.stderr,
+            'returncode': result.returncode
+        }
+    except Exception as e:
+        # 超时或无法执行（返回码非 0 不算后端故障）
+        breaker.record_failure()
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+# ==================== 配置解析 ====================
+
+# 配置解析使用的预编译正则
+_NAME_COMMENT_RE = re.compile(r'#\s*(?:客户端|[Cc]lient\s*)[：:]')
+_NAME_SIMPLE_LINE_RE = re.compile(r'#\s*[a-zA-Z0-9_-]+\s*$')
+_NAME_CN_RE = re.compile(r'#\s*客户端[：:]\s*(\S+)')
+_NAME_EN_RE = re.compile(r'#\s*[Cc]lient\s*[：:]\s*(\S+)')
+_NAME_SIMPLE_RE = re.compile(r'#\s*([a-zA-Z0-9_-]+)\s*$')
+# AllowedIPs 可以有多个逗号分隔的网段，取到行尾
+_PEER_KEY_RE = re.compile(r'\s*(PublicKey|AllowedIPs)\s*=\s*([^\s#][^#]*?)\s*(?:#.*)?$')
+_GROUP_RE = re.compile(r'#\s*分组[：:]\s*(\S+)')
+_TAGS_RE = re.compile(r'#\s*标签[：:]\s*(.*?)\s*$')
+_TAG_SPLIT_RE = re.compile(r'[\s,，]+')
+_BLOCK_PUBLIC_KEY_RE = re.compile(r'^((?:#~ )?\s*PublicKey\s*=\s*)(\S+)', re.MULTILINE)
+
+# 简化格式注释中不作为客户端名称的词
+_NAME_EXCLUDED_WORDS = {'Peer', 'peer', 'PublicKey', 'AllowedIPs', 'Endpoint', 'PersistentKeepalive'}
+# 包含这些词的单词注释属于服务端配置，不是客户端名称注释
+_SERVER_COMMENT_WORDS = ('服务端', '监听', '启动', '关闭', 'Interface', 'Server')
+# 已禁用的 peer 块每行加此前缀注释掉（wg-quick strip 会忽略，保留在配置中）
+DISABLED_PREFIX = '#~ '
+
+
+def _is_name_comment(stripped):
+    """判断注释行是否是客户端名称注释（即新 peer 块的开始）"""
+    if _NAME_COMMENT_RE.match(stripped):
+        return True
+    return (_NAME_SIMPLE_LINE_RE.match(stripped) is not None and
+            not any(word in stripped for word in _SERVER_COMMENT_WORDS))
+
+
+def clean_label(value):
+    """清理分组/标签名称（允许中文，去掉空白、逗号、冒号和 #）"""
+    return re.sub(r'[\s,，:：#~]', '', str(value or ''))[:64]
+
+
+def parse_tags(value):
+    return tuple(tag for tag in (clean_label(t) for t in _TAG_SPLIT_RE.split(value or '')) if tag)
+
+
+def unknown_client_name(public_key):
+    """无名称注释的客户端使用公钥后 8 位（URL 安全）作为标识"""
+    safe_suffix = public_key.replace('+', '').replace('=', '').replace('/', '')[-8:]
+    return f'Unknown-{safe_suffix}'
+
+
+class PeerSpan:
+    """
+    配置文本中一个 peer 块的字符区间和解析出的字段
+
+    区间从块前的客户端名称注释开始（没有注释时从 [Peer] 行开始），
+    到下一个块的名称注释或 [Peer] 行之前结束，包含块尾的空行。
+    """
+    __slots__ = ('start', 'end', 'name', 'public_key', 'allowed_ips', 'disabled', 'group', 'tags')
+
+    def __init__(self, start, end, name, public_key, allowed_ips, disabled=False, group=None, tags=()):
+        self.start = start
+        self.end = end
+        self.name = name                  # 无名称注释时为 None
+        self.public_key = public_key      # 块中没有 PublicKey 时为 None
+        self.allowed_ips = allowed_ips
+        self.disabled = disabled          # [Peer] 行带 DISABLED_PREFIX
+        self.group = group                # 块中 # 分组: 注释
+        self.tags = tags                  # 块中 # 标签: 注释
+
+    @property
+    def client_name(self):
+        if self.name:
+            return self.name
+        return unknown_client_name(self.public_key) if self.public_key else None
+
+    def shifted(self, delta):
+        return PeerSpan(self.start + delta, self.end + delta, self.name, self.public_key, self.allowed_ips,
+                        self.disabled, self.group, self.tags)
+
+
+def _lex_config(text):
+    """
+    单遍扫描配置文本，返回 ([Interface] 部分结束偏移, PeerSpan 列表)
+
+    块边界规则与原来的逐行状态机一致：[Peer] 行或客户端名称注释开始新块，
+    peer 块内的其他注释和空行都属于当前块。带 DISABLED_PREFIX 的行去掉前缀后
+    按同样规则解析，[Peer] 行带前缀的块为已禁用块。
+    """
+    peers = []
+    block_start = None   # 当前块起始偏移
+    has_peer = False     # 当前块是否已经出现 [Peer] 行
+    names = [None, None, None]  # 中文 / 英文 / 简化 三种名称格式各自的第一个匹配
+    meta = [None, None]         # 分组 / 标签
+    public_key = allowed_ips = None
+    disabled = False
+
+    def close(end):
+        if block_start is None or not has_peer:
+            return
+        name = names[0] or names[1]
+        if name is None and names[2] and names[2] not in _NAME_EXCLUDED_WORDS and len(names[2]) > 1:
+            name = names[2]
+        peers.append(PeerSpan(block_start, end, name, public_key, allowed_ips, disabled,
+                              meta[0], meta[1] or ()))
+
+    pos = 0
+    length = len(text)
+    in_interface = True
+    while pos < length:
+        nl = text.find('\n', pos)
+        line_end = length if nl < 0 else nl + 1
+        line = text[pos:line_end]
+        line_disabled = line.startswith('#~')
+        if line_disabled:
+            line = line[3:] if line.startswith(DISABLED_PREFIX) else line[2:]
+        stripped = line.strip()
+
+        if stripped == '[Peer]':
+            if block_start is None or has_peer:
+                close(pos)
+                block_start = pos
+                names = [None, None, None]
+                meta = [None, None]
+            has_peer = True
+            in_interface = False
+            public_key = allowed_ips = None
+            disabled = line_disabled
+
+        elif stripped == '[Interface]':
+            close(pos)
+            block_start = None
+            has_peer = False
+            in_interface = True
+
+        elif stripped.startswith('#'):
+            if _is_name_comment(stripped) and (in_interface or has_peer or block_start is None):
+                # 新 peer 块的名称注释，结束 Interface 部分或上一个块
+                close(pos)
+                block_start = pos
+                has_peer = False
+                in_interface = False
+                names = [None, None, None]
+                meta = [None, None]
+            elif in_interface:
+                pos = line_end
+                continue
+
+        elif stripped and not has_peer and not in_interface:
+            # 名称注释和 [Peer] 之间出现其他内容：这段注释不属于任何块
+            block_start = None
+
+        if block_start is not None and '#' in line:
+            line_text = line.rstrip('\n')
+            if names[0] is None:
+                match = _NAME_CN_RE.search(line_text)
+                names[0] = match.group(1) if match else None
+            if names[1] is None:
+                match = _NAME_EN_RE.search(line_text)
+                names[1] = match.group(1) if match else None
+            if names[2] is None:
+                match = _NAME_SIMPLE_RE.search(line_text)
+                names[2] = match.group(1) if match else None
+            if meta[0] is None:
+                match = _GROUP_RE.match(stripped)
+                meta[0] = clean_label(match.group(1)) or None if match else None
+            if meta[1] is None:
+                match = _TAGS_RE.match(stripped)
+                meta[1] = parse_tags(match.group(1)) if match else None
+
+        if has_peer and '=' in line:
+            match = _PEER_KEY_RE.match(line)
+            if match:
+                if match.group(1) == 'PublicKey':
+                    public_key = public_key or match.group(2)
+                else:
+                    allowed_ips = allowed_ips or match.group(2)
+
+        pos = line_end
+
+    close(length)
+    interface_end = peers[0].start if peers else length
+    return interface_end, peers
+
+
+class ConfigIndex:
+    """
+    接口配置文本及其 peer 块区间索引
+
+    删除或替换一个 peer 只需要拼接对应区间，后续块的区间整体平移，
+    不需要重新解析整个配置；校验也只针对被修改的块。
+    """
+    __slots__ = ('text', 'interface_end', 'peers')
+
+    def __init__(self, text, interface_end=None, peers=None):
+        self.text = text
+        if peers is None:
+            interface_end, peers = _lex_config(text)
+        self.interface_end = interface_end
+        self.peers = peers
+
+    @property
+    def interface_text(self):
+        return self.text[:self.interface_end]
+
+    @property
+    def peers_text(self):
+        return self.text[self.interface_end:]
+
+    def block_text(self, span):
+        return self.text[span.start:span.end]
+
+    def find(self, client_name):
+        """
+        查找客户端对应的 peer 块序号
+
+        Unknown-XXXX 形式按公钥后缀匹配，其余按名称注释匹配。
+        """
+        if client_name.startswith('Unknown-'):
+            return [i for i, span in enumerate(self.peers)
+                    if span.public_key and unknown_client_name(span.public_key) == client_name]
+        return [i for i, span in enumerate(self.peers) if span.name == client_name]
+
+    def find_public_key(self, public_key):
+        return [i for i, span in enumerate(self.peers) if span.public_key == public_key]
+
+    def set_disabled(self, i, disabled):
+        """禁用（注释掉）或启用第 i 个 peer 块，返回新的 ConfigIndex"""
+        span = self.peers[i]
+        if span.disabled == disabled:
+            return self
+        lines = self.block_text(span).splitlines(True)
+        if disabled:
+            lines = [DISABLED_PREFIX + line if line.strip() and not line.startswith('#~') else line
+                     for line in lines]
+        else:
+            lines = [line[3:] if line.startswith(DISABLED_PREFIX) else line[2:] if line.startswith('#~') else line
+                     for line in lines]
+        return self.splice(i, ''.join(lines))
+
+    def set_metadata(self, i, group=None, tags=None):
+        """
+        修改第 i 个 peer 块的分组/标签注释，返回新的 ConfigIndex
+
+        Args:
+            group: 新分组，None 表示不变，空字符串表示清除
+            tags: 新标签列表，None 表示不变，空列表表示清除
+        """
+        span = self.peers[i]
+        new_group = span.group if group is None else (clean_label(group) or None)
+        new_tags = span.tags if tags is None else parse_tags(','.join(tags))
+        if new_group == span.group and new_tags == span.tags:
+            return self
+
+        prefix = DISABLED_PREFIX if span.disabled else ''
+        lines = []
+        insert_at = None
+        for line in self.block_text(span).splitlines(True):
+            content = line[3:] if line.startswith(DISABLED_PREFIX) else line
+            stripped = content.strip()
+            if _GROUP_RE.match(stripped) or _TAGS_RE.match(stripped):
+                continue
+            if insert_at is None and (_is_name_comment(stripped) or stripped == '[Peer]'):
+                # 元数据放在名称注释之后；没有名称注释时放在 [Peer] 之前
+                insert_at = len(lines) + (0 if stripped == '[Peer]' else 1)
+            lines.append(line)
+
+        meta_lines = []
+        if new_group:
+            meta_lines.append(f'{prefix}# 分组: {new_group}\n')
+        if new_tags:
+            meta_lines.append(f'{prefix}# 标签: {", ".join(new_tags)}\n')
+        lines[insert_at:insert_at] = meta_lines
+        return self.splice(i, ''.join(lines))
+
+    def replace_public_key(self, i, public_key):
+        """返回第 i 个 peer 块替换 PublicKey 后的文本（不修改索引）"""
+        return _BLOCK_PUBLIC_KEY_RE.sub(lambda m: m.group(1) + public_key, self.block_text(self.peers[i]), count=1)
+
+    def splice_many(self, replacements):
+        """
+        一次替换多个 peer 块（{序号: 新块文本}），返回新的 ConfigIndex
+
+        批量修改时只拼接一次文本并重新扫描一次，避免逐块 splice 的平方开销。
+
+        Raises:
+            ValueError: 某个新块不是完整的 peer 块
+        """
+        if not replacements:
+            return self
+        parts = []
+        pos = 0
+        for i in sorted(replacements):
+            span = self.peers[i]
+            block = replacements[i]
+            if not block.endswith('\n'):
+                block += '\n'
+            errors = validate_peer_block(block)
+            if errors:
+                raise ValueError(', '.join(errors))
+            parts.append(self.text[pos:span.start])
+            parts.append(block)
+            pos = span.end
+        parts.append(self.text[pos:])
+        return ConfigIndex(''.join(parts))
+
+    def splice(self, i, replacement=''):
+        """
+        用 replacement 替换第 i 个 peer 块（空字符串表示删除），返回新的 ConfigIndex
+
+        Raises:
+            ValueError: replacement 不是一个完整的 peer 块
+        """
+        span = self.peers[i]
+        new_spans = []
+        if replacement:
+            if not replacement.endswith('\n'):
+                replacement += '\n'
+            errors = validate_peer_block(replacement)
+            if errors:
+                raise ValueError(', '.join(errors))
+            _, new_spans = _lex_config(replacement)
+
+        left = self.text[:span.start]
+        right = self.text[span.end:]
+        if not replacement:
+            # 只在拼接处清理多余的连续空行
+            while left.endswith('\n\n') and right.startswith('\n'):
+                right = right[1:]
+        text = left + replacement + right
+
+        delta = len(text) - len(self.text)
+        peers = (self.peers[:i] +
+                 [s.shifted(span.start) for s in new_spans] +
+                 [s.shifted(delta) for s in self.peers[i + 1:]])
+        return ConfigIndex(text, peers[0].start if peers else len(text), peers)
+
+
+def validate_peer_block(block):
+    """校验单个 peer 块文本，返回错误列表"""
+    _, spans = _lex_config(block)
+    if len(spans) != 1:
+        return [f'应包含 1 个 [Peer]，实际 {len(spans)} 个']
+    errors = []
+    if not spans[0].public_key:
+        errors.append('缺少PublicKey')
+    if not spans[0].allowed_ips:
+        errors.append('缺少AllowedIPs')
+    return errors
+
+
+def remove_peer_block(index, client_name):
+    """
+    从配置中删除指定客户端的 peer 块（包括其前置注释）
+
+    Args:
+        index: 接口配置的 ConfigIndex
+        client_name: 已清理过的客户端名称（Unknown-XXXX 形式按公钥后缀匹配）
+
+    Returns:
+        tuple: (新的 ConfigIndex, 删除的 PeerSpan 列表)
+    """
+    removed = []
+    # 从后往前拼接，前面块的区间不受影响
+    for i in reversed(index.find(client_name)):
+        span = index.peers[i]
+        block = index.block_text(span)
+        # 被删除的区间必须恰好是这个 peer 块
+        _, check = _lex_config(block)
+        if len(check) != 1 or check[0].public_key != span.public_key:
+            raise ValueError(f'peer 块边界异常: {client_name}')
+        removed.append(span)
+        index = index.splice(i)
+    return index, removed
+
+
+# syncconf 成功后调用的回调（参数为接口），用于重新应用只存在于运行时的修改
+_reload_hooks = []
+
+
+class WGInterface:
+    """
+    单个 WireGuard 接口
+
+    每个接口拥有独立的配置文件、客户端配置目录、IP 分配和运行时读取，
+    多个接口之间互不共享状态。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.conf = f"{WG_DIR}/{name}.conf"
+        # 主接口沿用原有客户端目录，其他接口使用独立子目录
+        self.client_dir = CLIENT_DIR if name == WG_INTERFACE else f"{CLIENT_DIR}/{name}"
+        self._config_cache = (None, None, None)  # (mtime, 配置文本, ConfigIndex)
+
+    def read_config(self):
+        """读取接口配置文件（按 mtime 缓存），读取失败返回 None"""
+        if not os.path.exists(self.conf):
+            return None
+
+        try:
+            mtime = os.stat(self.conf).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and self._config_cache[0] == mtime:
+            return self._config_cache[1]
+
+        result = run_command(['cat', self.conf], use_sudo=False)
+        if not result['success']:
+            # 尝试使用 sudo 读取
+            result = run_command(['cat', self.conf])
+            if not result['success']:
+                return None
+
+        self._config_cache = (mtime, result['stdout'], None)
+        return result['stdout']
+
+    def read_index(self):
+        """读取配置并返回 ConfigIndex（与配置文本一起按 mtime 缓存），读取失败返回 None"""
+        config = self.read_config()
+        if config is None:
+            return None
+        mtime, text, index = self._config_cache
+        if index is None or text is not config:
+            with trace_span('parse'):
+                index = ConfigIndex(config)
+            if text is config:
+                self._config_cache = (mtime, text, index)
+        return index
+
+    def invalidate(self):
+        """配置文件被修改后清除缓存"""
+        self._config_cache = (None, None, None)
+
+    def invalidate_if_changed(self):
+        """配置文件的 mtime 与缓存不一致（被其他进程或手工修改）时清除缓存，返回是否清除"""
+        try:
+            mtime = os.stat(self.conf).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and self._config_cache[0] == mtime:
+            return False
+        self.invalidate()
+        return True
+
+    def runtime_peers(self):
+        return get_runtime_peers(self.name)
+
+    def is_active(self):
+        return run_command(['wg', 'show', self.name], use_sudo=False)['success']
+
+    def peer_count(self):
+        index = self.read_index()
+        if index is None or 'placeholder' in index.text:
+            return 0
+        return len(index.peers)
+
+    def allocate_ip(self, config):
+        """
+        在接口网段中分配下一个可用 IP
+
+        Returns:
+            str: 客户端 IP，无法确定网段时返回 None
+        """
+        address_match = re.search(r'Address\s*=\s*(\d+\.\d+\.\d+)\.\d+', config)
+        if not address_match:
+            return None
+
+        subnet = address_match.group(1)
+        used_ips = {int(ip) for ip in re.findall(r'AllowedIPs\s*=\s*' + re.escape(subnet) + r'\.(\d+)/32', config)}
+
+        next_ip = 2
+        while next_ip in used_ips:
+            next_ip += 1
+        return f"{subnet}.{next_ip}"
+
+    def write_config(self, config):
+        """
+        写入接口配置文件（临时文件 + cp，保留原文件权限），返回是否成功
+
+        Args:
+            config: 配置文本或 ConfigIndex（传入索引时直接作为新的缓存，不再重新解析）
+        """
+        index = config if isinstance(config, ConfigIndex) else None
+        text = index.text if index else config
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write(text)
+            temp_file = f.name
+
+        result = run_command(['cp', temp_file, self.conf])
+        os.unlink(temp_file)
+        self.invalidate()
+        if result['success'] and index:
+            try:
+                self._config_cache = (os.stat(self.conf).st_mtime_ns, text, index)
+            except OSError:
+                pass
+        return result['success']
+
+    def apply_peers(self, changes):
+        """
+        用一条 wg set 命令批量修改运行时 peer，不触碰其他 peer
+
+        Args:
+            changes: [(公钥, allowed_ips)] 列表，allowed_ips 为 None 表示移除该 peer，
+                空字符串表示只加入 peer、不分配 AllowedIPs（已存在时不修改）
+
+        Returns:
+            dict: run_command 结果
+        """
+        if not changes:
+            return {'success': True, 'stdout': '', 'stderr': '', 'returncode': 0}
+
+        cmd = ['wg', 'set', self.name]
+        for public_key, allowed_ips in changes:
+            if allowed_ips is None:
+                cmd += ['peer', public_key, 'remove']
+            elif allowed_ips == '':
+                cmd += ['peer', public_key]
+            else:
+                cmd += ['peer', public_key, 'allowed-ips', re.sub(r'\s+', '', allowed_ips)]
+        return run_command(cmd)
+
+    def reload(self):
+        """
+        将配置文件同步到运行时（wg-quick strip + wg syncconf 两步法，代替进程替换）
+
+        Returns:
+            dict: run_command 结果，额外包含失败阶段 stage（strip 或 syncconf）
+        """
+        strip_result = run_command(['wg-quick', 'strip', self.name])
+        if not strip_result['success']:
+            strip_result['stage'] = 'strip'
+            return strip_result
+
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.conf') as strip_f:
+            strip_f.write(strip_result['stdout'])
+            strip_file = strip_f.name
+
+        result = run_command(['wg', 'syncconf', self.name, strip_file])
+        os.unlink(strip_file)
+        result['stage'] = 'syncconf'
+        if result['success']:
+            for hook in _reload_hooks:
+                hook(self)
+        return result
+
+
+# 所有受管理的接口（按配置顺序，第一个为主接口）
+INTERFACES = {name: WGInterface(name) for name in WG_INTERFACES}
+
+# 多接口状态并行采集使用的线程池
+_interface_pool = ThreadPoolExecutor(max_workers=max(2, len(INTERFACES)), thread_name_prefix='wg-iface')
+
+
+def get_interface(name=None):
+    """按名称获取接口，未指定时返回主接口；名称未知时返回 None"""
+    return INTERFACES.get(name or WG_INTERFACE)
+
+
+def choose_interface():
+    """按 WG_SHARD_POLICY 为新客户端选择接口"""
+    primary = INTERFACES[WG_INTERFACE]
+    if WG_SHARD_POLICY != 'least_loaded' or len(INTERFACES) == 1:
+        return primary
+
+    # 只考虑已完成初始化的接口
+    candidates = []
+    for iface in INTERFACES.values():
+        config = iface.read_config()
+        if config and 'placeholder' not in config:
+            candidates.append((iface.peer_count(), iface))
+    if not candidates:
+        return primary
+    return min(candidates, key=lambda item: item[0])[1]
+
+
+def get_server_info(iface=None):
+    """获取服务器信息（默认主接口）"""
+    if iface is None:
+        iface = get_interface()
+    try:
+        # 检查配置文件是否存在
+        if not os.path.exists(iface.conf):
+            print(f"DEBUG: Config file {iface.conf} does not exist")
+            return {'interface': iface.name, 'error': 'WireGuard configuration not found'}
+
+        # 检查文件权限
+        try:
+            stat_info = os.stat(iface.conf)
+            print(f"DEBUG: Config file permissions: {oct(stat_info.st_mode)[-3:]}, owner: {stat_info.st_uid}:{stat_info.st_gid}")
+        except Exception as e:
+            print(f"DEBUG: Cannot stat config file: {e}")
+
+        # 获取服务器配置
+        config = iface.read_config()
+        if config is None:
+            print(f"DEBUG: Cannot read config file {iface.conf}")
+            return {'interface': iface.name, 'error': 'Cannot read WireGuard config'}
+
+        # 检查是否是占位符配置
+        if 'placeholder' in config:
+            print("DEBUG: Found placeholder configuration")
+            return {'interface': iface.name, 'error': 'WireGuard not fully initialized yet'}
+
+        # 解析配置
+        address_match = re.search(r'Address\s*=\s*([^\s]+)', config)
+        port_match = re.search(r'ListenPort\s*=\s*(\d+)', config)
+        server_info = {
+            'interface': iface.name,
+            'address': address_match.group(1) if address_match else 'N/A',
+            'listen_port': port_match.group(1) if port_match else 'N/A',
+            'peer_count': iface.peer_count(),
+        }
+
+        # 服务端地址（缓存，不在每次请求时探测）
+        server_info['public_ip'] = endpoint.current() or 'N/A'
+
+        # 获取服务状态
+        server_info['status'] = 'active' if iface.is_active() else 'inactive'
+
+        print(f"DEBUG: Successfully read config, server_info: {server_info}")
+        return server_info
+    except Exception as e:
+        print(f"DEBUG: Exception in get_server_info: {e}")
+        return {'interface': iface.name, 'error': str(e)}
+
+
+def get_all_server_info():
+    """并行获取所有接口的服务器信息"""
+    return list(_interface_pool.map(traced(get_server_info), INTERFACES.values()))
+
+
+def get_runtime_peers(interface):
+    """
+    读取接口运行时状态（wg show <interface> dump）
+
+    Returns:
+        dict: {公钥: (最后握手epoch, 接收字节, 发送字节)}，接口未启动时返回空字典
+
+    Raises:
+        BackendError: wg 命令超时、熔断或无法执行
+    """
+    result = run_command(['wg', 'show', interface, 'dump'], use_sudo=False)
+    if 'error' in result:
+        raise BackendError(result['error'])
+    if not result['success']:
+        return {}
+
+    peers = {}
+    # 第一行是接口自身信息，其余每行一个 peer（制表符分隔）
+    for line in result['stdout'].splitlines()[1:]:
+        fields = line.split('\t')
+        if len(fields) < 8:
+            continue
+        try:
+            peers[fields[0]] = (int(fields[4]), int(fields[5]), int(fields[6]))
+        except ValueError:
+            continue
+    return peers
+
+
+def normalize_allowed_ips(value):
+    """AllowedIPs 规范化为逗号分隔的有序网段（与内核一样去掉主机位），空值和 (none) 为空字符串"""
+    networks = set()
+    for item in re.split(r'[\s,]+', value or ''):
+        if not item or item == '(none)':
+            continue
+        try:
+            networks.add(str(ipaddress.ip_network(item, strict=False)))
+        except ValueError:
+            networks.add(item)
+    return ','.join(sorted(networks))
+
+
+def get_runtime_allowed_ips(interface):
+    """
+    读取运行时各 peer 的 AllowedIPs（wg show <interface> allowed-ips）
+
+    Returns:
+        dict: {公钥: 规范化的 AllowedIPs}，接口未启动时返回 None
+
+    Raises:
+        BackendError: wg 命令超时、熔断或无法执行
+    """
+    result = run_command(['wg', 'show', interface, 'allowed-ips'], use_sudo=False)
+    if 'error' in result:
+        raise BackendError(result['error'])
+    if not result['success']:
+        return None
+    peers = {}
+    for line in result['stdout'].splitlines():
+        public_key, _, allowed_ips = line.partition('\t')
+        if public_key.strip():
+            peers[public_key.strip()] = normalize_allowed_ips(allowed_ips)
+    return peers
+
+
+def diff_peers(expected, running):
+    """
+    对比期望的运行时 peer 和实际运行时 peer（都是 {公钥: AllowedIPs}）
+
+    Returns:
+        tuple: (差异列表 [{public_key, kind, expected, running}]，kind 为 missing / extra / allowed_ips；
+                修正差异的最小修改列表，格式同 WGInterface.apply_peers)
+    """
+    drift, changes = [], []
+    for public_key, allowed_ips in expected.items():
+        allowed_ips = normalize_allowed_ips(allowed_ips)
+        current = running.get(public_key)
+        if current == allowed_ips:
+            continue
+        drift.append({'public_key': public_key, 'kind': 'missing' if current is None else 'allowed_ips',
+                      'expected': allowed_ips, 'running': current})
+        # 空字符串只加入 peer，无法清除已有的 AllowedIPs，先移除再加入
+        if current and not allowed_ips:
+            changes.append((public_key, None))
+        changes.append((public_key, allowed_ips))
+    for public_key, current in running.items():
+        if public_key not in expected:
+            drift.append({'public_key': public_key, 'kind': 'extra', 'expected': None, 'running': current})
+            changes.append((public_key, None))
+    return drift, changes
+
+
+def _parse_peer_data(span, interface, runtime_peers, traffic_data, now):
+    """
+    根据 peer 块区间生成客户端记录
+
+    Args:
+        span: ConfigIndex 中的 PeerSpan
+        interface: peer 所属接口名称
+        runtime_peers: get_runtime_peers() 的返回值，用于获取连接状态
+        traffic_data: 流量数据字典（会被修改）
+        now: 当前 epoch 秒
+
+    Returns:
+        tuple: (PeerRecord, 流量是否变化)，如果是无效块（没有公钥）返回 (None, False)
+    """
+    if not span.public_key:
+        return None, False  # 无效的peer块
+    pubkey = span.public_key
+    name = span.client_name
+    ip = span.allowed_ips.replace('/32', '') if span.allowed_ips else 'N/A'
+
+    # 从运行时状态获取握手时间和流量计数
+    handshake, current_rx, current_tx = runtime_peers.get(pubkey, (0, 0, 0))
+
+    # 流量持久化和累计计算（traffic_data 作为参数传入，不在这里加载）
+    client_traffic = traffic_data.get(name)
+    if client_traffic is None:
+        client_traffic = traffic_data[name] = TrafficRecord(last_update=now)
+        changed = True
+    else:
+        changed = False
+    if client_traffic.update(current_rx, current_tx, now):
+        changed = True
+
+    record = PeerRecord(
+        name, pubkey, ip,
+        interface=interface,
+        rx=current_rx,
+        tx=current_tx,
+        total_rx=client_traffic.total_rx,
+        total_tx=client_traffic.total_tx,
+        handshake=handshake,
+        disabled=span.disabled,
+        group=span.group,
+        tags=span.tags
+    )
+    return record, changed
+
+
+def _parse_interface_clients(iface, index, runtime_peers, traffic_data, now, changed_clients=None):
+    """
+    解析单个接口配置中的所有客户端
+
+    Args:
+        changed_clients: 可选列表，流量计数发生变化的 PeerRecord 会追加到其中
+
+    Returns:
+        tuple: (PeerRecord 列表, 流量数据是否变化)
+    """
+    clients = []
+    traffic_changed = False
+    for span in index.peers:
+        client, changed = _parse_peer_data(span, iface.name, runtime_peers, traffic_data, now)
+        traffic_changed = traffic_changed or changed
+        if client:
+            clients.append(client)
+            if changed and changed_clients is not None:
+                changed_clients.append(client)
+
+    # 检测重复的公钥
+    pubkey_count = {}
+    for client in clients:
+        pubkey_count[client.public_key] = pubkey_count.get(client.public_key, 0) + 1
+    for client in clients:
+        client.duplicates = pubkey_count[client.public_key]
+
+    return clients, traffic_changed
+
+
+def _read_interface_state(iface):
+    """读取单个接口的配置索引和运行时状态（在线程池中并行执行）"""
+    index = iface.read_index()
+    if index is None and os.path.exists(iface.conf):
+        # 文件存在但读取失败（cat/sudo 超时或熔断），不能当作没有客户端
+        raise BackendError(f'无法读取 {iface.conf}')
+    # 检查是否是占位符配置
+    if index is None or not index.text or 'placeholder' in index.text:
+        return iface, None, {}
+    return iface, index, iface.runtime_peers()
+
+
+def get_clients(interface=None, changed_clients=None):
+    """
+    获取所有（或指定接口的）客户端信息，返回 PeerRecord 列表
+
+    Args:
+        interface: 只读取指定接口
+        changed_clients: 可选列表，收集本次流量计数发生变化的客户端
+
+    Raises:
+        BackendError: 配置或运行时状态读取失败（调用方可回退到上一次的快照）
+    """
+    if interface:
+        targets = [get_interface(interface)] if get_interface(interface) else []
+    else:
+        targets = list(INTERFACES.values())
+
+    # 并行读取各接口的配置和运行时状态
+    states = list(_interface_pool.map(traced(_read_interface_state), targets))
+
+    # 加载流量数据（整个函数只加载一次）
+    traffic_data = load_traffic_data()
+
+    clients = []
+    traffic_changed = False
+    now = int(time.time())
+    for iface, index, runtime_peers in states:
+        if index is None:
+            continue
+        with trace_span('peers'):
+            iface_clients, changed = _parse_interface_clients(iface, index, runtime_peers, traffic_data, now,
+                                                              changed_clients)
+        clients.extend(iface_clients)
+        traffic_changed = traffic_changed or changed
+
+    # 保存流量数据（整个函数最多保存一次，计数未变化时跳过）
+    if traffic_changed:
+        save_traffic_data(traffic_data)
+
+    return clients
+
+
+# ==================== 服务端地址发现 ====================
+
+WG_ENDPOINT = os.environ.get('WG_ENDPOINT', '').strip()                   # 客户端配置中的服务端地址（域名或 IP），设置后不再探测
+ENDPOINT_PROBES = [probe.strip() for probe in os.environ.get('ENDPOINT_PROBES', 'route').split(',')
+                   if probe.strip()]                                      # 探测方式（按顺序）：route 或返回 IP 文本的 http(s) 地址
+ENDPOINT_PROBE_TIMEOUT = float(os.environ.get('ENDPOINT_PROBE_TIMEOUT', '3'))   # 单个 http 探测的超时（秒）
+ENDPOINT_STATE_FILE = f"{WG_DIR}/endpoint.json"
+
+
+def _probe_route():
+    """默认路由的源地址（ip route get，IPv4 优先）"""
+    for target in ('1.1.1.1', '2606:4700:4700::1111'):
+        result = run_command(['ip', 'route', 'get', target], use_sudo=False)
+        match = re.search(r'\bsrc\s+(\S+)', result['stdout']) if result['success'] else None
+        if match:
+            return match.group(1)
+    return None
+
+
+def _probe_http(url):
+    """http(s) 探测：响应正文为 IP 地址文本（如 https://api.ipify.org）"""
+    import urllib.request
+    with urllib.request.urlopen(url, timeout=ENDPOINT_PROBE_TIMEOUT) as response:
+        text = response.read(64).decode('ascii', 'replace').strip()
+    return str(ipaddress.ip_address(text))
+
+
+def format_endpoint(host, port):
+    """客户端配置中的 Endpoint 值，IPv6 地址加方括号"""
+    return f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+
+
+class EndpointDiscovery:
+    """
+    服务端地址发现
+
+    优先使用 WG_ENDPOINT；否则按 ENDPOINT_PROBES 顺序探测，取第一个成功的结果：
+    route 为默认路由的源地址，http(s) 地址为其返回的公网 IP。结果缓存在内存和
+    endpoint.json 中，get_server_info 和新建客户端只读缓存，重新探测由 Web 后端
+    定时或在路由变化时调用 discover() 完成。
+    """
+
+    def __init__(self, state_path, override=None, probes=()):
+        self.state_path = state_path
+        self.override = override or None
+        self.probes = list(probes)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._host = None
+        self.source = None
+        self.updated_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._host = state.get('host') or None
+        self.source = state.get('source')
+        self.updated_at = state.get('updated_at')
+
+    def cached(self):
+        """上次确定的地址（不探测），没有记录时返回 None"""
+        with self._lock:
+            self._ensure_loaded()
+            return self._host
+
+    def discover(self):
+        """
+        重新探测（不修改缓存）
+
+        Returns:
+            tuple: (地址, 来源)，全部探测失败时为 (None, None)
+        """
+        if self.override:
+            return self.override, 'env'
+        for probe in self.probes:
+            try:
+                if probe == 'route':
+                    host = _probe_route()
+                elif probe.startswith(('http://', 'https://')):
+                    host = _probe_http(probe)
+                else:
+                    print(f"DEBUG: Unknown endpoint probe: {probe}")
+                    continue
+            except Exception as e:
+                print(f"DEBUG: Endpoint probe {probe} failed: {e}")
+                continue
+            if host:
+                return host, probe
+        return None, None
+
+    def update(self, host, source):
+        """记录新地址并写入 endpoint.json"""
+        with self._lock:
+            self._loaded = True
+            self._host, self.source, self.updated_at = host, source, int(time.time())
+            state = {'host': host, 'source': source, 'updated_at': self.updated_at}
+        temp_path = self.state_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            print(f"DEBUG: Cannot save endpoint state: {e}")
+
+    def current(self):
+        """当前地址：优先缓存，没有缓存时探测一次；无法确定时返回 None"""
+        host = self.cached()
+        if host is None or (self.override and host != self.override):
+            host, source = self.discover()
+            if host:
+                self.update(host, source)
+        return host
+
+    def status(self):
+        with self._lock:
+            self._ensure_loaded()
+            return {'host': self._host, 'source': self.source, 'updated_at': self.updated_at,
+                    'override': self.override, 'probes': self.probes}
+
+
+endpoint = EndpointDiscovery(ENDPOINT_STATE_FILE, WG_ENDPOINT, ENDPOINT_PROBES)
+
+
+# ==================== 密钥 ====================
+
+_X25519_P = 2 ** 255 - 19
+_x25519 = None
+
+
+def _x25519_module():
+    """延迟导入 cryptography 的 X25519（导入较慢），未安装时返回 None"""
+    global _x25519
+    if _x25519 is None:
+        try:
+            from cryptography.hazmat.primitives.asymmetric import x25519
+            _x25519 = x25519
+        except ImportError:
+            _x25519 = False
+    return _x25519 or None
+
+
+def _x25519_base(scalar):
+    """RFC 7748 X25519 标量乘基点（没有安装 cryptography 时使用）"""
+    k = int.from_bytes(scalar, 'little')
+    k = (k & ~7 & ~(1 << 255)) | (1 << 254)
+    p = _X25519_P
+    x1, x2, z2, x3, z3 = 9, 1, 0, 9, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        bit = (k >> t) & 1
+        if swap ^ bit:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = bit
+        a = x2 + z2
+        aa = a * a % p
+        b = x2 - z2
+        bb = b * b % p
+        e = aa - bb
+        da = (x3 - z3) * a % p
+        cb = (x3 + z3) * b % p
+        x3 = (da + cb) ** 2 % p
+        z3 = x1 * (da - cb) ** 2 % p
+        x2 = aa * bb % p
+        z2 = e * (aa + 121665 * e) % p
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, p - 2, p) % p).to_bytes(32, 'little')
+
+
+def public_key_from_private(private_key):
+    """由 base64 私钥计算公钥（等价于 wg pubkey）"""
+    raw = base64.b64decode(private_key)
+    x25519 = _x25519_module()
+    if x25519 is not None:
+        public = x25519.X25519PrivateKey.from_private_bytes(raw).public_key().public_bytes_raw()
+    else:
+        public = _x25519_base(raw)
+    return base64.b64encode(public).decode()
+
+
+def generate_keypair():
+    """
+    在进程内生成 WireGuard 密钥对（等价于 wg genkey | wg pubkey，不启动子进程）
+
+    Returns:
+        tuple: (私钥, 公钥)，均为 base64
+    """
+    raw = bytearray(os.urandom(32))
+    raw[0] &= 248
+    raw[31] = (raw[31] & 127) | 64
+    private_key = base64.b64encode(bytes(raw)).decode()
+    return private_key, public_key_from_private(private_key)
+
+
+def _read_private_file(path):
+    """读取文件，不存在返回 None（无权限时用 sudo 读取）"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except PermissionError:
+        result = run_command(['cat', path])
+        return result['stdout'] if result['success'] else None
+
+
+def _write_private_file(path, content):
+    """写入权限 600 的文件：同目录临时文件 + rename；目录不可写时退回 sudo cp"""
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.rotate-')
+    except PermissionError:
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+            f.write(content)
+            temp_file = f.name
+        result = run_command(['cp', temp_file, path])
+        os.unlink(temp_file)
+        if not result['success']:
+            raise RuntimeError(f'无法写入 {path}')
+        run_command(['chmod', '600', path])
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+# ==================== 二维码 ====================
+
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', '512'))   # 缓存的客户端二维码数量，0 关闭
+
+_qrcode = None
+# 按配置内容摘要缓存的二维码 PNG（LRU），配置改变（如密钥轮换）后摘要不同，不会返回旧图
+_qr_cache = OrderedDict()
+_qr_cache_lock = threading.Lock()
+
+
+def _qrcode_module():
+    """延迟导入 qrcode 库（依赖 PIL，导入较慢），未安装时返回 None"""
+    global _qrcode
+    if _qrcode is None:
+        try:
+            import qrcode
+            _qrcode = qrcode
+        except ImportError:
+            _qrcode = False
+    return _qrcode or None
+
+
+def render_qrcode_png(config_text, mask_pattern=None):
+    """
+    把配置渲染为 PNG 二维码
+
+    优先在进程内使用 qrcode 库，未安装时调用 qrencode 命令。
+
+    Args:
+        mask_pattern: 固定掩码（0-7），跳过逐个评估 8 种掩码，渲染快约 3 倍；None 表示选最优掩码
+
+    Returns:
+        bytes: PNG 数据，失败返回 None
+    """
+    qrcode = _qrcode_module()
+    if qrcode is not None:
+        try:
+            qr = qrcode.QRCode(mask_pattern=mask_pattern)
+            qr.add_data(config_text)
+            qr.make(fit=True)
+            buffer = BytesIO()
+            qr.make_image().save(buffer)
+            return buffer.getvalue()
+        except Exception:
+            return None
+
+    try:
+        # 创建临时文件
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as f:
+            f.write(config_text)
+            temp_file = f.name
+
+        # 生成二维码到临时文件 (需要shell进行输入重定向)
+        png_file = temp_file + '.png'
+        result = run_command(f'qrencode -o {png_file} < {temp_file}', shell=True)
+
+        if result['success'] and os.path.exists(png_file):
+            with open(png_file, 'rb') as f:
+                png = f.read()
+
+            # 清理临时文件
+            os.unlink(temp_file)
+            os.unlink(png_file)
+
+            return png
+        else:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+            return None
+    except Exception as e:
+        print(f"QR code generation failed: {e}")
+        return None
+
+
+def cached_qrcode_png(config_text):
+    """render_qrcode_png 的 LRU 缓存版本"""
+    key = hashlib.sha256(config_text.encode()).digest()
+    with _qr_cache_lock:
+        png = _qr_cache.get(key)
+        if png is not None:
+            _qr_cache.move_to_end(key)
+            return png
+    png = render_qrcode_png(config_text)
+    if png and QR_CACHE_SIZE > 0:
+        with _qr_cache_lock:
+            _qr_cache[key] = png
+            while len(_qr_cache) > QR_CACHE_SIZE:
+                _qr_cache.popitem(last=False)
+    return png
+
+
+def generate_qrcode(config_text):
+    """生成二维码（base64 PNG）"""
+    png = cached_qrcode_png(config_text)
+    return base64.b64encode(png).decode() if png else None
+
+
+def read_client_config(client_name):
+    """
+    在各接口的客户端目录中查找并读取客户端配置
+
+    Args:
+        client_name: 已清理过的客户端名称
+
+    Returns:
+        str: 配置文本，未找到返回 None
+    """
+    for iface in INTERFACES.values():
+        # 验证路径以防止路径遍历攻击
+        config_file = os.path.normpath(os.path.join(iface.client_dir, f"{client_name}.conf"))
+        # 确保文件在客户端目录中
+        if not config_file.startswith(os.path.normpath(iface.client_dir)):
+            return None
+
+        result = run_command(['cat', config_file])
+        if result['success']:
+            return result['stdout']
+    return None
+
+
+# ==================== 客户端增删 ====================
+
+def create_client(client_name, interface=None, group=None, tags=None):
+    """
+    添加新客户端：分配 IP、在进程内生成密钥和客户端配置、追加 peer 块并把新 peer 加入运行时
+
+    Args:
+        client_name: 客户端名称（会被清理为 [a-zA-Z0-9_-]）
+        interface: 目标接口名称，未指定时按分配策略选择
+        group: 可选分组
+        tags: 可选标签列表
+
+    Returns:
+        dict: 包含 success 以及 client 或 error 的结果字典；成功时另含 peer 块 block
+              和客户端文件 files（供调用方记录复制增量）
+    """
+    try:
+        client_name = (client_name or '').strip()
+
+        if not client_name:
+            return {'success': False, 'error': 'Client name is required'}
+
+        # 清理客户端名称
+        client_name = re.sub(r'[^a-zA-Z0-9_-]', '', client_name)
+
+        # 选择接口：请求中显式指定，否则按分配策略选择
+        if interface:
+            iface = get_interface(interface)
+            if iface is None:
+                return {'success': False, 'error': f'未知接口: {interface}'}
+        else:
+            iface = choose_interface()
+
+        # 获取服务器信息
+        server_info = get_server_info(iface)
+        if server_info.get('error'):
+            return {'success': False, 'error': server_info['error']}
+        iface.invalidate()
+        config = iface.read_config()
+        if config is None:
+            return {'success': False, 'error': 'Cannot read config'}
+
+        # 检查客户端名称是否已存在（名称在所有接口间唯一）
+        existing_clients = get_clients()
+        for client in existing_clients:
+            if client.name == client_name:
+                return {
+                    'success': False,
+                    'error': f'客户端名称 "{client_name}" 已存在，请使用其他名称'
+                }
+
+        # 查找可用 IP
+        client_ip = iface.allocate_ip(config)
+        if client_ip is None:
+            return {'success': False, 'error': 'Cannot determine VPN subnet'}
+
+        # 服务端公钥（由配置中的私钥在进程内计算）
+        server_key_match = re.search(r'^\s*PrivateKey\s*=\s*(\S+)', config, re.MULTILINE)
+        try:
+            server_public_key = public_key_from_private(server_key_match.group(1))
+        except (AttributeError, ValueError):
+            return {'success': False, 'error': 'Cannot get server public key'}
+
+        # 在进程内生成密钥，私钥不经过子进程命令行
+        private_key, public_key = generate_keypair()
+
+        # 添加 Peer 到服务器配置（分组/标签作为注释元数据）
+        meta_lines = ''
+        if clean_label(group):
+            meta_lines += f'# 分组: {clean_label(group)}\n'
+        tags = parse_tags(','.join(map(str, tags))) if isinstance(tags, list) else ()
+        if tags:
+            meta_lines += f'# 标签: {", ".join(tags)}\n'
+        peer_config = f'''
+# 客户端: {client_name}
+{meta_lines}[Peer]
+PublicKey = {public_key}
+AllowedIPs = {client_ip}/32
+'''
+
+        # 生成客户端配置
+        client_config = f'''[Interface]
+PrivateKey = {private_key}
+Address = {client_ip}/24
+DNS = 8.8.8.8, 1.1.1.1
+
+[Peer]
+PublicKey = {server_public_key}
+Endpoint = {format_endpoint(server_info['public_ip'], server_info['listen_port'])}
+AllowedIPs = 0.0.0.0/0, ::/0
+PersistentKeepalive = 25
+'''
+
+        client_files = {
+            f'{client_name}.conf': client_config,
+            f'{client_name}_private.key': private_key,
+            f'{client_name}_public.key': public_key
+        }
+
+        # 保存客户端文件（权限 600），再修改服务端配置；任何一步失败都删除已写入的文件
+        run_command(['mkdir', '-p', iface.client_dir])
+        try:
+            for filename, content in client_files.items():
+                _write_private_file(os.path.join(iface.client_dir, filename), content)
+            _backup_config(iface)
+            if not iface.write_config(config + peer_config):
+                raise RuntimeError('Cannot write config')
+        except Exception:
+            _remove_client_files(iface, [client_name])
+            raise
+
+        # 运行时只加入新 peer，失败时整体同步
+        reload_result = iface.apply_peers([(public_key, f'{client_ip}/32')])
+        if not reload_result['success']:
+            reload_result = iface.reload()
+
+        result = {
+            'success': True,
+            'client': {
+                'name': client_name,
+                'ip': client_ip,
+                'interface': iface.name,
+                'public_key': public_key
+            },
+            'block': peer_config,
+            'files': client_files
+        }
+        if not reload_result['success']:
+            # 配置已写入，运行时缺少这个 peer：返回警告，由漂移检测（/api/drift）修正
+            error = (reload_result.get('stderr') or reload_result.get('error') or '未知错误').strip()
+            print(f"Warning: {client_name} added to {iface.conf} but not to {iface.name}: {error}")
+            result['warning'] = f'配置已保存，但运行时更新失败: {error}'
+        return result
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+
+def _clean_names(names):
+    """清理并去重客户端名称列表"""
+    cleaned = []
+    for name in names or []:
+        name = re.sub(r'[^a-zA-Z0-9_-]', '', str(name))
+        if name and name not in cleaned:
+            cleaned.append(name)
+    return cleaned
+
+
+def _group_by_interface(names):
+    """
+    按所在接口对客户端名称分组
+
+    Returns:
+        tuple: ({WGInterface: [名称]}, 未找到的名称列表)
+    """
+    by_iface = {}
+    for iface in INTERFACES.values():
+        index = iface.read_index()
+        if index is None or 'placeholder' in index.text:
+            continue
+        for name in names:
+            if index.find(name):
+                by_iface.setdefault(iface, []).append(name)
+    found = {name for iface_names in by_iface.values() for name in iface_names}
+    return by_iface, [name for name in names if name not in found]
+
+
+def clients_in_group(group):
+    """配置中属于指定分组的客户端名称（按当前配置文件，而不是缓存的快照）"""
+    names = []
+    for iface in INTERFACES.values():
+        index = iface.read_index()
+        if index is None:
+            continue
+        names.extend(span.client_name for span in index.peers if span.group == group and span.client_name)
+    return names
+
+
+def _backup_config(iface):
+    """修改前备份接口配置，只保留最近 CONFIG_BACKUP_KEEP 份（变更历史见审计日志）"""
+    backup_name = f'{iface.conf}.backup.{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    if not run_command(['cp', iface.conf, backup_name])['success']:
+        raise RuntimeError('无法创建配置备份')
+    if CONFIG_BACKUP_KEEP > 0:
+        prefix = os.path.basename(iface.conf) + '.backup.'
+        try:
+            backups = sorted(name for name in os.listdir(WG_DIR) if name.startswith(prefix))
+        except OSError:
+            backups = []
+        stale = [os.path.join(WG_DIR, name) for name in backups[:-CONFIG_BACKUP_KEEP]]
+        if stale:
+            run_command(['rm', '-f'] + stale)
+    return backup_name
+
+
+def _apply_runtime_changes(iface, changes, backup_name):
+    """
+    用一条 wg set 应用运行时修改，失败时整体同步；仍失败则恢复备份并抛出 RuntimeError
+
+    Returns:
+        bool: 是否退回了整体同步
+    """
+    result = iface.apply_peers(changes)
+    if result['success']:
+        return False
+    result = iface.reload()
+    if not result['success']:
+        if backup_name:
+            run_command(['cp', backup_name, iface.conf])
+            iface.invalidate()
+        raise RuntimeError(f'运行时更新失败: {result.get("stderr") or result.get("error", "未知错误")}')
+    return True
+
+
+CLIENT_FILE_SUFFIXES = ('.conf', '_private.key', '_public.key', '.png')
+
+
+def _remove_client_files(iface, names):
+    """删除客户端的配置、密钥和二维码文件（只删除确切的文件名，不按前缀匹配）"""
+    paths = [os.path.join(iface.client_dir, name + suffix) for name in names for suffix in CLIENT_FILE_SUFFIXES]
+    if paths:
+        run_command(['rm', '-f'] + paths)
+
+
+def _delete_from_interface(iface, names, backup=True):
+    """
+    在单个接口上批量删除客户端：一次写配置、一条 wg set、一次清理文件和流量记录
+
+    Returns:
+        list: [(名称, 公钥)] 实际删除的客户端
+    """
+    iface.invalidate()
+    index = iface.read_index()
+    if index is None:
+        raise RuntimeError(f'无法读取 {iface.conf}')
+
+    deleted = []
+    for name in names:
+        try:
+            index, removed = remove_peer_block(index, name)
+        except ValueError as e:
+            raise RuntimeError(str(e))
+        deleted.extend((name, span.public_key) for span in removed)
+    if not deleted:
+        return []
+
+    backup_name = _backup_config(iface) if backup else None
+    if not iface.write_config(index):
+        raise RuntimeError('无法写入新配置')
+    _apply_runtime_changes(iface, [(public_key, None) for _, public_key in deleted if public_key], backup_name)
+
+    deleted_names = sorted({name for name, _ in deleted})
+    _remove_client_files(iface, deleted_names)
+    traffic_data = load_traffic_data()
+    if any([traffic_data.pop(name, None) is not None for name in deleted_names]):
+        save_traffic_data(traffic_data)
+    return deleted
+
+
+def delete_peers(names, on_deleted=None):
+    """
+    批量删除客户端（每个接口一次配置写入和一条 wg set）
+
+    Args:
+        on_deleted: 可选回调 on_deleted(iface, [(名称, 公钥)])，每个接口删除完成后调用
+
+    Returns:
+        dict: success、deleted、not_found，失败时包含 error
+    """
+    names = _clean_names(names)
+    if not names:
+        return {'success': False, 'error': '客户端名称无效'}
+
+    by_iface, not_found = _group_by_interface(names)
+    deleted = []
+    try:
+        for iface, iface_names in by_iface.items():
+            iface_deleted = _delete_from_interface(iface, iface_names)
+            if not iface_deleted:
+                continue
+            deleted.extend(name for name, _ in iface_deleted)
+            if on_deleted:
+                on_deleted(iface, iface_deleted)
+    except RuntimeError as e:
+        return {'success': False, 'error': str(e), 'deleted': deleted}
+    return {'success': True, 'deleted': deleted, 'not_found': not_found}
+
+
+def configured_client_names(interface=None):
+    """配置中的全部客户端名称（可限定接口）"""
+    names = []
+    for iface in INTERFACES.values():
+        if interface and iface.name != interface:
+            continue
+        index = iface.read_index()
+        if index is None or 'placeholder' in index.text:
+            continue
+        names.extend(span.client_name for span in index.peers if span.client_name)
+    return names
+
+
+# ==================== 批量导出 ====================
+
+EXPORT_QR_WORKERS = int(os.environ.get('EXPORT_QR_WORKERS', '4'))   # 渲染二维码的线程数
+EXPORT_PREFETCH = EXPORT_QR_WORKERS * 4                             # 最多提前读取/渲染的客户端数
+
+_qr_pool = ThreadPoolExecutor(max_workers=max(1, EXPORT_QR_WORKERS), thread_name_prefix='wg-qr')
+
+
+class _ZipStream:
+    """
+    只追加的 ZIP 输出缓冲
+
+    zipfile 向其中写入，生成器每写完一个条目就取走已有数据。不支持 tell/seek，
+    zipfile 因此使用数据描述符写条目大小，不需要回写文件头。
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stream_zip(entries):
+    """把 (文件名, 内容) 逐个写入 ZIP 并产出压缩后的数据块，内存占用与单个条目相当"""
+    import zipfile  # 只在导出时用到，不拖慢命令行启动
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        for name, data in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            # PNG 已经压缩过，直接存储
+            info.compress_type = zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED
+            info.external_attr = 0o600 << 16
+            archive.writestr(info, data)
+            chunk = stream.take()
+            if chunk:
+                yield chunk
+    yield stream.take()
+
+
+def _export_entries(targets, with_qr):
+    """
+    按顺序产出客户端的 .conf 和二维码 PNG
+
+    二维码在线程池中提前渲染（固定掩码），最多保持 EXPORT_PREFETCH 个客户端在途，
+    内存占用与客户端总数无关；没有 qrcode 库时线程池并行调用 qrencode。
+    """
+    targets = iter(targets)
+    prefix_dirs = len(INTERFACES) > 1
+    pending = deque()
+
+    def fill():
+        while len(pending) < EXPORT_PREFETCH:
+            target = next(targets, None)
+            if target is None:
+                return
+            iface, name = target
+            config_text = _read_private_file(os.path.join(iface.client_dir, f'{name}.conf'))
+            if config_text is None:
+                continue
+            future = _qr_pool.submit(render_qrcode_png, config_text, 0) if with_qr else None
+            pending.append((iface, name, config_text, future))
+
+    fill()
+    while pending:
+        iface, name, config_text, future = pending.popleft()
+        fill()
+        path = f'{iface.name}/{name}' if prefix_dirs else name
+        yield f'{path}.conf', config_text.encode()
+        if future is not None:
+            png = future.result()
+            if png:
+                yield f'{path}.png', png
+
+
+def export_targets(group=None, tag=None, interface=None):
+    """按分组/标签/接口筛选要导出的客户端，返回 [(WGInterface, 名称)]"""
+    targets = []
+    for iface in INTERFACES.values():
+        if interface and iface.name != interface:
+            continue
+        index = iface.read_index()
+        if index is None or 'placeholder' in index.text:
+            continue
+        for span in index.peers:
+            if not span.client_name:
+                continue
+            if group is not None and span.group != group:
+                continue
+            if tag is not None and tag not in span.tags:
+                continue
+            targets.append((iface, span.client_name))
+    return targets
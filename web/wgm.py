@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+wgm - WireGuard 管理命令行工具
+
+直接调用 wgcore，不经过 HTTP 和登录，适合 cron、Ansible 等脚本频繁调用：
+
+    wgm list [--interface wg0] [--group 销售部] [--tag vip] [--json]
+    wgm add alice [--interface wg1] [--group 销售部] [--tag vip] [--json]
+    wgm delete alice bob
+    wgm bulk add names.txt          # 每行 "名称[,分组]"，- 表示标准输入
+    wgm bulk delete names.txt
+    wgm export -o clients.zip [--group 销售部] [--no-qr]
+    wgm stats [--json]
+
+成功退出码为 0，失败为 1。只导入 wgcore，二维码等较慢的库只在导出时加载。
+命令行的修改不会发送 Webhook 通知、记录复制增量或审计日志；启用了配置复制的主节点请使用 Web 接口。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import wgcore  # noqa: E402
+
+# 命令的输出；执行期间 sys.stdout 被替换，核心库的调试 print 不会混入
+_stdout = sys.stdout
+
+
+def _quiet(verbose):
+    """核心库的调试输出（print）默认丢弃，-v 时输出到标准错误"""
+    return contextlib.redirect_stdout(sys.stderr if verbose else io.StringIO())
+
+
+def _emit(*fields):
+    _stdout.write('\t'.join(fields) + '\n')
+
+
+def _print_json(data):
+    json.dump(data, _stdout, ensure_ascii=False, indent=2)
+    _stdout.write('\n')
+
+
+def _read_lines(path):
+    """读取名称列表文件（- 为标准输入），跳过空行和 # 注释"""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def cmd_list(args):
+    clients = wgcore.get_clients(args.interface)
+    if args.group is not None:
+        clients = [c for c in clients if c.group == (args.group or None)]
+    if args.tag:
+        clients = [c for c in clients if args.tag in c.tags]
+
+    now = int(time.time())
+    if args.json:
+        _print_json(wgcore.serialize_clients(clients, now))
+        return 0
+    for c in clients:
+        status = 'disabled' if c.disabled else ('online' if c.is_online(now) else 'offline')
+        _emit(c.name, c.interface, c.ip, c.group or '-', status, wgcore.format_bytes(c.total_rx + c.total_tx))
+    return 0
+
+
+def cmd_add(args):
+    result = wgcore.create_client(args.name, args.interface, args.group, args.tag)
+    if not result['success']:
+        print(f"wgm: {result['error']}", file=sys.stderr)
+        return 1
+    client = result['client']
+    if args.json:
+        _print_json(client)
+    else:
+        _emit(client['name'], client['interface'], client['ip'], client['public_key'])
+    return 0
+
+
+def _delete(names, as_json):
+    result = wgcore.delete_peers(names)
+    if as_json:
+        _print_json(result)
+    else:
+        for name in result.get('deleted', []):
+            _emit('deleted', name)
+        for name in result.get('not_found', []):
+            print(f'not found\t{name}', file=sys.stderr)
+    if not result['success']:
+        print(f"wgm: {result['error']}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_delete(args):
+    return _delete(args.names, args.json)
+
+
+def cmd_bulk(args):
+    lines = _read_lines(args.file)
+    if args.action == 'delete':
+        return _delete([line.split(',')[0].strip() for line in lines], args.json)
+
+    added, failed = [], []
+    for line in lines:
+        name, _, group = (part.strip() for part in line.partition(','))
+        result = wgcore.create_client(name, args.interface, group or args.group)
+        if result['success']:
+            added.append(result['client'])
+            if not args.json:
+                _emit('added', result['client']['name'], result['client']['ip'])
+        else:
+            failed.append({'name': name, 'error': result['error']})
+            print(f"wgm: {name}: {result['error']}", file=sys.stderr)
+    if args.json:
+        _print_json({'added': added, 'failed': failed})
+    return 1 if failed else 0
+
+
+def cmd_export(args):
+    targets = wgcore.export_targets(args.group, args.tag, args.interface)
+    if not targets:
+        print('wgm: 没有可导出的客户端', file=sys.stderr)
+        return 1
+    _stdout.flush()
+    out = open(_stdout.fileno(), 'wb', closefd=False) if args.output == '-' else open(args.output, 'wb')
+    with out:
+        for chunk in wgcore._stream_zip(wgcore._export_entries(targets, not args.no_qr)):
+            out.write(chunk)
+    return 0
+
+
+def cmd_stats(args):
+    now = int(time.time())
+    servers = {info.get('interface'): info for info in wgcore.get_all_server_info()}
+    stats = {}
+    for name in wgcore.INTERFACES:
+        info = servers.get(name, {})
+        stats[name] = {'interface': name, 'address': info.get('address'), 'listen_port': info.get('listen_port'),
+                       'error': info.get('error'), 'clients': 0, 'online': 0, 'disabled': 0,
+                       'rx_bytes': 0, 'tx_bytes': 0}
+    for c in wgcore.get_clients():
+        item = stats[c.interface]
+        item['clients'] += 1
+        item['online'] += c.is_online(now) and not c.disabled
+        item['disabled'] += c.disabled
+        item['rx_bytes'] += c.total_rx
+        item['tx_bytes'] += c.total_tx
+
+    if args.json:
+        _print_json({'generated_at': now, 'interfaces': list(stats.values())})
+        return 0
+    for item in stats.values():
+        state = f"error: {item['error']}" if item['error'] else f"{item['address']} :{item['listen_port']}"
+        _emit(item['interface'], state, f"clients={item['clients']} online={item['online']} "
+              f"disabled={item['disabled']} rx={wgcore.format_bytes(item['rx_bytes'])} "
+              f"tx={wgcore.format_bytes(item['tx_bytes'])}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='wgm', description='WireGuard 管理命令行工具')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出调试信息到标准错误')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('list', help='列出客户端')
+    p.add_argument('--interface')
+    p.add_argument('--group', help='只列出该分组（空字符串为未分组）')
+    p.add_argument('--tag')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser('add', help='添加客户端')
+    p.add_argument('name')
+    p.add_argument('--interface')
+    p.add_argument('--group')
+    p.add_argument('--tag', action='append', help='可重复')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_add)
+
+    p = sub.add_parser('delete', help='删除客户端（每个接口一次配置写入）')
+    p.add_argument('names', nargs='+')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_delete)
+
+    p = sub.add_parser('bulk', help='从文件批量添加/删除客户端')
+    p.add_argument('action', choices=['add', 'delete'])
+    p.add_argument('file', help='每行 "名称[,分组]"，- 表示标准输入')
+    p.add_argument('--interface')
+    p.add_argument('--group', help='没有写分组的行使用该分组')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_bulk)
+
+    p = sub.add_parser('export', help='导出客户端配置和二维码（ZIP）')
+    p.add_argument('-o', '--output', default='-', help='输出文件，默认标准输出')
+    p.add_argument('--interface')
+    p.add_argument('--group')
+    p.add_argument('--tag')
+    p.add_argument('--no-qr', action='store_true', help='只导出 .conf')
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('stats', help='各接口汇总（客户端数、在线数、流量）')
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_stats)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    with _quiet(args.verbose):
+        try:
+            code = args.func(args)
+        except wgcore.BackendError as e:
+            print(f'wgm: WireGuard 后端不可用: {e}', file=sys.stderr)
+            code = 1
+    _stdout.flush()
+    return code
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # 输出被 head 等提前关闭：丢弃剩余输出，避免退出时再次报错
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+wgsupervisor - WireGuard 容器内的接口守护进程
+
+代替 entrypoint-wg.sh 末尾每 30 秒一次的 wg show 循环：
+
+  - 每 SUPERVISOR_INTERVAL 秒（默认 0.5）读取 /sys/class/net/<接口>/flags 判断接口是否存在且已启动，
+    不启动子进程；每 SUPERVISOR_VERIFY_INTERVAL 秒用 wg show allowed-ips 确认内核接口可用
+  - 接口故障时 wg-quick down + up 重建，连续失败按指数退避（SUPERVISOR_BACKOFF_MIN～MAX 秒）
+  - 恢复后（以及每次校验时）对比配置文件和运行时的 peer 公钥，只用一条 wg set 补回缺失的 peer；
+    恢复后还会移除 Web 后端因超出配额暂停、被 wg-quick up 按配置加回的 peer
+  - 在 SUPERVISOR_HOST:SUPERVISOR_PORT 提供健康检查：
+        GET /livez   守护循环在运行（没有卡住）
+        GET /readyz  所有接口已启动、peer 与配置一致
+    两者都返回 JSON（各接口状态、重启次数、最近错误），失败时状态码为 503
+
+只依赖标准库和 wgcore（配置解析、带超时和熔断的命令执行）。
+"""
+
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from wgcore import WG_DIR, INTERFACES, run_command  # noqa: E402
+
+SUPERVISOR_INTERVAL = float(os.environ.get('SUPERVISOR_INTERVAL', '0.5'))                 # 接口存活检查间隔（秒）
+SUPERVISOR_VERIFY_INTERVAL = float(os.environ.get('SUPERVISOR_VERIFY_INTERVAL', '10'))    # wg 运行时和 peer 校验间隔（秒）
+SUPERVISOR_BACKOFF_MIN = float(os.environ.get('SUPERVISOR_BACKOFF_MIN', '0.5'))           # 重建失败后的首次等待（秒）
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get('SUPERVISOR_BACKOFF_MAX', '30'))            # 重建失败后的最长等待（秒）
+SUPERVISOR_HOST = os.environ.get('SUPERVISOR_HOST', '127.0.0.1')                          # 健康检查监听地址
+SUPERVISOR_PORT = int(os.environ.get('SUPERVISOR_PORT', '9180'))                          # 健康检查端口，0 关闭
+
+QUOTA_STATE_FILE = f"{WG_DIR}/quota_state.json"   # Web 后端记录的因超出配额而暂停的 peer
+
+IFF_UP = 0x1
+
+
+def log(message):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+def link_up(name):
+    """接口存在且处于 UP 状态（读取 sysfs，不启动子进程）"""
+    try:
+        with open(f'/sys/class/net/{name}/flags') as f:
+            return bool(int(f.read().strip(), 16) & IFF_UP)
+    except (OSError, ValueError):
+        return False
+
+
+def runtime_public_keys(name):
+    """运行时的 peer 公钥集合，wg 无法读取接口时返回 None"""
+    result = run_command(['wg', 'show', name, 'allowed-ips'], use_sudo=False)
+    if not result['success']:
+        return None
+    return {line.split('\t', 1)[0] for line in result['stdout'].splitlines() if line.strip()}
+
+
+def suspended_public_keys(name):
+    """Web 后端因超出流量配额从运行时移除的 peer（配置文件中仍然存在）"""
+    try:
+        with open(QUOTA_STATE_FILE) as f:
+            suspended = json.load(f).get('suspended', {})
+    except (OSError, ValueError, AttributeError):
+        return set()
+    return {info.get('public_key') for info in suspended.values() if info.get('interface') == name}
+
+
+class InterfaceWatch:
+    """单个接口的守护状态"""
+
+    def __init__(self, iface):
+        self.iface = iface
+        self.state = 'starting'         # up / down / recovering / starting
+        self.since = time.time()
+        self.restarts = 0
+        self.failures = 0               # 连续重建失败次数
+        self.next_attempt = 0           # 下次允许重建的 monotonic 时间
+        self.next_verify = 0
+        self.in_sync = False
+        self.reapplied = 0              # 累计补回的 peer 数
+        self.last_error = None
+        self.last_restart = None
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.since = time.time()
+
+    def verify(self, restarted=False):
+        """
+        确认 wg 能读取接口，并补回配置中有、运行时缺失的 peer
+
+        Args:
+            restarted: 刚执行过 wg-quick up，此时还要移除按配置加回的已暂停（超出配额）peer
+
+        Returns:
+            bool: 接口可用
+        """
+        name = self.iface.name
+        running = runtime_public_keys(name)
+        if running is None:
+            return False
+        self.iface.invalidate()
+        index = self.iface.read_index()
+        if index is None:
+            self.last_error = f'无法读取 {self.iface.conf}'
+            self.in_sync = False
+            return True
+
+        suspended = suspended_public_keys(name)
+        missing = [span for span in index.peers if span.public_key and not span.disabled
+                   and span.public_key not in running and span.public_key not in suspended]
+        readded = suspended & running if restarted else set()
+        if missing or readded:
+            cmd = ['wg', 'set', name]
+            for span in missing:
+                cmd += ['peer', span.public_key]
+                if span.allowed_ips:
+                    cmd += ['allowed-ips', span.allowed_ips.replace(' ', '')]
+            for public_key in readded:
+                cmd += ['peer', public_key, 'remove']
+            result = run_command(cmd, use_sudo=False)
+            if not result['success']:
+                self.last_error = f"同步 peer 失败: {result.get('stderr') or result.get('error')}"
+                self.in_sync = False
+                return True
+            self.reapplied += len(missing)
+            log(f"{name}: re-applied {len(missing)} missing peers, removed {len(readded)} suspended peers")
+        self.in_sync = True
+        return True
+
+    def restart(self):
+        name = self.iface.name
+        self._set_state('recovering')
+        log(f"{name}: interface down, restarting (attempt {self.failures + 1})")
+        run_command(['wg-quick', 'down', name], use_sudo=False, timeout=30)
+        result = run_command(['wg-quick', 'up', name], use_sudo=False, timeout=30)
+        self.last_restart = time.time()
+        self.restarts += 1
+        if result['success'] and link_up(name) and self.verify(restarted=True):
+            self.failures = 0
+            self.last_error = None
+            self._set_state('up')
+            log(f"{name}: restarted, peers in sync: {self.in_sync}")
+            return
+
+        self.failures += 1
+        self.last_error = (result.get('stderr') or result.get('error') or 'wg-quick up 失败').strip()
+        backoff = min(SUPERVISOR_BACKOFF_MAX, SUPERVISOR_BACKOFF_MIN * 2 ** (self.failures - 1))
+        self.next_attempt = time.monotonic() + backoff
+        self._set_state('down')
+        log(f"{name}: restart failed ({self.last_error}), retrying in {backoff:.1f}s")
+
+    def tick(self, now):
+        healthy = link_up(self.iface.name)
+        if healthy and now >= self.next_verify:
+            self.next_verify = now + SUPERVISOR_VERIFY_INTERVAL
+            healthy = self.verify()
+        if healthy:
+            if self.state != 'up':
+                self._set_state('up')
+            return
+        self.in_sync = False
+        if now >= self.next_attempt:
+            self.restart()
+        else:
+            self._set_state('down')
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'since': int(self.since),
+            'in_sync': self.in_sync,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'reapplied': self.reapplied,
+            'last_restart': int(self.last_restart) if self.last_restart else None,
+            'last_error': self.last_error
+        }
+
+
+class Supervisor:
+    def __init__(self, interfaces):
+        self.watches = [InterfaceWatch(iface) for iface in interfaces]
+        self.heartbeat = time.monotonic()
+        self._stop = threading.Event()
+
+    def live(self):
+        # 重建时 wg-quick down/up 最多各阻塞 30 秒，留出余量
+        return time.monotonic() - self.heartbeat < 3 * SUPERVISOR_INTERVAL + 60
+
+    def ready(self):
+        return all(watch.state == 'up' and watch.in_sync for watch in self.watches)
+
+    def status(self):
+        return {'live': self.live(), 'ready': self.ready(),
+                'interfaces': {watch.iface.name: watch.to_dict() for watch in self.watches}}
+
+    def run(self):
+        log(f"Supervising {', '.join(w.iface.name for w in self.watches)} every {SUPERVISOR_INTERVAL}s")
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for watch in self.watches:
+                try:
+                    watch.tick(now)
+                except Exception as e:
+                    watch.last_error = str(e)
+                    log(f"{watch.iface.name}: supervisor error: {e}")
+            self.heartbeat = time.monotonic()
+            self._stop.wait(SUPERVISOR_INTERVAL)
+
+    def stop(self, *_):
+        self._stop.set()
+
+
+def serve_health(supervisor):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            checks = {'/livez': supervisor.live, '/readyz': supervisor.ready, '/healthz': supervisor.ready}
+            check = checks.get(self.path.split('?', 1)[0])
+            if check is None:
+                self.send_error(404)
+                return
+            body = json.dumps(supervisor.status(), ensure_ascii=False).encode()
+            self.send_response(200 if check() else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((SUPERVISOR_HOST, SUPERVISOR_PORT), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='health').start()
+    log(f"Health checks on http://{SUPERVISOR_HOST}:{SUPERVISOR_PORT}/livez and /readyz")
+
+
+def main():
+    supervisor = Supervisor(INTERFACES.values())
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    if SUPERVISOR_PORT:
+        serve_health(supervisor)
+    supervisor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())